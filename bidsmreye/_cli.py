@@ -3,14 +3,14 @@
 from __future__ import annotations
 
 import sys
+from pathlib import Path
 from typing import Any
 
 from rich_argparse import RichHelpFormatter
 
 from bidsmreye._parsers import common_parser, download_parser
-from bidsmreye.bidsmreye import bidsmreye
 from bidsmreye.defaults import default_log_level, log_levels
-from bidsmreye.download import download
+from bidsmreye.environment import set_environment
 from bidsmreye.logger import bidsmreye_log
 
 log = bidsmreye_log(name="bidsmreye")
@@ -37,9 +37,20 @@ def cli(argv: Any = sys.argv) -> None:
         log_level = min(len(log_levels()) - 1, max(log_level + adjustment, 0))
     log_level_name = log_levels()[log_level]
 
-    model_weights_file = None
-    if getattr(args, "model", None) is not None:
-        model_weights_file = str(getattr(args, "model"))  # noqa: B009
+    # before numpy, ANTs and TensorFlow are imported
+    set_environment(
+        nthreads=int(getattr(args, "nthreads", 0)),
+        n_jobs=int(getattr(args, "n_jobs", 1)),
+        omp_nthreads=int(getattr(args, "omp_nthreads", 0)),
+        onednn=not bool(getattr(args, "no_onednn", False)),
+        inter_op_threads=int(getattr(args, "inter_op_threads", 0)),
+    )
+    from bidsmreye.bidsmreye import bidsmreye
+
+    model_weights_file: str | Path | list[str | Path] | None = None
+    if getattr(args, "model", None):
+        models: list[str | Path] = [str(x) for x in getattr(args, "model")]  # noqa: B009
+        model_weights_file = models[0] if len(models) == 1 else models
 
     bidsmreye(
         bids_dir=args.bids_dir[0],
@@ -57,6 +68,23 @@ def cli(argv: Any = sys.argv) -> None:
         linear_coreg=bool(getattr(args, "linear_coreg", False)),
         log_level_name=log_level_name,
         force=bool(getattr(args, "force", False)),
+        n_jobs=int(getattr(args, "n_jobs", 1)),
+        session_reference=bool(getattr(args, "session_reference", False)),
+        eye_slab=bool(getattr(args, "eye_slab", False)),
+        shard=getattr(args, "shard", None),
+        nthreads=int(getattr(args, "nthreads", 0)),
+        omp_nthreads=int(getattr(args, "omp_nthreads", 0)),
+        batch_size=int(getattr(args, "batch_size", 64)),
+        ensemble=bool(getattr(args, "ensemble", False)),
+        inter_op_threads=int(getattr(args, "inter_op_threads", 0)),
+        onednn=not bool(getattr(args, "no_onednn", False)),
+        xla=bool(getattr(args, "xla", False)),
+        bfloat16=bool(getattr(args, "bfloat16", False)),
+        backend=getattr(args, "backend", "tensorflow"),
+        quantization_report=bool(getattr(args, "quantization_report", False)),
+        pipeline=bool(getattr(args, "pipeline", False)),
+        socket=getattr(args, "socket", None),
+        shared_plotlyjs=bool(getattr(args, "shared_plotlyjs", False)),
     )
 
 
@@ -69,4 +97,6 @@ def cli_download(argv: Any = sys.argv) -> None:
     parser = download_parser(formatter_class=RichHelpFormatter)
     args = parser.parse_args(argv[1:])
 
+    from bidsmreye.download import download
+
     download(model=args.model, output_dir=args.output_dir)
@@ -134,6 +134,212 @@ Overwrite previous output.
         """,
         action="store_true",
     )
+    parser.add_argument(
+        "--shard",
+        help="""
+Only process one slice of the runs to split the work across several jobs
+(for example the tasks of a job array).
+Given as INDEX/COUNT with INDEX going from 0 to COUNT-1:
+jobs started with the same COUNT process disjoint slices
+of about the same number of runs.
+        """,
+        metavar="INDEX/COUNT",
+    )
+    parser.add_argument(
+        "--nthreads",
+        help="""
+Maximum number of threads across all the processes started by bidsmreye.
+Defaults to all the CPUs available to bidsmreye.
+""",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--omp_nthreads",
+        help="""
+Maximum number of threads per process
+used by ANTs, TensorFlow and the numerical libraries.
+Defaults to the '--nthreads' budget divided by the number of parallel jobs.
+""",
+        type=int,
+        default=0,
+    )
+    return parser
+
+
+def _add_prepare_arguments(parser: ArgumentParser) -> ArgumentParser:
+    parser.add_argument(
+        "--linear_coreg",
+        help="""
+Uses a less aggressive (and linear) alignment procedure
+to the deepmreye template.
+
+May lead to worse results so check your outputs.
+""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        help="""
+Number of runs to prepare in parallel.
+Each run is coregistered in its own process.
+
+Use -1 to run as many jobs as the '--nthreads' budget allows.
+""",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--session_reference",
+        help="""
+Register the mean of a single run per subject, session and space
+to the deepmreye template and reuse its transforms for all the other runs
+of that session, instead of registering each run separately.
+
+Much faster when there are many runs per session,
+but assumes little head motion between runs.
+""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--eye_slab",
+        help="""
+Only read from disk the part of the images around the eyes
+instead of the whole images.
+The registration to the deepmreye template is then estimated
+on the average of a few volumes of each run.
+
+Reduces memory use and disk access for high resolution data.
+""",
+        action="store_true",
+    )
+    return parser
+
+
+def _add_generalize_arguments(parser: ArgumentParser) -> ArgumentParser:
+    parser.add_argument(
+        "--model",
+        help=f"""
+Model to use. Default model: {default_model()}.
+
+Several models can be passed: they are all applied to each batch of volumes
+and each one gets its own output.
+""",
+        choices=available_models(),
+        default=[default_model()],
+        nargs="+",
+    )
+    parser.add_argument(
+        "--backend",
+        help="""
+Library used to run the models.
+'onnx' converts the models to ONNX once (cached next to the model weights)
+and runs them with ONNX Runtime,
+which requires to install bidsmreye with the 'onnx' extra.
+'onnx_int8' also quantizes the ONNX models to int8
+(cached in the 'models' folder of the output dataset): faster but less precise.
+The quantization is calibrated on the first 4 runs to process, sorted by name.
+""",
+        choices=["tensorflow", "onnx", "onnx_int8"],
+        default="tensorflow",
+    )
+    parser.add_argument(
+        "--quantization_report",
+        help="""
+With '--backend onnx_int8', also apply the float models
+and add the correlation and RMSE between the gaze positions
+predicted by the int8 and float models to the sidecar of each run.
+""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--inter_op_threads",
+        help="""
+Number of independent operations of the model TensorFlow runs at the same time.
+Each one uses up to '--omp_nthreads' threads.
+Defaults to 2 (or 1 with a single thread).
+""",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--no_onednn",
+        help="""
+Disable the oneDNN optimizations of TensorFlow.
+Results may differ slightly from the default
+because of floating-point round-off errors.
+""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--xla",
+        help="""
+Compile the model with XLA before inference.
+Compilation takes time and is not faster on all CPUs.
+""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bfloat16",
+        help="""
+Run the model in bfloat16 on CPUs that support it natively
+(AVX512-BF16 or AMX). Faster on those CPUs but less precise.
+Ignored on other CPUs.
+""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ensemble",
+        help="""
+Also save the average of the predictions of all the models
+with the 'desc-ensemble' entity.
+Only used when several models are passed.
+""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch_size",
+        help="""
+Number of volumes the model processes at once.
+Batches are filled with volumes from several runs.
+""",
+        type=int,
+        default=64,
+    )
+    return parser
+
+
+def _add_all_arguments(parser: ArgumentParser) -> ArgumentParser:
+    parser.add_argument(
+        "--pipeline",
+        help="""
+Generalize each run as soon as it is prepared,
+instead of preparing all the runs first.
+Preparation jobs run while the models predict the eye movements
+of the runs already prepared.
+Inference uses one of the '--n_jobs' shares of the threads.
+""",
+        action="store_true",
+    )
+    return parser
+
+
+def _add_qc_arguments(parser: ArgumentParser) -> ArgumentParser:
+    parser.add_argument(
+        "--shared_plotlyjs",
+        help="""
+Write the plotly.js library once in the 'assets' folder of the output dataset
+and load it from the quality control figures and reports,
+instead of embedding it (a few MB) in each of them.
+The figures then only work next to that folder.
+""",
+        action="store_true",
+    )
+    return parser
+
+
+def _add_socket_arguments(parser: ArgumentParser, help: str) -> ArgumentParser:
+    parser.add_argument("--socket", help=help, type=Path, default=None)
     return parser
 
 
@@ -156,17 +362,7 @@ If your data is not in MNI space, bidsmreye will also register the data to MNI.
         formatter_class=parser.formatter_class,
     )
     prepare_parser = _add_common_arguments(prepare_parser)
-    # TODO make it possible to pass path to a model ?
-    prepare_parser.add_argument(
-        "--linear_coreg",
-        help="""
-Uses a less aggressive (and linear) alignment procedure
-to the deepmreye template.
-
-May lead to worse results so check your outputs.
-""",
-        action="store_true",
-    )
+    prepare_parser = _add_prepare_arguments(prepare_parser)
 
     generalize_parser = subparsers.add_parser(
         "generalize",
@@ -177,38 +373,46 @@ using the default pre-trained model of deepmreye.
         formatter_class=parser.formatter_class,
     )
     generalize_parser = _add_common_arguments(generalize_parser)
-    # TODO make it possible to pass path to a model ?
-    generalize_parser.add_argument(
-        "--model",
-        help=f"Model to use. Default model: {default_model()}.",
-        choices=available_models(),
-        default=default_model(),
+    generalize_parser = _add_generalize_arguments(generalize_parser)
+    generalize_parser = _add_qc_arguments(generalize_parser)
+    generalize_parser = _add_socket_arguments(
+        generalize_parser,
+        help="""
+Unix socket of a daemon started with 'serve'.
+The job is sent to the daemon, which has the models already loaded,
+instead of being run by this process.
+The models and inference options of the daemon are used.
+""",
     )
 
-    all_parser = subparsers.add_parser(
-        "all",
-        help="""Run prepare, generalize.""",
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="""Keep the models loaded and generalize the runs of the jobs
+sent to a local Unix socket (see the '--socket' option of generalize).
+        """,
         formatter_class=parser.formatter_class,
     )
-    all_parser = _add_common_arguments(all_parser)
-    # TODO make it possible to pass path to a model ?
-    all_parser.add_argument(
-        "--linear_coreg",
+    serve_parser = _add_common_arguments(serve_parser)
+    serve_parser = _add_generalize_arguments(serve_parser)
+    serve_parser = _add_qc_arguments(serve_parser)
+    serve_parser = _add_socket_arguments(
+        serve_parser,
         help="""
-Uses a less aggressive (and linear) alignment procedure
-to the deepmreye template.
-
-May lead to worse results so check your outputs.
+Unix socket to listen on.
+Defaults to '.bidsmreye.sock' in the bidsmreye folder of the output directory.
 """,
-        action="store_true",
     )
-    # TODO make it possible to pass path to a model ?
-    all_parser.add_argument(
-        "--model",
-        help=f"Model to use. Default model: {default_model()}.",
-        choices=available_models(),
-        default=default_model(),
+
+    all_parser = subparsers.add_parser(
+        "all",
+        help="""Run prepare, generalize.""",
+        formatter_class=parser.formatter_class,
     )
+    all_parser = _add_common_arguments(all_parser)
+    all_parser = _add_prepare_arguments(all_parser)
+    all_parser = _add_generalize_arguments(all_parser)
+    all_parser = _add_all_arguments(all_parser)
+    all_parser = _add_qc_arguments(all_parser)
 
     qc_parser = subparsers.add_parser(
         "qc",
@@ -216,6 +420,7 @@ May lead to worse results so check your outputs.
         formatter_class=parser.formatter_class,
     )
     qc_parser = _add_common_arguments(qc_parser)
+    qc_parser = _add_qc_arguments(qc_parser)
 
     return parser
 
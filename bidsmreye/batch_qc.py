@@ -0,0 +1,201 @@
+"""Compute the quality control of the eye gaze of many runs at once.
+
+Runs are stacked in arrays of shape (runs, timepoints),
+padded with NaN at the end when they do not have the same length
+(see ``stack_runs``).
+Missing timepoints and padding are treated the same way:
+they are ignored and never flagged as outliers.
+"""
+
+from __future__ import annotations
+
+import warnings
+from collections.abc import Sequence
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+# columns added to the confounds of each run
+QC_COLUMNS = ("displacement", "displacement_outliers", "x_outliers", "y_outliers")
+
+# metrics of each run added to its sidecar
+QC_METRICS = ("NbDisplacementOutliers", "NbXOutliers", "NbYOutliers", "XVar", "YVar")
+
+# bins of the gaze density of each run, in degrees of visual angle:
+# the same for all runs so their densities can be summed
+GAZE_DENSITY_EDGES = np.linspace(-30, 30, 121)
+
+
+def stack_runs(runs: Sequence[npt.ArrayLike]) -> npt.NDArray[Any]:
+    """Stack the time series of several runs, padding them with NaN.
+
+    :param runs: Time series of each run.
+    :type runs: Sequence[np.ndarray]
+
+    :return: Array of shape (runs, timepoints of the longest run).
+    :rtype: np.ndarray
+    """
+    arrays = [np.asarray(x, dtype=float) for x in runs]
+    stacked = np.full((len(arrays), max((len(x) for x in arrays), default=0)), np.nan)
+    for i, x in enumerate(arrays):
+        stacked[i, : len(x)] = x
+    return stacked
+
+
+def compute_displacement(x: npt.NDArray[Any], y: npt.NDArray[Any]) -> npt.NDArray[Any]:
+    """Compute the framewise displacement of the eye gaze of each run.
+
+    :param x: X positions with shape (runs, timepoints).
+    :type x: np.ndarray
+
+    :param y: Y positions with the same shape.
+    :type y: np.ndarray
+
+    :return: Displacement with the same shape, NaN for the first timepoint.
+    :rtype: np.ndarray
+    """
+    displacement = np.full(x.shape, np.nan)
+    displacement[:, 1:] = np.sqrt(np.diff(x, axis=1) ** 2 + np.diff(y, axis=1) ** 2)
+    return displacement
+
+
+def carling_outliers(values: npt.NDArray[Any]) -> npt.NDArray[np.int8]:
+    """Flag the outliers of each run with the adjusted Carling's box-plot rule.
+
+    Same rule as ``bidsmreye.quality_control.compute_robust_outliers``
+    with ``outlier_type="Carling"``:
+    outliers are outside of median +/- k * IQR,
+    with k = (17.63 * n - 23.64) / (7.74 * n - 3.71).
+    The quartiles need at least 7 timepoints:
+    no outlier is flagged in shorter runs.
+
+    :param values: Time series with shape (runs, timepoints).
+    :type values: np.ndarray
+
+    :return: 1 for outliers, 0 otherwise, with the same shape.
+    :rtype: np.ndarray
+    """
+    # NaN are sorted last
+    y = np.sort(values, axis=1)
+    nb_timepoints = (~np.isnan(values)).sum(axis=1)
+
+    def order_statistic(index: npt.NDArray[Any]) -> npt.NDArray[Any]:
+        index = np.clip(index, 0, max(y.shape[1] - 1, 0))
+        return np.take_along_axis(y, index[:, np.newaxis], axis=1)[:, 0]
+
+    j = np.floor(nb_timepoints / 4 + 5 / 12).astype(int)
+    g = (nb_timepoints / 4) - j + (5 / 12)
+    k = nb_timepoints - j + 1
+
+    lower_quartiles = (1 - g) * order_statistic(j) + g * order_statistic(j + 1)
+    higher_quartiles = (1 - g) * order_statistic(k) + g * order_statistic(k - 1)
+    inter_quartiles_range = np.where(
+        k < nb_timepoints, higher_quartiles - lower_quartiles, np.nan
+    )
+
+    # same as np.median: mean of the 2 middle values for an even number of values
+    median = (
+        order_statistic((nb_timepoints - 1) // 2) + order_statistic(nb_timepoints // 2)
+    ) / 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        carling_k = (17.63 * nb_timepoints - 23.64) / (7.74 * nb_timepoints - 3.71)
+    lower_bound = (median - carling_k * inter_quartiles_range)[:, np.newaxis]
+    upper_bound = (median + carling_k * inter_quartiles_range)[:, np.newaxis]
+
+    return ((values < lower_bound) | (values > upper_bound)).astype(np.int8)
+
+
+def batch_quality_control(
+    x: npt.NDArray[Any], y: npt.NDArray[Any]
+) -> dict[str, npt.NDArray[Any]]:
+    """Compute the displacement and the outliers of the eye gaze of each run.
+
+    :param x: X positions with shape (runs, timepoints).
+    :type x: np.ndarray
+
+    :param y: Y positions with the same shape.
+    :type y: np.ndarray
+
+    :return: Values of each column of ``QC_COLUMNS``, with the same shape.
+    :rtype: dict[str, np.ndarray]
+    """
+    displacement = compute_displacement(x, y)
+    return {
+        "displacement": displacement,
+        "displacement_outliers": carling_outliers(displacement),
+        "x_outliers": carling_outliers(x),
+        "y_outliers": carling_outliers(y),
+    }
+
+
+def summarize_runs(
+    x: npt.NDArray[Any], y: npt.NDArray[Any], columns: dict[str, npt.NDArray[Any]]
+) -> dict[str, npt.NDArray[Any]]:
+    """Compute the quality control metrics of each run.
+
+    :param x: X positions with shape (runs, timepoints).
+    :type x: np.ndarray
+
+    :param y: Y positions with the same shape.
+    :type y: np.ndarray
+
+    :param columns: Outliers of each run. See ``batch_quality_control``.
+    :type columns: dict[str, np.ndarray]
+
+    :return: Values of each metric of ``QC_METRICS``, with shape (runs,).
+             Variances are NaN for runs with less than 2 timepoints.
+             They are the same as ``pd.Series.var`` up to rounding errors
+             for runs padded with NaN.
+    :rtype: dict[str, np.ndarray]
+    """
+    with warnings.catch_warnings():
+        # degrees of freedom <= 0
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        x_var = np.nanvar(x, axis=1, ddof=1)
+        y_var = np.nanvar(y, axis=1, ddof=1)
+    return {
+        "NbDisplacementOutliers": columns["displacement_outliers"].sum(axis=1),
+        "NbXOutliers": columns["x_outliers"].sum(axis=1),
+        "NbYOutliers": columns["y_outliers"].sum(axis=1),
+        "XVar": x_var,
+        "YVar": y_var,
+    }
+
+
+def gaze_density(
+    x: npt.NDArray[Any],
+    y: npt.NDArray[Any],
+    edges: npt.NDArray[Any] = GAZE_DENSITY_EDGES,
+) -> npt.NDArray[np.intp]:
+    """Count the gaze positions of each run in the bins of a 2D grid.
+
+    Same counts as ``np.histogram2d(x[i], y[i], bins=[edges, edges])`` for each run,
+    except that positions outside of the grid are counted in its outer bins.
+    Missing timepoints are not counted.
+
+    :param x: X positions with shape (runs, timepoints).
+    :type x: np.ndarray
+
+    :param y: Y positions with the same shape.
+    :type y: np.ndarray
+
+    :param edges: Edges of the bins, along X and Y.
+    :type edges: np.ndarray
+
+    :return: Counts with shape (runs, X bins, Y bins).
+    :rtype: np.ndarray
+    """
+    nb_runs, nb_bins = x.shape[0], len(edges) - 1
+
+    def bin_index(values: npt.NDArray[Any]) -> npt.NDArray[np.intp]:
+        index = np.searchsorted(edges, values, side="right") - 1
+        return np.clip(index, 0, nb_bins - 1)
+
+    valid = ~(np.isnan(x) | np.isnan(y))
+    run = np.broadcast_to(np.arange(nb_runs)[:, np.newaxis], x.shape)[valid]
+    bins = (run * nb_bins + bin_index(x[valid])) * nb_bins + bin_index(y[valid])
+    return np.bincount(bins, minlength=nb_runs * nb_bins**2).reshape(
+        nb_runs, nb_bins, nb_bins
+    )
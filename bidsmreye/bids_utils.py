@@ -18,10 +18,31 @@ from bidsmreye.configuration import (
 )
 from bidsmreye.logger import bidsmreye_log
 from bidsmreye.methods import methods
-from bidsmreye.utils import copy_license, create_dir_if_absent, return_regex
+from bidsmreye.utils import (
+    atomic_write,
+    check_if_file_found,
+    copy_license,
+    create_dir_if_absent,
+    return_regex,
+    set_this_filter,
+)
 
 log = bidsmreye_log("bidsmreye")
 
+# entities that identify a run across the files of the different steps
+RUN_ENTITIES = (
+    "subject",
+    "session",
+    "task",
+    "acquisition",
+    "ceagent",
+    "reconstruction",
+    "direction",
+    "run",
+    "space",
+)
+SESSION_ENTITIES = ("subject", "session", "space")
+
 
 def check_layout(cfg: Config, layout: BIDSLayout, for_file: str = "bold") -> None:
     """Check layout.
@@ -171,21 +192,32 @@ def create_sidecar(
     if source is not None:
         content["Sources"] = [source]  # type: ignore
     sidecar_name = create_bidsname(layout, filename, "no_label_json")
-    json.dump(content, open(sidecar_name, "w"), indent=4)
+    with atomic_write(sidecar_name) as tmp_file, open(tmp_file, "w") as f:
+        json.dump(content, f, indent=4)
     log.debug(f"Sidecar saved to {sidecar_name}")
 
 
 def save_sampling_frequency_to_json(
     layout_out: BIDSLayout, img: BIDSFile, source: str
 ) -> None:
-    metadata = img.get_metadata()
+    save_sampling_frequency(layout_out, img.path, img.get_metadata(), source)
+
+
+def save_sampling_frequency(
+    layout_out: BIDSLayout, img_path: str, metadata: dict[str, Any], source: str
+) -> None:
+    """Save the sampling frequency of an image given its metadata.
+
+    Unlike ``save_sampling_frequency_to_json``,
+    does not need the layout of the input dataset.
+    """
     repetition_time = metadata["RepetitionTime"]
     # TODO handle rare edge case where preprocessed data
     # does not contain RepetitionTime metadata
     if repetition_time <= 1:
         log.warning(f"Found a repetition time of {repetition_time} seconds.")
     create_sidecar(
-        layout_out, img.path, SamplingFrequency=1 / float(repetition_time), source=source
+        layout_out, img_path, SamplingFrequency=1 / float(repetition_time), source=source
     )
 
 
@@ -296,6 +328,125 @@ def list_subjects(cfg: Config, layout: BIDSLayout) -> list[str]:
     return subjects
 
 
+def list_images(cfg: Config, layout_in: BIDSLayout, subject_label: str) -> list[BIDSFile]:
+    """List the functional images to prepare for one subject.
+
+    :param cfg: Configuration object.
+    :type cfg: Config
+
+    :param layout_in: Layout input dataset.
+    :type layout_in: BIDSLayout
+
+    :param subject_label: Can be a regular expression.
+    :type subject_label: str
+
+    :return: Functional images of that subject matching the BIDS filter.
+    :rtype: list[BIDSFile]
+    """
+    this_filter = set_this_filter(cfg, subject_label, "bold")
+
+    bf = layout_in.get(
+        regex_search=True,
+        **this_filter,
+    )
+
+    check_if_file_found(bf, this_filter, layout_in)
+
+    return bf
+
+
+def shard_key(cfg: Config, layout: BIDSLayout, file: str | BIDSFile) -> tuple[str, ...]:
+    """Return the work unit a file belongs to when splitting the work in shards.
+
+    A work unit is a run,
+    or a whole session when one registration is reused per session.
+    The subject label always comes first.
+
+    :param cfg: Configuration object.
+    :type cfg: Config
+
+    :param layout: BIDSLayout of the dataset the file belongs to.
+    :type layout: BIDSLayout
+
+    :param file: File or path to a file of the dataset.
+    :type file: str | BIDSFile
+
+    :rtype: tuple[str, ...]
+    """
+    entities = layout.parse_file_entities(str(getattr(file, "path", file)))
+    names = SESSION_ENTITIES if cfg.session_reference else RUN_ENTITIES
+    return tuple(str(entities.get(x, "")) for x in names)
+
+
+def select_shard(cfg: Config, layout: BIDSLayout, files: list[Any]) -> list[Any]:
+    """Only keep the files belonging to the shard to process.
+
+    Work units are sorted and dealt out in turn to the ``cfg.shard[1]`` shards,
+    so each shard gets a disjoint slice of about the same size
+    whatever the number of runs of each subject.
+
+    :param cfg: Configuration object.
+    :type cfg: Config
+
+    :param layout: BIDSLayout of the dataset the files belong to.
+    :type layout: BIDSLayout
+
+    :param files: Files or paths to files of the dataset.
+    :type files: list[Any]
+
+    :return: Files of the shard, in their original order.
+    :rtype: list[Any]
+    """
+    if cfg.shard is None:
+        return files
+
+    index, count = cfg.shard
+    keys = sorted({shard_key(cfg, layout, x) for x in files})
+    selected = set(keys[index::count])
+
+    log.info(
+        f"Shard {index}/{count}: processing {len(selected)} of {len(keys)} "
+        f"{'sessions' if cfg.session_reference else 'runs'}."
+    )
+
+    return [x for x in files if shard_key(cfg, layout, x) in selected]
+
+
+def list_shard_keys(
+    cfg: Config, layout: BIDSLayout, subjects: list[str], filetype: str = "bold"
+) -> set[tuple[str, ...]] | None:
+    """Return the work units of a dataset assigned to the shard to process.
+
+    Computing them from the input dataset of a step makes sure
+    that all the steps agree on how the work is split.
+
+    :param cfg: Configuration object.
+    :type cfg: Config
+
+    :param layout: BIDSLayout of the dataset.
+    :type layout: BIDSLayout
+
+    :param subjects: Labels of the subjects to process.
+    :type subjects: list[str]
+
+    :param filetype: Type of files defining the work units.
+    :type filetype: str
+
+    :return: ``None`` when the work is not split in shards.
+    :rtype: set[tuple[str, ...]] | None
+    """
+    if cfg.shard is None:
+        return None
+    files = [
+        x
+        for subject_label in subjects
+        for x in layout.get(
+            regex_search=True, **set_this_filter(cfg, subject_label, filetype)
+        )
+    ]
+    return {shard_key(cfg, layout, x) for x in select_shard(cfg, layout, files)}
+
+
 def set_dataset_description(layout: BIDSLayout, is_derivative: bool = True) -> BIDSLayout:
     """Add dataset description to a layout.
 
@@ -356,5 +507,5 @@ def write_dataset_description(layout: BIDSLayout) -> None:
     """
     output_file = Path(layout.root) / "dataset_description.json"
 
-    with open(output_file, "w") as ff:
+    with atomic_write(output_file) as tmp_file, open(tmp_file, "w") as ff:
         json.dump(layout.dataset_description, ff, indent=4)
@@ -6,6 +6,7 @@ from __future__ import annotations
 import json
 import sys
 from pathlib import Path
+from typing import Any
 
 from bidsmreye._version import __version__
 from bidsmreye.configuration import Config
@@ -25,13 +26,19 @@ def bidsmreye(
     task: list[str] | None = None,
     run: list[str] | None = None,
     debug: bool | None = None,
-    model_weights_file: str | None = None,
+    model_weights_file: str | Path | list[str | Path] | None = None,
     reset_database: bool | None = None,
     bids_filter_file: str | None = None,
     linear_coreg: bool = False,
     log_level_name: str | None = None,
     force: bool = False,
+    **kwargs: Any,
 ) -> None:
+    """Run bidsmreye.
+
+    Extra keyword arguments (like ``n_jobs``)
+    are passed to :class:`bidsmreye.configuration.Config`.
+    """
     bids_filter = None
     if bids_filter_file is not None and Path(bids_filter_file).is_file():
         with open(Path(bids_filter_file)) as f:
@@ -53,6 +60,7 @@ def bidsmreye(
         bids_filter=bids_filter,
         linear_coreg=linear_coreg,
         force=force,
+        **kwargs,
     )  # type: ignore
 
     if log_level_name is None:
@@ -73,14 +81,27 @@ def bidsmreye(
     log.debug(f"Configuration:\n{cfg}")
     log.debug(f"{analysis_level=} {action=}")
 
-    if action in {"all", "generalize"} and isinstance(cfg.model_weights_file, str):
+    # jobs sent to a daemon use the models it has loaded
+    uses_models = action in {"all", "generalize", "serve"} and not (
+        action == "generalize" and cfg.socket is not None
+    )
+    if uses_models and any(isinstance(x, str) for x in cfg.list_model_weights_files()):
         from bidsmreye.download import download
 
         model_output_dir = cfg.output_dir / "models"
         model_output_dir.mkdir(exist_ok=True, parents=True)
 
-        cfg.model_weights_file = download(
-            cfg.model_weights_file, output_dir=model_output_dir
+        model_weights_files: list[str | Path] = []
+        for x in cfg.list_model_weights_files():
+            weights = (
+                download(x, output_dir=model_output_dir) if isinstance(x, str) else x
+            )
+            if weights is not None:
+                model_weights_files.append(weights)
+        cfg.model_weights_file = (
+            model_weights_files[0]
+            if len(model_weights_files) == 1
+            else model_weights_files
         )
 
     dispatch(analysis_level=analysis_level, action=action, cfg=cfg)
@@ -97,27 +118,46 @@ def dispatch(analysis_level: str, action: str, cfg: Config) -> None:
             sys.exit(1)
 
     elif analysis_level == "participant":
-        if action == "all":
-            from bidsmreye.generalize import generalize
-            from bidsmreye.prepare_data import prepare_data
+        dispatch_participant(action=action, cfg=cfg)
 
-            prepare_data(cfg)
-            generalize(cfg)
 
-        elif action == "prepare":
-            from bidsmreye.prepare_data import prepare_data
+def dispatch_participant(action: str, cfg: Config) -> None:
+    if action == "all" and cfg.pipeline:
+        from bidsmreye.pipeline import prepare_and_generalize
 
-            prepare_data(cfg)
+        prepare_and_generalize(cfg)
 
-        elif action == "generalize":
-            from bidsmreye.generalize import generalize
+    elif action == "all":
+        from bidsmreye.generalize import generalize
+        from bidsmreye.prepare_data import prepare_data
 
-            generalize(cfg)
+        prepare_data(cfg)
+        generalize(cfg)
 
-        elif action == "qc":
-            from bidsmreye.quality_control import quality_control_input
+    elif action == "prepare":
+        from bidsmreye.prepare_data import prepare_data
 
-            quality_control_input(cfg)
-        else:
-            log.error("Unknown participant level action")
-            sys.exit(1)
+        prepare_data(cfg)
+
+    elif action == "generalize" and cfg.socket is not None:
+        from bidsmreye.serve import job_from_config, submit
+
+        submit(cfg.socket, job_from_config(cfg))
+
+    elif action == "generalize":
+        from bidsmreye.generalize import generalize
+
+        generalize(cfg)
+
+    elif action == "serve":
+        from bidsmreye.serve import serve
+
+        serve(cfg, cfg.socket)
+
+    elif action == "qc":
+        from bidsmreye.quality_control import quality_control_input
+
+        quality_control_input(cfg)
+    else:
+        log.error("Unknown participant level action")
+        sys.exit(1)
@@ -6,9 +6,10 @@ import warnings
 from pathlib import Path
 from typing import Any
 
-from attrs import asdict, converters, define, field
+from attrs import asdict, converters, define, field, validators
 from bids import BIDSLayout  # type: ignore
 
+from bidsmreye.environment import thread_budget
 from bidsmreye.logger import bidsmreye_log
 
 log = bidsmreye_log(name="bidsmreye")
@@ -47,13 +48,38 @@ No dataset_description.json found:
     task: Any | None = field(kw_only=True, default=None)
     run: Any | None = field(kw_only=True, default=None)
 
-    model_weights_file: str | Path | None = field(kw_only=True, default=None)
+    model_weights_file: str | Path | list[str | Path] | None = field(
+        kw_only=True, default=None
+    )
     bids_filter: Any = field(kw_only=True, default=None)
 
     debug: str | bool | None = field(kw_only=True, default=None)
     reset_database: bool = field(kw_only=True, default=False)
     linear_coreg: bool = field(kw_only=True, default=False)
     force: bool = field(kw_only=True, default=False)
+    n_jobs: int = field(kw_only=True, default=1, converter=int)
+    session_reference: bool = field(kw_only=True, default=False)
+    eye_slab: bool = field(kw_only=True, default=False)
+    shard: Any | None = field(kw_only=True, default=None)
+    nthreads: int = field(kw_only=True, default=0, converter=int)
+    omp_nthreads: int = field(kw_only=True, default=0, converter=int)
+    batch_size: int = field(kw_only=True, default=64, converter=int)
+    ensemble: bool = field(kw_only=True, default=False)
+    inter_op_threads: int = field(kw_only=True, default=0, converter=int)
+    onednn: bool = field(kw_only=True, default=True)
+    xla: bool = field(kw_only=True, default=False)
+    bfloat16: bool = field(kw_only=True, default=False)
+    backend: str = field(
+        kw_only=True,
+        default="tensorflow",
+        validator=validators.in_(["tensorflow", "onnx", "onnx_int8"]),
+    )
+    quantization_report: bool = field(kw_only=True, default=False)
+    pipeline: bool = field(kw_only=True, default=False)
+    socket: Path | None = field(
+        kw_only=True, default=None, converter=converters.optional(Path)
+    )
+    shared_plotlyjs: bool = field(kw_only=True, default=False)
 
     has_GPU: bool = False
 
@@ -69,6 +95,12 @@ No dataset_description.json found:
         if not self.run:
             self.run = []
 
+        self.set_thread_budget()
+        self.set_inference_options()
+
+        if self.shard is not None:
+            self.shard = parse_shard(self.shard)
+
         # TODO test for passing bids_filter
         if not self.bids_filter:
             self.bids_filter = get_bids_filter_config()
@@ -106,6 +138,53 @@ No dataset_description.json found:
         self.check_argument(attribute="space", layout_in=layout_in)
         self.check_argument(attribute="run", layout_in=layout_in)
 
+    def set_thread_budget(self) -> None:
+        """Divide the threads budget between the parallel jobs.
+
+        The number of threads per process is applied to
+        ANTs, TensorFlow and the numerical libraries by the command line interface.
+        See ``bidsmreye.environment.set_environment``.
+        """
+        n_jobs = self.n_jobs
+        self.nthreads, self.n_jobs, self.omp_nthreads = thread_budget(
+            self.nthreads, self.n_jobs, self.omp_nthreads
+        )
+        if n_jobs > self.n_jobs:
+            log.warning(
+                f"Running {self.n_jobs} parallel jobs instead of {n_jobs} "
+                f"to stay within the budget of {self.nthreads} threads."
+            )
+        if self.omp_nthreads * self.n_jobs > self.nthreads:
+            log.warning(
+                f"{self.n_jobs} jobs with {self.omp_nthreads} threads each "
+                f"exceed the budget of {self.nthreads} threads."
+            )
+
+    def set_inference_options(self) -> None:
+        """Check and apply the options of TensorFlow for inference on CPU.
+
+        bfloat16 is only used on CPUs that support it natively
+        and relies on oneDNN.
+        The quantization report only applies to int8 models.
+        """
+        if self.quantization_report and self.backend != "onnx_int8":
+            log.warning("The quantization report requires the 'onnx_int8' backend.")
+            self.quantization_report = False
+        if self.bfloat16 and not self.onednn:
+            log.warning("bfloat16 requires oneDNN: using float32.")
+            self.bfloat16 = False
+        if self.bfloat16 and not cpu_supports_bfloat16():
+            log.warning("This CPU does not support bfloat16: using float32.")
+            self.bfloat16 = False
+
+    def list_model_weights_files(self) -> list[str | Path]:
+        """Return the weights of all the models to apply, without duplicates."""
+        if not self.model_weights_file:
+            return []
+        if not isinstance(self.model_weights_file, list):
+            return [self.model_weights_file]
+        return list(dict.fromkeys(self.model_weights_file))
+
     def check_argument(self, attribute: str, layout_in: BIDSLayout) -> Config:
         """Check an attribute value compared to the input dataset content.
 
@@ -171,6 +250,48 @@ No dataset_description.json found:
         return self
 
 
+def cpu_supports_bfloat16() -> bool:
+    """Check if the CPU has native bfloat16 instructions (AVX512-BF16, AMX or ARM BF16).
+
+    Relies on the CPU flags listed in ``/proc/cpuinfo`` so always false
+    on systems that do not have it.
+    """
+    cpuinfo = Path("/proc/cpuinfo")
+    if not cpuinfo.is_file():
+        return False
+    flags = set(cpuinfo.read_text().split())
+    return bool(flags & {"avx512_bf16", "amx_bf16", "bf16"})
+
+
+def parse_shard(value: str | tuple[int, int] | list[int]) -> tuple[int, int]:
+    """Parse the index and count of a shard given as ``INDEX/COUNT``.
+
+    :param value: Shard as a string like ``"0/4"`` or as an (index, count) pair.
+    :type  value: str | tuple[int, int] | list[int]
+
+    :raises ValueError: If the shard is malformed or its index is out of range.
+
+    :return: (index, count) with the index starting at 0.
+    :rtype: tuple[int, int]
+    """
+    try:
+        if isinstance(value, str):
+            index, count = (int(x) for x in value.split("/"))
+        else:
+            index, count = (int(x) for x in value)
+    except (TypeError, ValueError) as exc:
+        raise ValueError(f"shard must be given as INDEX/COUNT, got: '{value}'.") from exc
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(
+            f"shard index must be between 0 and {count - 1}, got: '{value}'."
+            if count >= 1
+            else f"shard count must be at least 1, got: '{value}'."
+        )
+
+    return index, count
+
+
 def config_to_dict(cfg: Config) -> dict[str, Any]:
     """Convert a config to a dictionary.
 
@@ -0,0 +1,134 @@
+"""Set the environment variables read by the numerical libraries when imported.
+
+ANTs, TensorFlow and the BLAS libraries used by numpy read them once,
+when they start their thread pools,
+and the processes started by bidsmreye inherit them.
+So they are set by the command line interface
+before any of those libraries is imported (see ``set_environment``).
+
+Variables already set by the user are never changed.
+"""
+
+from __future__ import annotations
+
+import os
+
+from bidsmreye.logger import bidsmreye_log
+
+log = bidsmreye_log(name="bidsmreye")
+
+# environment variables limiting the number of threads of each library
+THREAD_ENV_VARIABLES = (
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+)
+
+
+def available_cpus() -> int:
+    """Return the number of CPUs this process is allowed to use.
+
+    Relies on the CPU affinity when available,
+    so that the limits set by job schedulers (like SLURM) are respected.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def thread_budget(nthreads: int, n_jobs: int, omp_nthreads: int) -> tuple[int, int, int]:
+    """Divide a budget of threads between parallel jobs.
+
+    :param nthreads: Total number of threads. All the available CPUs if below 1.
+    :type  nthreads: int
+
+    :param n_jobs: Number of parallel jobs. One per thread if below 1.
+                   Reduced to fit in the budget.
+    :type  n_jobs: int
+
+    :param omp_nthreads: Number of threads per job.
+                         The budget divided between the jobs if below 1.
+    :type  omp_nthreads: int
+
+    :return: Total number of threads, number of jobs and threads per job.
+    :rtype: tuple[int, int, int]
+    """
+    if nthreads < 1:
+        nthreads = available_cpus()
+
+    if n_jobs < 1:
+        n_jobs = nthreads
+    n_jobs = min(n_jobs, nthreads)
+
+    if omp_nthreads < 1:
+        omp_nthreads = max(1, nthreads // n_jobs)
+
+    return nthreads, n_jobs, omp_nthreads
+
+
+def _set_env(variable: str, value: str, override: bool = False) -> None:
+    if override or variable not in os.environ:
+        os.environ[variable] = value
+    elif os.environ[variable] != value:
+        log.info(f"Keeping {variable}={os.environ[variable]} set in the environment.")
+
+
+def set_thread_env(nb_threads: int, override: bool = False) -> None:
+    """Set the number of threads of ANTs, TensorFlow and the numerical libraries.
+
+    :param nb_threads: Maximum number of threads per process.
+    :type  nb_threads: int
+
+    :param override: Also change the variables already set.
+    :type  override: bool
+    """
+    for variable in THREAD_ENV_VARIABLES:
+        _set_env(variable, str(nb_threads), override)
+    # independent operations of the TensorFlow graph each get intra op threads
+    _set_env("TF_NUM_INTEROP_THREADS", str(min(2, nb_threads)), override)
+
+
+def set_tensorflow_env(
+    onednn: bool = True, inter_op_threads: int = 0, override: bool = False
+) -> None:
+    """Set the options of TensorFlow that must be set before it is imported.
+
+    The options that can be changed later are set by
+    ``bidsmreye.generalize.set_tensorflow_options``.
+
+    :param onednn: Use the oneDNN optimizations of TensorFlow.
+                   They are on by default, so only disabling them is applied.
+    :type  onednn: bool
+
+    :param inter_op_threads: Number of independent operations run at the same time.
+                             Not applied if below 1.
+    :type  inter_op_threads: int
+
+    :param override: Also change the variables already set.
+    :type  override: bool
+    """
+    if not onednn or override:
+        _set_env("TF_ENABLE_ONEDNN_OPTS", "1" if onednn else "0", override)
+    if inter_op_threads > 0:
+        _set_env("TF_NUM_INTEROP_THREADS", str(inter_op_threads), override)
+
+
+def set_environment(
+    nthreads: int = 0,
+    n_jobs: int = 1,
+    omp_nthreads: int = 0,
+    onednn: bool = True,
+    inter_op_threads: int = 0,
+) -> None:
+    """Apply the thread budget and the TensorFlow options of the command line.
+
+    The number of threads is only limited
+    if ``nthreads`` or ``omp_nthreads`` is given.
+    See ``thread_budget`` for the parameters.
+    """
+    # first, so that inter_op_threads is not replaced by the default of set_thread_env
+    set_tensorflow_env(onednn, inter_op_threads)
+    if nthreads > 0 or omp_nthreads > 0:
+        set_thread_env(thread_budget(nthreads, n_jobs, omp_nthreads)[2])
@@ -0,0 +1,245 @@
+"""Record what produced the outputs of each step to only recompute what changed.
+
+The fingerprint of a work unit is saved in a hidden JSON file
+next to the main output of the step and lists:
+
+- the version of bidsMReye,
+- the Config fields the step depends on,
+- the size, modification time and SHA-256 hash of each input file.
+
+Inputs whose size and modification time did not change are not hashed again,
+so checking a fingerprint is cheap even for large images.
+An input that was only touched is hashed once
+and its new modification time is saved in the fingerprint.
+
+The BOLD images prepared by the steps of ``UNHASHED_STEPS`` are not hashed:
+that would read them whole, while ``--eye_slab`` only reads the eyes.
+They are considered changed as soon as their modification time changes.
+"""
+
+from __future__ import annotations
+
+import copy
+import hashlib
+import json
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+from bidsmreye._version import __version__
+from bidsmreye.configuration import Config
+from bidsmreye.logger import bidsmreye_log
+from bidsmreye.utils import atomic_write
+
+log = bidsmreye_log(name="bidsmreye")
+
+# Config fields each step depends on
+STEP_CONFIG_FIELDS: dict[str, tuple[str, ...]] = {
+    "session_reference": ("linear_coreg", "eye_slab"),
+    "prepare": ("linear_coreg", "session_reference", "eye_slab"),
+    "generalize": ("bfloat16", "backend", "quantization_report", "xla", "onednn"),
+    "onnx_conversion": (),
+    "onnx_quantization": (),
+    "quality_control": ("shared_plotlyjs",),
+}
+
+# steps whose inputs are only compared by size and modification time
+UNHASHED_STEPS = ("session_reference", "prepare")
+
+HASH_CHUNK_SIZE = 2**20
+
+
+def fingerprint_file(output_file: str | Path) -> Path:
+    """Return the file storing the fingerprint of an output.
+
+    Hidden files are ignored by pybids so they do not pollute the dataset.
+    """
+    output_file = Path(output_file)
+    return output_file.parent / f".{output_file.name}.fingerprint.json"
+
+
+def hash_file(file: str | Path) -> str:
+    """Return the SHA-256 hash of the content of a file.
+
+    Hashes are cached as long as the size and modification time of the file
+    do not change, so files shared by many work units (like model weights)
+    are only read once.
+    """
+    stat = Path(file).stat()
+    return _hash_file(str(Path(file).absolute()), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=32)
+def _hash_file(file: str, size: int, mtime_ns: int) -> str:
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_signature(file: str | Path, content_hash: bool = True) -> dict[str, Any]:
+    """Return the size, modification time and hash of a file."""
+    stat = Path(file).stat()
+    signature: dict[str, Any] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if content_hash:
+        signature["sha256"] = hash_file(file)
+    return signature
+
+
+def compute_fingerprint(
+    cfg: Config, step: str, inputs: list[str | Path]
+) -> dict[str, Any]:
+    """Compute the fingerprint of a work unit.
+
+    :param cfg: Configuration object
+    :type  cfg: Config
+
+    :param step: One of the keys of ``STEP_CONFIG_FIELDS``.
+    :type  step: str
+
+    :param inputs: Files the outputs of the work unit are computed from.
+    :type  inputs: list[str | Path]
+
+    :rtype: dict[str, Any]
+    """
+    return {
+        "version": __version__,
+        "step": step,
+        "config": {x: _to_json(getattr(cfg, x)) for x in STEP_CONFIG_FIELDS[step]},
+        "inputs": {
+            str(x): file_signature(x, content_hash=step not in UNHASHED_STEPS)
+            for x in inputs
+        },
+    }
+
+
+def save_fingerprint(
+    cfg: Config, step: str, inputs: list[str | Path], output_file: str | Path
+) -> Path:
+    """Save the fingerprint of a work unit once its outputs have been written.
+
+    :param output_file: Main output of the work unit.
+    :type  output_file: str | Path
+
+    :return: The file the fingerprint was saved to.
+    :rtype: Path
+    """
+    fingerprint = fingerprint_file(output_file)
+    with atomic_write(fingerprint) as tmp_file, open(tmp_file, "w") as f:
+        json.dump(compute_fingerprint(cfg, step, inputs), f, indent=4)
+    return fingerprint
+
+
+def is_up_to_date(
+    cfg: Config,
+    step: str,
+    inputs: list[str | Path],
+    outputs: list[str | Path],
+) -> bool:
+    """Check if the outputs of a work unit need to be recomputed.
+
+    Outputs are up to date if they all exist
+    and the fingerprint saved with the first one matches
+    the current inputs, Config and version of bidsMReye.
+
+    :param cfg: Configuration object
+    :type  cfg: Config
+
+    :param step: One of the keys of ``STEP_CONFIG_FIELDS``.
+    :type  step: str
+
+    :param inputs: Files the outputs of the work unit are computed from.
+    :type  inputs: list[str | Path]
+
+    :param outputs: Outputs of the work unit, starting with the main one.
+    :type  outputs: list[str | Path]
+
+    :rtype: bool
+    """
+    name = Path(outputs[0]).name
+
+    if missing := [Path(x).name for x in outputs if not Path(x).exists()]:
+        if len(missing) < len(outputs):
+            log.warning(f"Recomputing '{name}': missing {missing}.")
+        return False
+
+    if cfg.force:
+        log.info(f"Recomputing '{name}': --force.")
+        return False
+
+    fingerprint = fingerprint_file(outputs[0])
+    if not fingerprint.exists():
+        log.warning(
+            f"Recomputing '{name}': no fingerprint, "
+            "it was computed by a version of bidsMReye before 'fingerprints' "
+            "or its fingerprint was deleted."
+        )
+        return False
+
+    with open(fingerprint) as f:
+        saved = json.load(f)
+    before = copy.deepcopy(saved)
+
+    reason = _changed(cfg, step, inputs, saved)
+    if reason is not None:
+        log.warning(f"Recomputing '{name}': {reason}.")
+        return False
+
+    # only the modification time of some inputs changed:
+    # save it so they are not hashed again on the next run
+    if saved != before:
+        with atomic_write(fingerprint) as tmp_file, open(tmp_file, "w") as f:
+            json.dump(saved, f, indent=4)
+
+    log.debug(
+        "Output for the following file is up to date. "
+        "Use the '--force' option to overwrite. "
+        f"\n '{name}'"
+    )
+    return True
+
+
+def _changed(
+    cfg: Config, step: str, inputs: list[str | Path], saved: dict[str, Any]
+) -> str | None:
+    """Return why a saved fingerprint does not match, if it does not."""
+    if saved.get("version") != __version__:
+        return f"computed with bidsMReye {saved.get('version')}"
+
+    config = {x: _to_json(getattr(cfg, x)) for x in STEP_CONFIG_FIELDS[step]}
+    if saved.get("step") != step or saved.get("config") != config:
+        return "options changed"
+
+    saved_inputs = saved.get("inputs", {})
+    if set(saved_inputs) != {str(x) for x in inputs}:
+        return "inputs changed"
+
+    for file in inputs:
+        if _input_changed(file, saved_inputs[str(file)]):
+            return f"{Path(file).name} changed"
+
+    return None
+
+
+def _input_changed(file: str | Path, before: dict[str, Any]) -> bool:
+    """Check if an input changed since its signature ``before`` was saved.
+
+    If only its modification time changed, it is updated in ``before``.
+    """
+    if not Path(file).exists():
+        return True
+    now = file_signature(file, content_hash=False)
+    if now["size"] != before.get("size"):
+        return True
+    if now["mtime_ns"] == before.get("mtime_ns"):
+        return False
+    # only hash files that were touched
+    if "sha256" not in before or hash_file(file) != before["sha256"]:
+        return True
+    before["mtime_ns"] = now["mtime_ns"]
+    return False
+
+
+def _to_json(value: Any) -> Any:
+    return str(value) if isinstance(value, Path) else value
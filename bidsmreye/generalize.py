@@ -4,40 +4,300 @@ from __future__ import annotations
 
 import json
 import logging
-import os
-import shutil
 import warnings
+from collections.abc import Iterator
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
+import tensorflow as tf
 from bids import BIDSLayout  # type: ignore
-from deepmreye import analyse, train
-from deepmreye.util import data_generator, model_opts
-from rich import print
+from bids.layout import BIDSFile
+from deepmreye import analyse, architecture
+from deepmreye.util import model_opts
 
 from bidsmreye.bids_utils import (
     check_layout,
     create_bidsname,
     get_dataset_layout,
+    list_shard_keys,
     list_subjects,
     return_desc_entity,
+    shard_key,
 )
 from bidsmreye.configuration import Config
+from bidsmreye.fingerprint import is_up_to_date, save_fingerprint
 from bidsmreye.logger import bidsmreye_log
-from bidsmreye.quality_control import quality_control_output
+from bidsmreye.onnx_backend import (
+    OnnxModel,
+    compare_gaze,
+    convert_to_onnx,
+    onnx_model_file,
+    quantize_onnx_model,
+    quantized_model_file,
+)
+from bidsmreye.quality_control import quality_control_output, quality_control_runs
+from bidsmreye.report import generate_report
 from bidsmreye.utils import (
     add_timestamps_to_dataframe,
+    atomic_write,
     check_if_file_found,
-    create_dir_for_file,
-    move_file,
+    load_timeseries,
     progress_bar,
     set_this_filter,
 )
 
 log = bidsmreye_log(name="bidsmreye")
 
+# desc entity of the average of the predictions of several models
+ENSEMBLE_DESC = "ensemble"
+
+# name of the float model a quantized model is compared to
+REFERENCE_NAME = "{}_float"
+
+# folder of the output dataset where the int8 models are saved (ignored by pybids)
+QUANTIZED_MODELS_DIR = "models"
+
+# number of runs the int8 quantization is calibrated on
+CALIBRATION_RUNS = 4
+
+
+def input_shape(file: str | Path) -> tuple[int, ...]:
+    """Return the shape of the model input for an extracted timeseries file.
+
+    Only reads the first volume of the file.
+    """
+    with np.load(file) as content:
+        return (*content["data_0"].shape, 1)
+
+
+def set_tensorflow_options(bfloat16: bool = False) -> None:
+    """Set the options of TensorFlow that can be changed once it is imported.
+
+    The other options are set with environment variables by
+    ``bidsmreye.environment.set_tensorflow_env``.
+
+    :param bfloat16: Let oneDNN run the model in bfloat16 where it is safe.
+                     Inputs and outputs of the model remain float32.
+    :type bfloat16: bool
+    """
+    tf.config.optimizer.set_experimental_options(
+        {"auto_mixed_precision_onednn_bfloat16": bfloat16}
+    )
+
+
+@lru_cache(maxsize=16)
+def load_model(
+    model_weights_file: str | Path, input_shape: tuple[int, ...], xla: bool = False
+) -> Any:
+    """Build the inference model and load its weights.
+
+    The model is cached so it is only built once per process
+    and reused for all the runs with the same input shape.
+
+    :param model_weights_file: Weights of a pretrained deepMReye model.
+    :type model_weights_file: str | Path
+
+    :param input_shape: Shape of the data of one volume, with a channel dimension.
+    :type input_shape: tuple[int, ...]
+
+    :param xla: Compile the forward pass of the model with XLA.
+    :type xla: bool
+
+    :return: Model instance used for inference.
+    :rtype: Keras Model
+    """
+    log.info(f"Loading model: {Path(model_weights_file).name}")
+    _, model_inference = architecture.create_standard_model(
+        input_shape, model_opts.get_opts()
+    )
+    model_inference.load_weights(model_weights_file)
+    model_inference.jit_compile = xla
+    return model_inference
+
+
+def convert_model(
+    cfg: Config, model_weights_file: str | Path, input_shape: tuple[int, ...]
+) -> Path:
+    """Convert a model to ONNX if it has not been done yet.
+
+    The conversion is cached next to the weights of the model.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param model_weights_file: Weights of a pretrained deepMReye model.
+    :type model_weights_file: str | Path
+
+    :param input_shape: Shape of the data of one volume, with a channel dimension.
+    :type input_shape: tuple[int, ...]
+
+    :return: ONNX model.
+    :rtype: Path
+    """
+    onnx_file = onnx_model_file(model_weights_file, input_shape)
+    if not is_up_to_date(cfg, "onnx_conversion", [model_weights_file], [onnx_file]):
+        convert_to_onnx(
+            load_model(model_weights_file, input_shape), input_shape, onnx_file
+        )
+        save_fingerprint(cfg, "onnx_conversion", [model_weights_file], onnx_file)
+    return onnx_file
+
+
+def calibration_runs(files: list[str]) -> list[str]:
+    """Select the runs the int8 quantization is calibrated on.
+
+    The first ``CALIBRATION_RUNS`` runs by name,
+    so the same runs are selected whatever the order the runs are processed in.
+
+    :param files: Extracted timeseries of the runs to process.
+    :type files: list[str]
+
+    :rtype: list[str]
+    """
+    return sorted(files, key=lambda x: Path(x).name)[:CALIBRATION_RUNS]
+
+
+def _quantized_model_file(cfg: Config, onnx_file: Path, files: list[str]) -> Path:
+    return quantized_model_file(
+        onnx_file, cfg.output_dir / QUANTIZED_MODELS_DIR, calibration_runs(files)
+    )
+
+
+def quantize_model(
+    cfg: Config,
+    model_weights_file: str | Path,
+    input_shape: tuple[int, ...],
+    files: list[str],
+) -> Path:
+    """Quantize a model to int8 if it has not been done yet.
+
+    The model is calibrated on the runs selected by ``calibration_runs``
+    and cached in the ``QUANTIZED_MODELS_DIR`` folder of the output dataset.
+    It is quantized again if the ONNX model or those runs change.
+
+    :param files: Extracted timeseries of the runs to process.
+    :type files: list[str]
+
+    :return: Quantized ONNX model.
+    :rtype: Path
+    """
+    onnx_file = convert_model(cfg, model_weights_file, input_shape)
+    quantized_file = _quantized_model_file(cfg, onnx_file, files)
+    calibration = calibration_runs(files)
+    inputs: list[str | Path] = [onnx_file, *calibration]
+    if not is_up_to_date(cfg, "onnx_quantization", inputs, [quantized_file]):
+        quantize_onnx_model(onnx_file, quantized_file, calibration)
+        save_fingerprint(cfg, "onnx_quantization", inputs, quantized_file)
+    return quantized_file
+
+
+def model_files(
+    cfg: Config, models: dict[str, str | Path], files: list[str]
+) -> dict[str, list[str | Path]]:
+    """Return the files each model is applied from, by desc entity.
+
+    With the ONNX backends, the converted or quantized models
+    are listed after the weights, so the outputs are computed again
+    when they change.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param models: Weights of the models to apply, by desc entity.
+    :type models: dict[str, str | Path]
+
+    :param files: Extracted timeseries of the runs to process.
+                  See ``load_models``.
+    :type files: list[str]
+
+    :rtype: dict[str, list[str | Path]]
+    """
+    if cfg.backend == "tensorflow":
+        return {name: [x] for name, x in models.items()}
+
+    shape = input_shape(calibration_runs(files)[0])
+    applied: dict[str, list[str | Path]] = {}
+    for name, x in models.items():
+        onnx_file = onnx_model_file(x, shape)
+        if cfg.backend == "onnx":
+            applied[name] = [x, onnx_file]
+        elif cfg.quantization_report:
+            applied[name] = [x, _quantized_model_file(cfg, onnx_file, files), onnx_file]
+        else:
+            applied[name] = [x, _quantized_model_file(cfg, onnx_file, files)]
+    return applied
+
+
+def load_onnx_model(cfg: Config, onnx_file: Path) -> OnnxModel:
+    """Start an ONNX Runtime session with the threads of the configuration.
+
+    Sessions are cached so they are only started once per process.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param onnx_file: ONNX model. See ``convert_model``.
+    :type onnx_file: Path
+
+    :rtype: OnnxModel
+    """
+    return _load_onnx_model(onnx_file, cfg.omp_nthreads, max(1, cfg.inter_op_threads))
+
+
+@lru_cache(maxsize=16)
+def _load_onnx_model(
+    onnx_file: Path, nb_threads: int, inter_op_threads: int
+) -> OnnxModel:
+    log.info(f"Loading model: {onnx_file.name}")
+    return OnnxModel(onnx_file, nb_threads, inter_op_threads)
+
+
+def load_models(
+    cfg: Config, models: dict[str, str | Path], files: list[str]
+) -> dict[str, Any]:
+    """Load the models with the backend of the configuration.
+
+    With ``cfg.quantization_report``, the float version of each int8 model
+    is also loaded under the name ``REFERENCE_NAME``.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param models: Weights of the models to apply, by desc entity.
+    :type models: dict[str, str | Path]
+
+    :param files: Extracted timeseries of the runs to process.
+                  The runs selected by ``calibration_runs`` must be prepared.
+    :type files: list[str]
+
+    :return: Model instances used for inference, by name.
+    :rtype: dict[str, Any]
+    """
+    shape = input_shape(calibration_runs(files)[0])
+    if cfg.backend == "tensorflow":
+        return {name: load_model(x, shape, cfg.xla) for name, x in models.items()}
+
+    if cfg.backend == "onnx":
+        return {
+            name: load_onnx_model(cfg, convert_model(cfg, x, shape))
+            for name, x in models.items()
+        }
+
+    models_inference = {
+        name: load_onnx_model(cfg, quantize_model(cfg, x, shape, files))
+        for name, x in models.items()
+    }
+    if cfg.quantization_report:
+        for name, x in models.items():
+            models_inference[REFERENCE_NAME.format(name)] = load_onnx_model(
+                cfg, convert_model(cfg, x, shape)
+            )
+    return models_inference
+
 
 def create_and_save_figure(
     layout_out: BIDSLayout, file: str, evaluation: Any, scores: Any
@@ -69,14 +329,18 @@ def create_and_save_figure(
         fig.show()
 
     confound_svg = create_bidsname(layout_out, file, "confounds_svg")
-    create_dir_for_file(confound_svg)
-    fig.write_image(confound_svg)
+    with atomic_write(confound_svg) as tmp_file:
+        fig.write_image(tmp_file)
 
 
 def convert_confounds(
-    layout_out: BIDSLayout, file: str | Path, extra_entities: dict[str, str] | None = None
+    layout_out: BIDSLayout,
+    file: str | Path,
+    pred_y: npt.NDArray[Any],
+    extra_entities: dict[str, str] | None = None,
+    extra_metadata: dict[str, Any] | None = None,
 ) -> Path:
-    """Convert numpy output to TSV.
+    """Save the eye movements predicted for a run as TSV with its JSON sidecar.
 
     :param layout_out: pybids layout to of the dataset to act on.
     :type layout_out: BIDSLayout
@@ -84,12 +348,15 @@ def convert_confounds(
     :param file: File to generate the confounds for.
     :type file: Union[str, Path]
 
+    :param pred_y: Gaze position predicted for each sub-TR of each volume,
+                   with shape (volumes, sub-TRs, 2). See ``predict_runs``.
+    :type pred_y: np.ndarray
+
+    :param extra_metadata: Added to the sidecar.
+    :type extra_metadata: dict[str, Any] | None
+
     :return: Name of the file generated.
     :rtype: Path
-
-    This function should preferably work on a single file
-    but should still be able to unpack the results from a numpy file
-    with results from multiple files.
     """
     COLUMNS = ["timestamp", "x_coordinate", "y_coordinate"]
 
@@ -97,8 +364,7 @@ def convert_confounds(
     confounds_json = create_bidsname(
         layout_out, file, "confounds_json", extra_entities=extra_entities
     )
-    shutil.copyfile(bold_json, confounds_json)
-    with open(confounds_json) as f:
+    with open(bold_json) as f:
         metadata = json.load(f)
     metadata["StartTime"] = 0.0
     metadata["Columns"] = COLUMNS
@@ -120,147 +386,370 @@ def convert_confounds(
         "Description": ("Gaze position y-coordinate of the recorded eye."),
         "Units": "degrees",
     }
-    with open(confounds_json, "w") as f:
+    metadata.update(extra_metadata or {})
+    with atomic_write(confounds_json) as tmp_file, open(tmp_file, "w") as f:
         metadata = {key: metadata[key] for key in sorted(metadata)}
         json.dump(metadata, f, indent=4)
     log.debug(f"Sidecar saved to {confounds_json}")
 
-    confound_numpy = create_bidsname(
-        layout_out, file, "confounds_numpy", extra_entities=extra_entities
-    )
-
-    content = np.load(
-        file=confound_numpy,
-        allow_pickle=True,
-    )
-
-    evaluation = content.item(0)
-    for key, item in evaluation.items():
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
 
-            this_pred = np.nanmedian(item["pred_y"], axis=1)
+        this_pred = np.nanmedian(pred_y, axis=1)
 
-        confound_name = create_bidsname(
-            layout_out, Path(key + "p"), "confounds_tsv", extra_entities=extra_entities
-        )
+    confound_name = create_bidsname(
+        layout_out, file, "confounds_tsv", extra_entities=extra_entities
+    )
 
-        log.info(f"Saving eye gaze data to {confound_name.relative_to(layout_out.root)}")
+    log.info(f"Saving eye gaze data to {confound_name.relative_to(layout_out.root)}")
 
-        df = pd.DataFrame(this_pred)
-        df = add_timestamps_to_dataframe(df, metadata["SamplingFrequency"])
+    df = pd.DataFrame(this_pred)
+    df = add_timestamps_to_dataframe(df, metadata["SamplingFrequency"])
 
+    with atomic_write(confound_name) as tmp_file:
         df.to_csv(
-            confound_name,
+            tmp_file,
             sep="\t",
             header=COLUMNS,
             index=None,
         )
 
-    log.debug(f"Removing {confound_numpy.relative_to(layout_out.root)}")
-    os.remove(confound_numpy)
-
     return confound_name
 
 
-def create_confounds_tsv(
+def batch_volumes(
+    files: list[str], batch_size: int
+) -> Iterator[list[tuple[str, npt.NDArray[Any], bool]]]:
+    """Split the volumes of several runs in batches of fixed size.
+
+    Volumes of consecutive runs are concatenated,
+    so a batch can contain the end of a run and the beginning of the next ones.
+    Volumes are memory mapped (see ``bidsmreye.utils.load_timeseries``)
+    and only the ones of the current batch are read in memory,
+    so memory use does not depend on the length of the runs.
+
+    :param files: Extracted timeseries of the runs.
+    :type files: list[str]
+
+    :param batch_size: Number of volumes per batch.
+                       The last batch can be smaller.
+    :type batch_size: int
+
+    :return: Batches as lists of (run, volumes, whether those are the last volumes
+             of the run) tuples.
+    :rtype: Iterator[list[tuple[str, np.ndarray, bool]]]
+    """
+    batch: list[tuple[str, npt.NDArray[Any], bool]] = []
+    size = 0
+    for file in files:
+        volumes = load_timeseries(file)
+        if not volumes:
+            log.warning(f"No volume found in: {Path(file).name}")
+            continue
+        start = 0
+        while start < len(volumes):
+            stop = min(start + batch_size - size, len(volumes))
+            X = np.stack(volumes[start:stop])[..., np.newaxis]
+            batch.append((file, X, stop == len(volumes)))
+            size += stop - start
+            start = stop
+            if size == batch_size:
+                yield batch
+                batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def predict_runs(
+    models: dict[str, Any], files: list[str], batch_size: int = 64
+) -> Iterator[tuple[str, dict[str, dict[str, npt.NDArray[Any]]]]]:
+    """Predict eye movements for several runs with batches spanning runs.
+
+    This keeps the batches full, whatever the number of volumes of each run.
+    Each batch is loaded once and passed to all the models.
+
+    :param models: Model instances used for inference, by name.
+                   See ``load_model``.
+    :type models: dict[str, Keras Model]
+
+    :param files: Extracted timeseries of the runs.
+    :type files: list[str]
+
+    :param batch_size: Number of volumes per forward pass.
+    :type batch_size: int
+
+    :return: Run and the predictions of each model,
+             as soon as all its volumes are predicted.
+    :rtype: Iterator[tuple[str, dict[str, dict[str, np.ndarray]]]]
+    """
+    pred_y: dict[str, list[npt.NDArray[Any]]] = {name: [] for name in models}
+    euc_pred: dict[str, list[npt.NDArray[Any]]] = {name: [] for name in models}
+    for batch in batch_volumes(files, batch_size):
+        X = np.concatenate([x for _, x, _ in batch])
+        batch_predictions = {
+            name: model.predict_on_batch(X) for name, model in models.items()
+        }
+        start = 0
+        for file, x, is_last in batch:
+            for name, (batch_pred_y, batch_euc_pred) in batch_predictions.items():
+                pred_y[name].append(np.asarray(batch_pred_y[start : start + len(x)]))
+                euc_pred[name].append(np.asarray(batch_euc_pred[start : start + len(x)]))
+            start += len(x)
+            if is_last:
+                yield (
+                    file,
+                    {
+                        name: {
+                            "pred_y": np.concatenate(pred_y[name]),
+                            "euc_pred": np.concatenate(euc_pred[name]),
+                        }
+                        for name in models
+                    },
+                )
+                pred_y = {name: [] for name in models}
+                euc_pred = {name: [] for name in models}
+
+
+def list_runs(
+    cfg: Config,
     layout_out: BIDSLayout,
-    file: str,
     subject_label: str,
-    extra_entities: dict[str, str] | None = None,
-) -> None:
-    """Generate a TSV file for the eye motion timeseries.
+    keys: set[tuple[str, ...]] | None = None,
+) -> list[BIDSFile]:
+    """List the extracted timeseries of one subject.
+
+    :param cfg: Configuration object
+    :type cfg: Config
 
     :param layout_out:
     :type layout_out: BIDSLayout
 
-    :param file:
-    :type file: str
-
     :param subject_label:
     :type subject_label: str
+
+    :param keys: Work units of the shard to process.
+                 See ``bids_utils.list_shard_keys``.
+    :type keys: set[tuple[str, ...]] | None
+
+    :rtype: list[BIDSFile]
     """
-    confound_numpy = create_bidsname(
-        layout_out, file, "confounds_numpy", extra_entities=extra_entities
+    this_filter = set_this_filter(cfg, subject_label, "no_label_bold")
+
+    bf = layout_out.get(
+        regex_search=True,
+        **this_filter,
     )
 
-    source_file = Path(layout_out.root) / f"sub-{subject_label}" / "results_tmp.npy"
+    check_if_file_found(bf, this_filter, layout_out)
 
-    move_file(
-        source_file,
-        confound_numpy,
-    )
+    if keys is not None:
+        bf = [x for x in bf if shard_key(cfg, layout_out, x) in keys]
 
-    convert_confounds(layout_out, file, extra_entities=extra_entities)
+    return bf
 
 
-def process_subject(cfg: Config, layout_out: BIDSLayout, subject_label: str) -> None:
-    """Run generalize for one subject.
+def list_outputs(
+    cfg: Config, models: dict[str, list[str | Path]]
+) -> dict[str, list[str | Path]]:
+    """List the outputs to compute for each run and the models they depend on.
 
     :param cfg: Configuration object
     :type cfg: Config
 
-    :param layout_out:
-    :type layout_out: BIDSLayout
+    :param models: Files each model is applied from, by desc entity.
+                   See ``model_files``.
+    :type models: dict[str, list[str | Path]]
 
-    :param subject_label:
-    :type subject_label: str
+    :return: Files of the models each output is computed from, by desc entity.
+    :rtype: dict[str, list[str | Path]]
     """
-    log.info(f"Running subject: {subject_label}")
+    outputs: dict[str, list[str | Path]] = dict(models)
+    if cfg.ensemble:
+        if len(models) < 2:
+            log.warning("Only one model to apply: no ensemble will be computed.")
+        else:
+            outputs[ENSEMBLE_DESC] = [x for files in models.values() for x in files]
+    return outputs
 
-    this_filter = set_this_filter(cfg, subject_label, "no_label_bold")
 
-    bf = layout_out.get(
-        regex_search=True,
-        **this_filter,
-    )
+def stale_outputs(
+    cfg: Config,
+    layout_out: BIDSLayout,
+    file: str,
+    outputs: dict[str, list[str | Path]],
+) -> dict[str, list[str | Path]]:
+    """List the outputs of a run that are missing or out of date.
 
-    check_if_file_found(bf, this_filter, layout_out)
+    :param file: Extracted timeseries of the run.
+    :type file: str
 
-    for file in bf:
-        log.info(f"Processing file: {Path(file.path).name}")
+    :param outputs: Files of the models each output is computed from,
+                    by desc entity. See ``list_outputs``.
+    :type outputs: dict[str, list[str | Path]]
 
-        print("\n")
-        generators = data_generator.create_generators([file.path], [file.path])
-        generators = (*generators, [file.path], [file.path])
-        print("\n")
+    :return: Inputs of the outputs to compute, by desc entity.
+    :rtype: dict[str, list[str | Path]]
+    """
+    stale: dict[str, list[str | Path]] = {}
+    for desc, files in outputs.items():
+        inputs: list[str | Path] = [file, Path(file).with_suffix(".json"), *files]
+        confounds_tsv = create_bidsname(
+            layout_out, file, "confounds_tsv", extra_entities={"desc": desc}
+        )
+        if not is_up_to_date(cfg, "generalize", inputs, [confounds_tsv]):
+            stale[desc] = inputs
+    return stale
 
-        opts = model_opts.get_opts()
 
-        _, model_inference = train.train_model(
-            dataset="example_data",
-            generators=generators,
-            opts=opts,
-            return_untrained=True,
-        )
-        model_inference.load_weights(cfg.model_weights_file)
-
-        verbose = 0
-        if log.isEnabledFor(logging.DEBUG):
-            verbose = 2
-        elif log.isEnabledFor(logging.INFO):
-            verbose = 1
-
-        _, _ = train.evaluate_model(
-            dataset="tmp",
-            model=model_inference,
-            generators=generators,
-            save=True,
-            model_path=f"{layout_out.root}/sub-{subject_label}/",
-            model_description="",
-            verbose=verbose,
-            percentile_cut=80,
-        )
+def list_runs_to_process(
+    cfg: Config,
+    layout_out: BIDSLayout,
+    files: list[str],
+    outputs: dict[str, list[str | Path]],
+) -> dict[str, dict[str, list[str | Path]]]:
+    """List the runs with outputs that are missing or out of date.
+
+    :param files: Extracted timeseries of the runs.
+    :type files: list[str]
+
+    :param outputs: Files of the models each output is computed from,
+                    by desc entity. See ``list_outputs``.
+    :type outputs: dict[str, list[str | Path]]
+
+    :return: Inputs of the outputs to compute, by desc entity, for each run.
+    :rtype: dict[str, dict[str, list[str | Path]]]
+    """
+    return {
+        file: stale
+        for file in files
+        if (stale := stale_outputs(cfg, layout_out, file, outputs))
+    }
+
+
+def list_models(cfg: Config) -> dict[str, str | Path]:
+    """Return the weights of the models to apply, by desc entity.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :rtype: dict[str, str | Path]
+    """
+    models = {return_desc_entity(Path(x)): x for x in cfg.list_model_weights_files()}
+    if not models:
+        raise ValueError("No model weights to apply.")
+    return models
+
+
+def generalize_runs(
+    cfg: Config,
+    layout_out: BIDSLayout,
+    models_inference: dict[str, Any],
+    models: dict[str, str | Path],
+    runs: dict[str, dict[str, list[str | Path]]],
+) -> Iterator[str]:
+    """Predict the eye movements of some runs and save the outputs.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param layout_out: Output dataset layout.
+    :type layout_out: BIDSLayout
+
+    :param models_inference: Model instances used for inference, by name.
+                             See ``load_models``.
+    :type models_inference: dict[str, Any]
 
-        extra_entities = None
-        if cfg.model_weights_file is not None:
-            extra_entities = {"desc": return_desc_entity(Path(cfg.model_weights_file))}
-        create_confounds_tsv(layout_out, file.path, subject_label, extra_entities)
+    :param models: Weights of the models to apply, by desc entity.
+    :type models: dict[str, str | Path]
+
+    :param runs: Inputs of the outputs to compute, by desc entity, for each run.
+                 See ``list_runs_to_process``.
+    :type runs: dict[str, dict[str, list[str | Path]]]
+
+    :return: Each run once its outputs are saved.
+    :rtype: Iterator[str]
+    """
+    for file, predictions in predict_runs(models_inference, list(runs), cfg.batch_size):
+        if ENSEMBLE_DESC in runs[file]:
+            predictions[ENSEMBLE_DESC] = {
+                "pred_y": np.mean(
+                    [predictions[name]["pred_y"] for name in models], axis=0
+                )
+            }
+        for desc, inputs in runs[file].items():
+            metadata = None
+            if REFERENCE_NAME.format(desc) in predictions:
+                metadata = {
+                    "QuantizationReport": quantization_report(
+                        file,
+                        predictions[REFERENCE_NAME.format(desc)]["pred_y"],
+                        predictions[desc]["pred_y"],
+                    )
+                }
+            confounds_tsv = convert_confounds(
+                layout_out,
+                file,
+                predictions[desc]["pred_y"],
+                {"desc": desc},
+                metadata,
+            )
+            save_fingerprint(cfg, "generalize", inputs, confounds_tsv)
+        yield file
+
+
+def quantization_report(
+    file: str, reference: npt.NDArray[Any], pred_y: npt.NDArray[Any]
+) -> dict[str, Any]:
+    """Compare the gaze positions predicted by an int8 model to the float model.
+
+    :param file: Run the predictions are from.
+    :type file: str
+
+    :param reference: Gaze position predicted by the float model.
+    :type reference: np.ndarray
+
+    :param pred_y: Gaze position predicted by the int8 model.
+    :type pred_y: np.ndarray
+
+    :return: Content added to the sidecar of the run.
+    :rtype: dict[str, Any]
+    """
+    comparison = compare_gaze(reference, pred_y)
+    log.info(
+        f"int8 vs float model for {Path(file).name}: "
+        + ", ".join(
+            f"{key}={'n/a' if value is None else f'{value:.3f}'}"
+            for key, value in comparison.items()
+        )
+    )
+    return {
+        "Description": (
+            "Agreement between the gaze positions predicted "
+            "by the int8 quantized model and the float model."
+        ),
+        **comparison,
+    }
 
 
 def generalize(cfg: Config) -> None:
     """Apply model weights to new data.
 
+    The volumes of all the runs to process are predicted in batches
+    of ``cfg.batch_size`` volumes that can span several runs and subjects.
+
+    Each batch is passed to all the models in ``cfg.model_weights_file``
+    and the predictions of each model are saved with their own ``desc`` entity.
+    If ``cfg.ensemble`` is set, the average of the predictions of all the models
+    is also saved with the ``desc-ensemble`` entity.
+
+    With ``cfg.backend == "onnx"``, the models are converted to ONNX
+    and run with ONNX Runtime. See :mod:`bidsmreye.onnx_backend`.
+    With ``cfg.backend == "onnx_int8"``, the ONNX models are also quantized to int8,
+    calibrated on some of the runs to process (see ``calibration_runs``).
+    If ``cfg.quantization_report`` is set, the float models are applied as well
+    and the agreement of their predictions with those of the int8 models
+    is added to the sidecar of each run.
+
     :param cfg: Configuration object
     :type cfg: Config
     """
@@ -269,14 +758,83 @@ def generalize(cfg: Config) -> None:
 
     subjects = list_subjects(cfg, layout_out)
 
+    keys = None
+    if cfg.shard is not None:
+        layout_in = get_dataset_layout(
+            cfg.input_dir, use_database=True, config=["bids", "derivatives"]
+        )
+        keys = list_shard_keys(cfg, layout_in, list_subjects(cfg, layout_in)) or set()
+        subjects = [x for x in subjects if x in {key[0] for key in keys}]
+
+    files: list[str] = []
+    for subject_label in subjects:
+        log.info(f"Running subject: {subject_label}")
+        files.extend(x.path for x in list_runs(cfg, layout_out, subject_label, keys))
+
+    models = list_models(cfg)
+    outputs = list_outputs(cfg, model_files(cfg, models, files)) if files else {}
+    runs = list_runs_to_process(cfg, layout_out, files, outputs)
+
+    # only load the models needed for the outputs to recompute
+    needed = {str(x) for stale in runs.values() for desc in stale for x in outputs[desc]}
+    models = {name: x for name, x in models.items() if str(x) in needed}
+
+    for model_weights_file in models.values():
+        log.info(f"Using model: {model_weights_file}")
+
+    set_tensorflow_options(bfloat16=cfg.bfloat16)
+
     text = "GENERALIZING"
     with progress_bar(text=text) as progress:
-        subject_loop = progress.add_task(
-            description="processing subject", total=len(subjects)
-        )
-        log.info(f"Using model: {cfg.model_weights_file}")
-        for subject_label in subjects:
-            process_subject(cfg, layout_out, subject_label)
-            progress.update(subject_loop, advance=1)
+        run_loop = progress.add_task(description="processing run", total=len(runs))
+        models_inference = load_models(cfg, models, files) if runs else {}
+        for file in generalize_runs(cfg, layout_out, models_inference, models, runs):
+            progress.update(run_loop, advance=1, description=f"done: {Path(file).name}")
+
+    quality_control_output(cfg, keys)
 
-    quality_control_output(cfg)
+
+def generalize_files(cfg: Config, layout_out: BIDSLayout, files: list[str]) -> None:
+    """Apply model weights to some runs given by their extracted timeseries.
+
+    Unlike ``generalize``, the output dataset is not indexed:
+    only the runs given are generalized and quality controlled,
+    and the reports of their subjects are updated.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param layout_out: Output dataset layout.
+                       Only used to name the outputs, so it can be out of date.
+    :type layout_out: BIDSLayout
+
+    :param files: Extracted timeseries of the runs (``desc-eye_timeseries.npz``).
+    :type files: list[str]
+    """
+    if not files:
+        return
+
+    models = list_models(cfg)
+    outputs = list_outputs(cfg, model_files(cfg, models, files))
+    if runs := list_runs_to_process(cfg, layout_out, files, outputs):
+        models_inference = load_models(cfg, models, files)
+        for file in generalize_runs(cfg, layout_out, models_inference, models, runs):
+            log.info(f"Generalized: {Path(file).name}")
+
+    quality_control_runs(
+        cfg,
+        layout_out,
+        [
+            create_bidsname(
+                layout_out, file, "confounds_tsv", extra_entities={"desc": desc}
+            )
+            for file in files
+            for desc in outputs
+        ],
+    )
+    for subject_label in sorted(
+        {layout_out.parse_file_entities(file)["subject"] for file in files}
+    ):
+        generate_report(
+            output_dir=cfg.output_dir, subject_label=subject_label, action="generalize"
+        )
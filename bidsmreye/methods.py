@@ -9,7 +9,7 @@ from pathlib import Path
 from bidsmreye._version import __version__
 from bidsmreye.defaults import available_models, default_model
 from bidsmreye.report import TEMPLATES_DIR, return_jinja_env
-from bidsmreye.utils import create_dir_for_file
+from bidsmreye.utils import atomic_write, create_dir_for_file
 
 
 def methods(
@@ -38,7 +38,8 @@ def methods(
     create_dir_for_file(output_file)
 
     bib_file = str(Path(__file__).parent / "templates" / "CITATION.bib")
-    shutil.copy(bib_file, output_dir)
+    with atomic_write(output_dir / "CITATION.bib") as tmp_file:
+        shutil.copy(bib_file, tmp_file)
 
     if not model:
         model = default_model()
@@ -64,6 +65,7 @@ def methods(
         qc_only=qc_only,
     )
 
-    output_file.write_text(output)
+    with atomic_write(output_file) as tmp_file:
+        tmp_file.write_text(output)
 
     return output_file
@@ -0,0 +1,319 @@
+"""Run the deepMReye models with ONNX Runtime instead of TensorFlow.
+
+Requires the optional dependencies of the ``onnx`` extra::
+
+    pip install bidsmreye[onnx]
+
+Models are converted once and cached next to their weights.
+Predictions match those of TensorFlow up to ``ONNX_TOLERANCE``.
+
+The converted models can also be quantized to int8:
+see ``quantize_onnx_model``.
+"""
+
+from __future__ import annotations
+
+import gc
+import hashlib
+import warnings
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+from bidsmreye.logger import bidsmreye_log
+from bidsmreye.utils import atomic_write, load_timeseries
+
+log = bidsmreye_log(name="bidsmreye")
+
+# maximum absolute difference (in degrees)
+# between the gaze positions predicted with ONNX Runtime and TensorFlow
+ONNX_TOLERANCE = 1e-4
+
+# with older opsets, the means of the group normalization layers
+# are converted to pooling operations that ONNX Runtime cannot run
+ONNX_OPSET = 18
+
+# volumes sampled across the runs to calibrate the quantization of the activations
+CALIBRATION_VOLUMES = 64
+
+
+def onnx_model_file(model_weights_file: str | Path, input_shape: tuple[int, ...]) -> Path:
+    """Return the ONNX model converted from the weights of a deepMReye model.
+
+    The shape of the volumes is part of the name
+    as the model can only be applied to volumes of that shape.
+
+    :param model_weights_file: Weights of a pretrained deepMReye model.
+    :type model_weights_file: str | Path
+
+    :param input_shape: Shape of the data of one volume, with a channel dimension.
+    :type input_shape: tuple[int, ...]
+
+    :rtype: Path
+    """
+    model_weights_file = Path(model_weights_file)
+    shape = "x".join(str(x) for x in input_shape[:-1])
+    return model_weights_file.with_name(f"{model_weights_file.stem}_{shape}.onnx")
+
+
+def convert_to_onnx(
+    model: Any, input_shape: tuple[int, ...], onnx_file: str | Path
+) -> Path:
+    """Convert a TensorFlow model to ONNX.
+
+    Converting the default models takes a few minutes
+    and more than 6 GB of memory.
+
+    :param model: Model instance used for inference.
+                  See ``bidsmreye.generalize.load_model``.
+    :type model: Keras Model
+
+    :param input_shape: Shape of the data of one volume, with a channel dimension.
+    :type input_shape: tuple[int, ...]
+
+    :param onnx_file: Where to save the ONNX model.
+    :type onnx_file: str | Path
+
+    :rtype: Path
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    onnx_file = Path(onnx_file)
+    log.info(f"Converting model to ONNX: {onnx_file.name}")
+    input_signature = [tf.TensorSpec((None, *input_shape), tf.float32, name="volumes")]
+    # tf2onnx copies the whole graph before each optimization and the discarded copies
+    # are only freed by a full garbage collection, which the millions of objects
+    # of TensorFlow make rare: freezing them lets the copies be collected.
+    gc.freeze()
+    try:
+        with atomic_write(onnx_file) as tmp_file:
+            tf2onnx.convert.from_keras(
+                model,
+                input_signature=input_signature,
+                opset=ONNX_OPSET,
+                output_path=str(tmp_file),
+            )
+    finally:
+        gc.unfreeze()
+    return onnx_file
+
+
+def quantized_model_file(
+    onnx_file: str | Path, models_dir: str | Path, files: list[str]
+) -> Path:
+    """Return the int8 model quantized from an ONNX model on some runs.
+
+    The runs used for calibration are identified by a hash of their names,
+    so the models calibrated on different runs can be kept side by side.
+
+    :param onnx_file: ONNX model. See ``onnx_model_file``.
+    :type onnx_file: str | Path
+
+    :param models_dir: Folder of the quantized models.
+    :type models_dir: str | Path
+
+    :param files: Extracted timeseries of the runs used for calibration.
+    :type files: list[str]
+
+    :rtype: Path
+    """
+    names = "\n".join(sorted(Path(x).name for x in files))
+    calibration = hashlib.sha256(names.encode()).hexdigest()[:8]
+    return Path(models_dir) / f"{Path(onnx_file).stem}_int8-{calibration}.onnx"
+
+
+def calibration_volumes(
+    files: list[str], nb_volumes: int = CALIBRATION_VOLUMES
+) -> npt.NDArray[Any]:
+    """Sample volumes evenly across runs to calibrate the quantization.
+
+    At most ``nb_volumes`` runs are read, one at a time,
+    and only the sampled volumes are loaded in memory.
+
+    :param files: Extracted timeseries of the runs.
+    :type files: list[str]
+
+    :param nb_volumes: Maximum number of volumes to sample.
+    :type nb_volumes: int
+
+    :return: Volumes with shape (volumes, x, y, z, 1).
+    :rtype: np.ndarray
+    """
+    if len(files) > nb_volumes:
+        files = [files[i] for i in np.linspace(0, len(files) - 1, nb_volumes).astype(int)]
+    per_run = -(-nb_volumes // len(files))
+    volumes = []
+    for file in files:
+        run_volumes = load_timeseries(file)
+        if not run_volumes:
+            continue
+        indices = np.unique(
+            np.linspace(0, len(run_volumes) - 1, per_run).round().astype(int)
+        )
+        volumes.append(np.stack([run_volumes[i] for i in indices])[..., np.newaxis])
+    if not volumes:
+        raise ValueError("No volume found to calibrate the quantization.")
+    return np.concatenate(volumes)[:nb_volumes].astype(np.float32)
+
+
+class _CalibrationReader:
+    """Pass the calibration volumes to ONNX Runtime in small batches."""
+
+    def __init__(self, input_name: str, X: npt.NDArray[Any], batch_size: int = 8):
+        self.batches: Iterator[dict[str, npt.NDArray[Any]]] = iter(
+            {input_name: X[i : i + batch_size]} for i in range(0, len(X), batch_size)
+        )
+
+    def get_next(self) -> dict[str, npt.NDArray[Any]] | None:
+        return next(self.batches, None)
+
+
+def quantize_onnx_model(
+    onnx_file: str | Path,
+    quantized_file: str | Path,
+    files: list[str],
+    nb_volumes: int = CALIBRATION_VOLUMES,
+) -> Path:
+    """Quantize the weights and activations of an ONNX model to int8.
+
+    Post-training static quantization:
+    the ranges of the activations are calibrated on volumes
+    sampled from the extracted timeseries of some runs.
+    Weights are quantized per channel.
+
+    :param onnx_file: ONNX model. See ``convert_to_onnx``.
+    :type onnx_file: str | Path
+
+    :param quantized_file: Where to save the quantized model.
+    :type quantized_file: str | Path
+
+    :param files: Extracted timeseries of the runs used for calibration.
+    :type files: list[str]
+
+    :param nb_volumes: Number of volumes used for calibration.
+    :type nb_volumes: int
+
+    :rtype: Path
+    """
+    import onnxruntime as ort
+    from onnxruntime.quantization import (
+        CalibrationMethod,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+
+    quantized_file = Path(quantized_file)
+    log.info(f"Quantizing model to int8: {quantized_file.name}")
+    session = ort.InferenceSession(str(onnx_file), providers=["CPUExecutionProvider"])
+    reader = _CalibrationReader(
+        session.get_inputs()[0].name, calibration_volumes(files, nb_volumes)
+    )
+    del session
+    with atomic_write(quantized_file) as tmp_file:
+        # min / max calibration:
+        # the histogram based methods need several GB of memory
+        # for the activations of the default models
+        quantize_static(
+            str(onnx_file),
+            str(tmp_file),
+            reader,
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            calibrate_method=CalibrationMethod.MinMax,
+        )
+    return quantized_file
+
+
+def compare_gaze(
+    reference: npt.NDArray[Any], pred_y: npt.NDArray[Any]
+) -> dict[str, float | None]:
+    """Compare the gaze positions predicted for a run by two models.
+
+    Positions are compared per volume (median across sub-TRs),
+    as they are saved by ``bidsmreye.generalize.convert_confounds``.
+
+    :param reference: Gaze position predicted by the reference model,
+                      with shape (volumes, sub-TRs, 2).
+    :type reference: np.ndarray
+
+    :param pred_y: Gaze position predicted by the other model,
+                   with the same shape.
+    :type pred_y: np.ndarray
+
+    :return: Pearson correlation and root mean square error (in degrees)
+             of each coordinate.
+             None when they cannot be computed,
+             so they are saved as ``null`` in the JSON sidecars.
+    :rtype: dict[str, float | None]
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        reference = np.nanmedian(reference, axis=1)
+        pred_y = np.nanmedian(pred_y, axis=1)
+
+    comparison: dict[str, float | None] = {}
+    for i, axis in enumerate(["X", "Y"]):
+        mask = np.isfinite(reference[:, i]) & np.isfinite(pred_y[:, i])
+        x, y = reference[mask, i], pred_y[mask, i]
+        correlation = None
+        if len(x) > 1 and x.std() > 0 and y.std() > 0:
+            correlation = float(np.corrcoef(x, y)[0, 1])
+        comparison[f"{axis}Correlation"] = correlation
+        comparison[f"{axis}RMSE"] = (
+            float(np.sqrt(np.mean((x - y) ** 2))) if len(x) else None
+        )
+    return comparison
+
+
+class OnnxModel:
+    """Model converted to ONNX and run with ONNX Runtime on CPU.
+
+    Can be used instead of the TensorFlow model
+    in ``bidsmreye.generalize.predict_runs``.
+    """
+
+    def __init__(
+        self, onnx_file: str | Path, nb_threads: int = 1, inter_op_threads: int = 1
+    ) -> None:
+        """Start an inference session.
+
+        :param onnx_file: ONNX model. See ``convert_to_onnx``.
+        :type onnx_file: str | Path
+
+        :param nb_threads: Threads used by each operation of the model.
+        :type nb_threads: int
+
+        :param inter_op_threads: Operations of the model run at the same time.
+        :type inter_op_threads: int
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = nb_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(
+            str(onnx_file), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_on_batch(self, X: npt.NDArray[Any]) -> list[npt.NDArray[Any]]:
+        """Predict the gaze position and the euclidean error for a batch of volumes.
+
+        :param X: Volumes with shape (volumes, x, y, z, 1).
+        :type X: np.ndarray
+
+        :return: Same outputs as the TensorFlow model.
+        :rtype: list[np.ndarray]
+        """
+        return list(
+            self.session.run(None, {self.input_name: X.astype(np.float32, copy=False)})
+        )
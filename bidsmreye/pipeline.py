@@ -0,0 +1,223 @@
+"""Prepare and generalize runs at the same time."""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+from bids import BIDSLayout  # type: ignore
+
+from bidsmreye.bids_utils import (
+    check_layout,
+    create_bidsname,
+    get_dataset_layout,
+    init_dataset,
+    list_shard_keys,
+    list_subjects,
+)
+from bidsmreye.configuration import Config
+from bidsmreye.generalize import (
+    calibration_runs,
+    generalize_runs,
+    list_models,
+    list_outputs,
+    load_models,
+    model_files,
+    set_tensorflow_options,
+    stale_outputs,
+)
+from bidsmreye.logger import bidsmreye_log
+from bidsmreye.prepare_data import (
+    group_by_session,
+    list_images_in_shard,
+    prepare_units_as_completed,
+)
+from bidsmreye.quality_control import quality_control_output
+from bidsmreye.report import generate_report
+from bidsmreye.utils import progress_bar
+
+log = bidsmreye_log(name="bidsmreye")
+
+# maximum number of units of work per preparation job
+# that are submitted and not generalized yet
+UNITS_PER_JOB = 2
+
+
+def preparation_jobs(cfg: Config) -> int:
+    """Return the number of jobs preparing runs while the main process generalizes.
+
+    Inference in the main process uses one of the ``cfg.n_jobs`` shares
+    of the thread budget, so one job less prepares runs,
+    unless there is a single job.
+    """
+    return max(1, cfg.n_jobs - 1)
+
+
+def list_units(
+    cfg: Config, layout_in: BIDSLayout, images: dict[str, list[str]]
+) -> dict[str, list[list[str]]]:
+    """Split the runs to prepare in independent units of work.
+
+    Each run is a unit of work, except with ``cfg.session_reference``
+    where all the runs of a session are prepared together
+    as they need the transforms of its reference run.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param layout_in: Layout input dataset.
+    :type layout_in: BIDSLayout
+
+    :param images: Functional images to prepare for each subject.
+    :type images: dict[str, list[str]]
+
+    :return: Runs of each unit of work, for each subject.
+    :rtype: dict[str, list[list[str]]]
+    """
+    if not cfg.session_reference:
+        return {
+            subject_label: [[x] for x in img_paths]
+            for subject_label, img_paths in images.items()
+        }
+    return {
+        subject_label: list(group_by_session(layout_in, img_paths).values())
+        for subject_label, img_paths in images.items()
+    }
+
+
+def prepare_and_generalize(cfg: Config) -> None:
+    """Run prepare and generalize as a pipeline.
+
+    Runs are prepared by worker processes (see ``preparation_jobs``)
+    and generalized in the main process as soon as they are prepared,
+    while the workers prepare the next ones.
+    At most ``UNITS_PER_JOB`` units of work per job are in flight,
+    so prepared runs do not pile up when inference is slower than preparation.
+
+    The units with the runs ``generalize`` would calibrate the int8 models on
+    (see ``calibration_runs``) are prepared first,
+    and nothing is generalized until they are ready,
+    so this gives the same outputs as running ``prepare_data`` then ``generalize``
+    with every backend.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+    """
+    layout_in = get_dataset_layout(
+        cfg.input_dir,
+        use_database=True,
+        config=["bids", "derivatives"],
+        reset_database=cfg.reset_database,
+    )
+    check_layout(cfg, layout_in)
+
+    layout_out = init_dataset(cfg)
+
+    subjects = list_subjects(cfg, layout_in)
+    keys = list_shard_keys(cfg, layout_in, subjects)
+    images = {
+        subject_label: [x.path for x in subject_images]
+        for subject_label, subject_images in list_images_in_shard(
+            cfg, layout_in, subjects
+        ).items()
+    }
+    units = list_units(cfg, layout_in, images)
+    subject_of_unit = {
+        tuple(unit): subject_label
+        for subject_label, subject_units in units.items()
+        for unit in subject_units
+    }
+
+    models = list_models(cfg)
+    for model_weights_file in models.values():
+        log.info(f"Using model: {model_weights_file}")
+    set_tensorflow_options(bfloat16=cfg.bfloat16)
+
+    all_units = [unit for subject_units in units.values() for unit in subject_units]
+    # extracted timeseries of each run, as named by prepare_data
+    timeseries = {
+        img: str(create_bidsname(layout_out, Path(img), "no_label_bold"))
+        for unit in all_units
+        for img in unit
+    }
+    all_files = list(timeseries.values())
+    calibration = set(calibration_runs(all_files))
+    calibration_units = {
+        tuple(unit)
+        for unit in all_units
+        if any(timeseries[img] in calibration for img in unit)
+    }
+    all_units.sort(key=lambda unit: tuple(unit) not in calibration_units)
+    # units prepared so far
+    prepared: set[tuple[str, ...]] = set()
+    # prepared units not generalized yet
+    waiting: list[tuple[list[str], list[str]]] = []
+
+    nb_runs = sum(len(x) for x in images.values())
+    n_jobs = preparation_jobs(cfg)
+    log.info(
+        f"Preparing {nb_runs} runs with {n_jobs} parallel jobs "
+        "and generalizing them as they are ready"
+    )
+
+    with progress_bar(text="PREPARING AND GENERALIZING") as progress:
+        subject_loop = progress.add_task(
+            description="processing subject", total=len(images)
+        )
+        run_loop = progress.add_task(description="processing run", total=nb_runs)
+
+        remaining = {subject_label: len(x) for subject_label, x in units.items()}
+
+        def _subject_done(subject_label: str) -> None:
+            generate_report(
+                output_dir=cfg.output_dir, subject_label=subject_label, action="prepare"
+            )
+            progress.update(subject_loop, advance=1)
+
+        for subject_label in [x for x, y in remaining.items() if y == 0]:
+            _subject_done(subject_label)
+
+        # computed once the calibration runs are prepared:
+        # the models depend on the shape of their volumes
+        outputs = None
+        models_inference = None
+        for unit, files in prepare_units_as_completed(
+            cfg,
+            layout_in,
+            all_units,
+            n_jobs=n_jobs,
+            max_pending=n_jobs * UNITS_PER_JOB,
+        ):
+            waiting.append((unit, files))
+            prepared.add(tuple(unit))
+            if not calibration_units <= prepared:
+                continue
+
+            if outputs is None:
+                outputs = list_outputs(cfg, model_files(cfg, models, all_files))
+
+            for ready_unit, ready_files in waiting:
+                runs = {
+                    file: stale
+                    for file in ready_files
+                    if (stale := stale_outputs(cfg, layout_out, file, outputs))
+                }
+                if runs:
+                    if models_inference is None:
+                        models_inference = load_models(cfg, models, all_files)
+                    for file in generalize_runs(
+                        cfg, layout_out, models_inference, models, runs
+                    ):
+                        log.debug(f"Generalized: {Path(file).name}")
+
+                progress.update(
+                    run_loop,
+                    advance=len(ready_unit),
+                    description=f"done: {Path(ready_unit[-1]).name}",
+                )
+                subject_label = subject_of_unit[tuple(ready_unit)]
+                remaining[subject_label] -= 1
+                if remaining[subject_label] == 0:
+                    _subject_done(subject_label)
+            waiting.clear()
+
+    quality_control_output(cfg, keys)
@@ -2,11 +2,27 @@
 
 from __future__ import annotations
 
-import pickle
+import inspect
+import json
+import multiprocessing
+import shutil
+from collections.abc import Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
+import ants
+import nibabel as nib
 import numpy as np
+import numpy.typing as npt
+import pandas as pd
 from bids import BIDSLayout  # type: ignore
 from bids.layout import BIDSFile
 from deepmreye import preprocess
@@ -16,51 +32,448 @@ from bidsmreye.bids_utils import (
     create_bidsname,
     get_dataset_layout,
     init_dataset,
+    list_images,
     list_subjects,
-    save_sampling_frequency_to_json,
+    save_sampling_frequency,
+    select_shard,
 )
 from bidsmreye.configuration import Config
+from bidsmreye.fingerprint import is_up_to_date, save_fingerprint
 from bidsmreye.logger import bidsmreye_log
 from bidsmreye.report import generate_report
 from bidsmreye.utils import (
-    check_if_file_found,
-    get_deepmreye_filename,
-    move_file,
+    atomic_write,
+    convert_eye_mask,
+    load_eye_mask,
     progress_bar,
-    set_this_filter,
+    return_deepmreye_output_filename,
+    save_eye_mask,
 )
 
 log = bidsmreye_log(name="bidsmreye")
 
+# number of volumes averaged to get the image registered to the template
+# when only reading the part of the images around the eyes
+EYE_SLAB_REFERENCE_VOLUMES = 10
+# extra field of view (in mm) read around the eyes
+EYE_SLAB_MARGIN = 10.0
+
+
+@lru_cache(maxsize=1)
+def load_deepmreye_masks() -> tuple[Any, ...]:
+    """Load the deepMReye template, eye masks and the edges of the eye mask.
+
+    The result is cached so they are only read from disk once per process.
+    Worker processes forked after a first call share the parent's copy.
+
+    :return: Output of ``deepmreye.preprocess.get_masks``.
+    :rtype: tuple
+    """
+    log.debug("Loading deepMReye template and masks")
+    return preprocess.get_masks()
+
+
+def transform_types(linear_coreg: bool = False) -> list[str] | None:
+    """Return the type of transform used at each step of the registration.
+
+    ``None`` lets deepMReye use its default (similarity) transforms.
+    """
+    return None if linear_coreg else ["Affine", "Affine", "SyNAggro"]
+
+
+def nifti_to_ants(data: npt.NDArray[Any], affine: npt.NDArray[Any], zooms: Any) -> Any:
+    """Create an ANTs image from the data and the affine of a NIfTI image."""
+    spacing = list(nib.affines.voxel_sizes(affine))
+    # ANTs works in LPS
+    flip = np.diag([-1, -1, 1])
+    direction = flip @ affine[:3, :3] / spacing
+    origin = list(flip @ affine[:3, 3])
+
+    if data.ndim == 4:
+        origin.append(0.0)
+        spacing.append(float(zooms[3]))
+        direction = np.pad(direction, (0, 1))
+        direction[3, 3] = 1
+
+    return ants.from_numpy(
+        np.asarray(data, dtype=np.float32),
+        origin=origin,
+        spacing=spacing,
+        direction=direction,
+    )
+
+
+def read_reference(img: str, nb_volumes: int = EYE_SLAB_REFERENCE_VOLUMES) -> Any:
+    """Average a few volumes evenly spread over a run.
+
+    Only those volumes are read from disk.
+
+    :param img: Path to a 4D image.
+    :type img: str
+
+    :param nb_volumes: Maximum number of volumes to average.
+    :type nb_volumes: int
+
+    :return: 3D image to register to the template.
+    :rtype: ants.ANTsImage
+    """
+    nii: Any = nib.load(img, keep_file_open=True)
+    if len(nii.shape) == 3:
+        return nifti_to_ants(nii.get_fdata(), nii.affine, nii.header.get_zooms())
+
+    volumes = np.unique(np.linspace(0, nii.shape[3] - 1, nb_volumes).round().astype(int))
+    data = np.zeros(nii.shape[:3])
+    for i in volumes:
+        data += nii.dataobj[..., i]
+    return nifti_to_ants(data / len(volumes), nii.affine, nii.header.get_zooms())
+
+
+def eye_slab_bounds(
+    affine: npt.NDArray[Any],
+    shape: tuple[int, ...],
+    transforms: list[str],
+    margin: float = EYE_SLAB_MARGIN,
+) -> tuple[slice, slice, slice]:
+    """Return the voxels of an image that end up in the big eye mask of deepMReye.
+
+    :param affine: Voxel to world (RAS) affine of the image.
+    :type affine: np.ndarray
+
+    :param shape: Shape of the image.
+    :type shape: tuple[int, ...]
+
+    :param transforms: Transforms from the image to the deepMReye template.
+                       In the order expected by ``ants.apply_transforms``.
+    :type transforms: list[str]
+
+    :param margin: Extra field of view (in mm) to include around the eyes.
+    :type margin: float
 
-def coregister_and_extract_data(img: str, linear_coreg: bool = False) -> None:
+    :return: Slices along the 3 spatial dimensions of the image.
+    :rtype: tuple[slice, slice, slice]
+    """
+    eyemask_big = load_deepmreye_masks()[1]
+
+    in_mask = np.argwhere(eyemask_big.numpy() > 0)
+    lps = (
+        np.asarray(eyemask_big.origin)
+        + in_mask * np.asarray(eyemask_big.spacing) @ np.asarray(eyemask_big.direction).T
+    )
+
+    # transforms used to resample an image map template points to image points
+    points = ants.apply_transforms_to_points(
+        3, pd.DataFrame(lps, columns=["x", "y", "z"]), transforms
+    )
+    ras = points[["x", "y", "z"]].to_numpy() * [-1, -1, 1]
+
+    voxels = nib.affines.apply_affine(np.linalg.inv(affine), ras)
+    padding = margin / nib.affines.voxel_sizes(affine)
+
+    start = np.floor(voxels.min(axis=0) - padding).astype(int)
+    stop = np.ceil(voxels.max(axis=0) + padding).astype(int) + 1
+    start = np.clip(start, 0, shape[:3])
+    stop = np.clip(stop, 0, shape[:3])
+
+    return tuple(slice(int(x), int(y)) for x, y in zip(start, stop))  # type: ignore
+
+
+def read_eye_slab(
+    img: str, transforms: list[str], margin: float = EYE_SLAB_MARGIN
+) -> Any:
+    """Read only the part of an image that ends up around the eyes of the template.
+
+    Only the slab is read from disk thanks to the array proxy of nibabel
+    (memory mapped for uncompressed NIfTI files).
+
+    :param img: Path to a 3D or 4D image.
+    :type img: str
+
+    :param transforms: Transforms from the image to the deepMReye template.
+                       In the order expected by ``ants.apply_transforms``.
+    :type transforms: list[str]
+
+    :param margin: Extra field of view (in mm) to include around the eyes.
+    :type margin: float
+
+    :return: Slab of the image.
+    :rtype: ants.ANTsImage
+    """
+    nii: Any = nib.load(img)
+    slab = eye_slab_bounds(nii.affine, nii.shape, transforms, margin)
+    if any(x.stop <= x.start for x in slab):
+        raise RuntimeError(
+            f"Eye mask of deepMReye is outside of the field of view of:\n{img}"
+        )
+
+    data = nii.dataobj[slab]
+    log.debug(f"Read eye slab of shape {data.shape} from image of shape {nii.shape}")
+
+    affine = nib.affines.from_matvec(
+        nii.affine[:3, :3],
+        nib.affines.apply_affine(nii.affine, [x.start for x in slab]),
+    )
+    return nifti_to_ants(data, affine, nii.header.get_zooms())
+
+
+def coregister_and_extract_data(
+    img: str,
+    linear_coreg: bool = False,
+    transforms: list[str] | None = None,
+    eye_slab: bool = False,
+    report_file: Path | None = None,
+    mask_file: Path | None = None,
+) -> None:
     """Coregister image to eye template and extract data from eye mask for one image.
 
+    By default, like deepMReye, the report and the extracted data
+    are saved next to the image.
+
     :param img: Image to coregister and extract data from
     :type img: str
+
+    :param linear_coreg: Use linear registration. Defaults to False.
+    :type linear_coreg: bool, optional
+
+    :param transforms: Transforms to the deepMReye template to apply
+                       instead of registering the image.
+                       In the order expected by ``ants.apply_transforms``.
+                       Defaults to None.
+    :type transforms: list[str], optional
+
+    :param eye_slab: Only read the part of the image around the eyes.
+                     The transforms are then estimated on the average
+                     of a few volumes rather than of the whole run.
+                     Defaults to False.
+    :type eye_slab: bool, optional
+
+    :param report_file: Where to save the report. Defaults to None.
+    :type report_file: Path, optional
+
+    :param mask_file: Where to save the data extracted from the eye mask.
+                      Defaults to None.
+    :type mask_file: Path, optional
     """
-    (
-        eyemask_small,
-        eyemask_big,
-        dme_template,
-        _,
-        x_edges,
-        y_edges,
-        z_edges,
-    ) = preprocess.get_masks()
-
-    transforms = None if linear_coreg else ["Affine", "Affine", "SyNAggro"]
-
-    preprocess.run_participant(
-        img,
-        dme_template,
-        eyemask_big,
-        eyemask_small,
-        x_edges,
-        y_edges,
-        z_edges,
-        transforms=transforms,
-    )
+    eyemask_small, eyemask_big, dme_template, *_ = load_deepmreye_masks()
+
+    if transforms is None and not eye_slab:
+        func, _ = preprocess.register_to_eye_masks(
+            dme_template,
+            ants.image_read(img),
+            masks=[None, eyemask_big, eyemask_small],
+            transforms=transform_types(linear_coreg),
+        )
+
+    else:
+        if transforms is None:
+            steps = register_to_template(read_reference(img), linear_coreg=linear_coreg)
+            transforms = chain_transforms(steps)
+
+        func = read_eye_slab(img, transforms) if eye_slab else ants.image_read(img)
+        func = ants.apply_transforms(
+            fixed=dme_template,
+            moving=func,
+            transformlist=transforms,
+            imagetype=3,
+        )
+
+    if report_file is None:
+        report_file = Path(img).parent / return_deepmreye_output_filename(
+            Path(img).name, "report"
+        )
+    if mask_file is None:
+        mask_file = Path(img).parent / return_deepmreye_output_filename(
+            Path(img).name, "mask"
+        )
+
+    extract_eye_data(func, report_file, mask_file)
+
+
+def extract_eye_data(func: Any, report_file: Path, mask_file: Path) -> npt.NDArray[Any]:
+    """Extract the data within the eye mask of an image registered to the template.
+
+    Same as ``deepmreye.preprocess.cut_mask``
+    but saves the data with ``save_eye_mask`` instead of pickling them.
+
+    :param func: 4D image registered to the deepMReye template.
+    :type func: ants.ANTsImage
+
+    :param report_file: Where to save the report.
+    :type report_file: Path
+
+    :param mask_file: Where to save the data extracted from the eye mask.
+    :type mask_file: Path
+
+    :return: Data within the eye mask.
+    :rtype: np.ndarray
+    """
+    eyemask_small, *_, x_edges, y_edges, z_edges = load_deepmreye_masks()
+    mask = eyemask_small.numpy()
+
+    data = func.numpy()
+    data[mask < 1, ...] = 0
+    y_slice = slice(y_edges[1], y_edges[0])
+    z_slice = slice(z_edges[1], z_edges[0])
+    left = data[x_edges[1] : x_edges[0], y_slice, z_slice]
+    right = data[x_edges[3] : x_edges[2], y_slice, z_slice]
+    masked_eye = np.concatenate((right, left))
+
+    with atomic_write(report_file) as tmp_file:
+        # deepmreye < 0.3 adds the extension to the name of the report
+        if "fn_subject" in inspect.signature(preprocess.plot_subject_report).parameters:
+            preprocess.plot_subject_report(
+                str(tmp_file.with_suffix("")), func, masked_eye, mask
+            )
+        else:
+            preprocess.plot_subject_report(tmp_file, func, masked_eye, mask)
+
+    save_eye_mask(masked_eye, mask_file)
+
+    return masked_eye
+
+
+def register_to_template(reference: Any, linear_coreg: bool = False) -> list[list[str]]:
+    """Register a 3D image to the deepMReye template.
+
+    Uses the same successive steps and parameters as
+    ``deepmreye.preprocess.register_to_eye_masks``
+    but keeps the transforms of each step.
+
+    :param reference: 3D image (for example the mean of a run) to register.
+    :type reference: ants.ANTsImage
+
+    :param linear_coreg: Use linear registration. Defaults to False.
+    :type linear_coreg: bool, optional
+
+    :return: Forward transforms of each registration step.
+    :rtype: list[list[str]]
+    """
+    eyemask_small, eyemask_big, dme_template, *_ = load_deepmreye_masks()
+
+    types = transform_types(linear_coreg)
+
+    steps = []
+    for idx, mask in enumerate([None, eyemask_big, eyemask_small]):
+        registration = ants.registration(
+            fixed=dme_template,
+            moving=reference,
+            aff_random_sampling_rate=1,
+            type_of_transform="Similarity" if types is None else types[idx],
+            mask=mask,
+            aff_metric="GC",
+            aff_sampling=512,
+            aff_iterations=(200, 200, 200, 10),
+            aff_smoothing_sigmas=(0, 0, 0, 0),
+        )
+        reference = ants.apply_transforms(
+            fixed=dme_template,
+            moving=reference,
+            transformlist=registration["fwdtransforms"],
+        )
+        steps.append(registration["fwdtransforms"])
+
+    return steps
+
+
+def chain_transforms(steps: list[list[str]]) -> list[str]:
+    """Order the transforms of successive registration steps.
+
+    Returns them in the order expected by ``ants.apply_transforms``:
+    transforms of later steps are applied last so they come first.
+    """
+    return [x for step in reversed(steps) for x in step]
+
+
+def session_transform_sidecar(layout_out: BIDSLayout, img: str) -> Path:
+    """Return the sidecar listing the transforms to the template for a run's session."""
+    space = layout_out.parse_file_entities(img).get("space", "boldref")
+    return create_bidsname(layout_out, img, "transform_json", {"space": space})
+
+
+def register_session_reference(
+    cfg: Config, layout_out: BIDSLayout, reference_img: str
+) -> Path:
+    """Register the mean of a run to the template and save the transforms.
+
+    The transforms are meant to be reused for all the runs of the same
+    subject, session and space as ``reference_img``.
+
+    :param cfg: Configuration object.
+    :type cfg: Config
+
+    :param layout_out: Layout output dataset.
+    :type layout_out: BIDSLayout
+
+    :param reference_img: Run whose mean is registered to the template.
+    :type reference_img: str
+
+    :return: Sidecar listing the transforms in the order
+             expected by ``ants.apply_transforms``.
+    :rtype: Path
+    """
+    sidecar = session_transform_sidecar(layout_out, reference_img)
+
+    if is_up_to_date(cfg, "session_reference", [reference_img], [sidecar]):
+        log.debug(f"Reusing transforms to template for session: '{sidecar.name}'")
+        return sidecar
+
+    log.info(f"Registering session reference: {Path(reference_img).name}")
+
+    if cfg.eye_slab:
+        reference = read_reference(reference_img)
+    else:
+        reference = ants.get_average_of_timeseries(ants.image_read(reference_img))
+    steps = register_to_template(reference, linear_coreg=cfg.linear_coreg)
+
+    space = layout_out.parse_file_entities(reference_img).get("space", "boldref")
+    saved_steps = []
+    for i, step in enumerate(steps):
+        saved = []
+        for file in step:
+            extension = ".nii.gz" if file.endswith(".nii.gz") else ".mat"
+            output_file = create_bidsname(
+                layout_out,
+                reference_img,
+                "transform",
+                {"space": space, "desc": f"step{i + 1}", "extension": extension},
+            )
+            with atomic_write(output_file) as tmp_file:
+                shutil.copyfile(file, tmp_file)
+            saved.append(str(output_file.relative_to(layout_out.root)))
+        saved_steps.append(saved)
+
+    content = {
+        "Sources": [str(Path(reference_img).name)],
+        "Transforms": chain_transforms(saved_steps),
+        "LinearCoregistration": cfg.linear_coreg,
+    }
+    with atomic_write(sidecar) as tmp_file, open(tmp_file, "w") as f:
+        json.dump(content, f, indent=4)
+    save_fingerprint(cfg, "session_reference", [reference_img], sidecar)
+
+    return sidecar
+
+
+def load_session_transforms(layout_out: BIDSLayout, img: str) -> list[str]:
+    """Return the transforms to the template of the session a run belongs to."""
+    sidecar = session_transform_sidecar(layout_out, img)
+    with open(sidecar) as f:
+        content = json.load(f)
+    return [str(Path(layout_out.root) / x) for x in content["Transforms"]]
+
+
+def group_by_session(
+    layout: BIDSLayout, images: list[str]
+) -> dict[tuple[Any, ...], list[str]]:
+    """Group runs that share the same subject, session and space.
+
+    Runs within a group are sorted, so the first one can be used as reference.
+    """
+    groups: dict[tuple[Any, ...], list[str]] = {}
+    for img in sorted(images):
+        entities = layout.parse_file_entities(img)
+        key = tuple(entities.get(x) for x in ["subject", "session", "space"])
+        groups.setdefault(key, []).append(img)
+    return groups
 
 
 def combine_data_with_empty_labels(layout_out: BIDSLayout, img: Path, i: int = 1) -> Path:
@@ -81,8 +494,9 @@ def combine_data_with_empty_labels(layout_out: BIDSLayout, img: Path, i: int = 1
     log.debug(f"Combining data with empty labels: {img}")
 
     # Load data and normalize it
-    data = pickle.load(open(img, "rb"))
-    data = preprocess.normalize_img(data)
+    # (in memory: the mean and std of each voxel are computed over the whole run
+    # and the array is modified in place)
+    data = preprocess.normalize_img(load_eye_mask(img, mmap_mode=None))
 
     # If experiment has no labels use dummy labels
     # 10 is the number of subTRs used in the pretrained weights, 2 is XY
@@ -97,22 +511,26 @@ def combine_data_with_empty_labels(layout_out: BIDSLayout, img: Path, i: int = 1
     subj["ids"].append(([entities["subject"]] * labels.shape[0], [i] * labels.shape[0]))
 
     output_file = create_bidsname(layout_out, Path(img), "no_label_bold")
-    file_to_move = Path(layout_out.root) / ".." / "bidsmreye" / output_file.name
-
-    preprocess.save_data(
-        output_file.name,
-        subj["data"],
-        subj["labels"],
-        subj["ids"],
-        layout_out.root,
-        center_labels=False,
-    )
 
-    return file_to_move
+    with atomic_write(output_file) as tmp_file:
+        preprocess.save_data(
+            tmp_file.name,
+            subj["data"],
+            subj["labels"],
+            subj["ids"],
+            tmp_file.parent,
+            center_labels=False,
+        )
+
+    return output_file
 
 
 def process_subject(
-    cfg: Config, layout_in: BIDSLayout, layout_out: BIDSLayout, subject_label: str
+    cfg: Config,
+    layout_in: BIDSLayout,
+    layout_out: BIDSLayout,
+    subject_label: str,
+    images: list[BIDSFile] | None = None,
 ) -> None:
     """Run coregistration and extract data for one subject.
 
@@ -127,63 +545,115 @@ def process_subject(
 
     :param subject_label: Can be a regular expression.
     :type subject_label: str
+
+    :param images: Functional images to prepare.
+                   Defaults to all the images of the subject.
+    :type images: list[BIDSFile] | None
     """
     log.info(f"Running subject: {subject_label}")
 
-    this_filter = set_this_filter(cfg, subject_label, "bold")
+    if images is None:
+        images = list_images(cfg, layout_in, subject_label)
 
-    bf = layout_in.get(
-        regex_search=True,
-        **this_filter,
-    )
-
-    check_if_file_found(bf, this_filter, layout_in)
+    if not cfg.session_reference:
+        for img in images:
+            prepapre_image(cfg, layout_in, layout_out, img)
+        return
 
-    for img in bf:
-        prepapre_image(cfg, layout_in, layout_out, img)
+    for group in group_by_session(layout_in, [x.path for x in images]).values():
+        register_session_reference(cfg, layout_out, group[0])
+        for img_path in group:
+            prepapre_image(cfg, layout_in, layout_out, layout_in.get_file(img_path))
 
 
 def prepapre_image(
     cfg: Config, layout_in: BIDSLayout, layout_out: BIDSLayout, img: BIDSFile
-) -> None:
-    """Preprocess a single functional image."""
-    img_path = img.path
+) -> Path:
+    """Preprocess a single functional image.
+
+    With ``cfg.session_reference``, the transforms of the session
+    must have been computed beforehand with ``register_session_reference``.
+
+    Runs whose outputs are up to date are skipped
+    (see ``bidsmreye.fingerprint.is_up_to_date``).
+
+    :return: Extracted timeseries of the run.
+    :rtype: Path
+    """
+    return prepare_run(cfg, layout_out, *describe_run(layout_in, img.path))
+
+
+def describe_run(layout_in: BIDSLayout, img_path: str) -> tuple[str, dict[str, Any], str]:
+    """Return what ``prepare_run`` needs to know about a run from the input dataset.
+
+    :param layout_in: Layout input dataset.
+    :type layout_in: BIDSLayout
 
+    :param img_path: Functional image of the run.
+    :type img_path: str
+
+    :return: Path, metadata and path relative to the input dataset of the image.
+    :rtype: tuple[str, dict[str, Any], str]
+    """
+    img = layout_in.get_file(img_path)
+    return img.path, img.get_metadata(), str(Path(img.path).relative_to(layout_in.root))
+
+
+def prepare_run(
+    cfg: Config,
+    layout_out: BIDSLayout,
+    img_path: str,
+    metadata: dict[str, Any],
+    source: str,
+) -> Path:
+    """Preprocess a single functional image described by ``describe_run``.
+
+    Does not need the layout of the input dataset,
+    so worker processes do not have to open its database.
+    See ``prepapre_image``.
+
+    :return: Extracted timeseries of the run.
+    :rtype: Path
+    """
     report_name = create_bidsname(layout_out, filename=img_path, filetype="report")
     mask_name = create_bidsname(layout_out, filename=img_path, filetype="mask")
     output_file = create_bidsname(layout_out, Path(img_path), "no_label_bold")
 
-    if (
-        not cfg.force
-        and report_name.exists()
-        and mask_name.exists()
-        and output_file.exists()
-    ):
-        log.debug(
-            "Output for the following file already exists. "
-            "Use the '--force' option to overwrite. "
-            f"\n '{Path(img_path).name}'"
-        )
-        return
+    if not mask_name.exists() and mask_name.with_suffix(".p").exists():
+        convert_eye_mask(mask_name.with_suffix(".p"))
 
-    log.info(f"Processing file: {Path(img_path).name}")
+    inputs: list[str | Path] = [img_path]
+    sidecar = Path(img_path).with_suffix("").with_suffix(".json")
+    if sidecar.exists():
+        inputs.append(sidecar)
 
-    coregister_and_extract_data(img_path, linear_coreg=cfg.linear_coreg)
+    transforms = None
+    if cfg.session_reference:
+        transforms = load_session_transforms(layout_out, img_path)
+        inputs.extend([session_transform_sidecar(layout_out, img_path), *transforms])
 
-    deepmreye_mask_report = get_deepmreye_filename(
-        layout_in, img=img_path, filetype="report"
-    )
-    move_file(deepmreye_mask_report, report_name)
+    outputs: list[str | Path] = [output_file, mask_name, report_name]
+    if is_up_to_date(cfg, "prepare", inputs, outputs):
+        return output_file
+
+    log.info(f"Processing file: {Path(img_path).name}")
 
-    deepmreye_mask_name = get_deepmreye_filename(layout_in, img=img_path, filetype="mask")
-    move_file(deepmreye_mask_name, mask_name)
+    coregister_and_extract_data(
+        img_path,
+        linear_coreg=cfg.linear_coreg,
+        transforms=transforms,
+        eye_slab=cfg.eye_slab,
+        report_file=report_name,
+        mask_file=mask_name,
+    )
 
-    source = str(Path(img_path).relative_to(layout_in.root))
-    save_sampling_frequency_to_json(layout_out, img=img, source=source)
+    save_sampling_frequency(layout_out, img_path, metadata, source)
 
     combine_data_with_empty_labels(layout_out, mask_name)
-    file_to_move = Path(layout_out.root) / ".." / "bidsmreye" / output_file.name
-    move_file(file_to_move, output_file)
+
+    save_fingerprint(cfg, "prepare", inputs, output_file)
+
+    return output_file
 
 
 def prepare_data(cfg: Config) -> None:
@@ -207,14 +677,257 @@ def prepare_data(cfg: Config) -> None:
     text = "PREPARING DATA"
     if cfg.linear_coreg:
         log.info("Using linear coregistration")
+    if cfg.session_reference:
+        log.info("Reusing the registration of one reference run per session")
+    if cfg.eye_slab:
+        log.info("Only reading the part of the images around the eyes")
+
+    images = list_images_in_shard(cfg, layout_in, subjects)
+
+    if cfg.n_jobs > 1:
+        prepare_data_in_parallel(cfg, layout_in, images)
+        return
 
     with progress_bar(text=text) as progress:
         subject_loop = progress.add_task(
-            description="processing subject", total=len(subjects)
+            description="processing subject", total=len(images)
+        )
+        for subject_label, subject_images in images.items():
+            process_subject(cfg, layout_in, layout_out, subject_label, subject_images)
+            generate_report(
+                output_dir=cfg.output_dir, subject_label=subject_label, action="prepare"
+            )
+            progress.update(subject_loop, advance=1)
+
+
+def list_images_in_shard(
+    cfg: Config, layout_in: BIDSLayout, subjects: list[str]
+) -> dict[str, list[BIDSFile]]:
+    """List the functional images to prepare for each subject.
+
+    With ``cfg.shard``, only the images of the shard are kept
+    and subjects without any image in the shard are dropped.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param layout_in: Layout input dataset.
+    :type layout_in: BIDSLayout
+
+    :param subjects: Labels of the subjects to prepare.
+    :type subjects: list[str]
+
+    :rtype: dict[str, list[BIDSFile]]
+    """
+    images = {x: list_images(cfg, layout_in, x) for x in subjects}
+    if cfg.shard is None:
+        return images
+
+    all_images = [x for subject_images in images.values() for x in subject_images]
+    selected = {x.path for x in select_shard(cfg, layout_in, all_images)}
+    images = {
+        subject_label: [x for x in subject_images if x.path in selected]
+        for subject_label, subject_images in images.items()
+    }
+    return {x: y for x, y in images.items() if y}
+
+
+def prepare_data_in_parallel(
+    cfg: Config, layout_in: BIDSLayout, images: dict[str, list[BIDSFile]]
+) -> None:
+    """Prepare all the runs of several subjects on a pool of worker processes.
+
+    Each run is an independent unit of work.
+    The report of a subject is generated once all its runs are done.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param layout_in: Layout input dataset.
+    :type layout_in: BIDSLayout
+
+    :param images: Functional images to prepare for each subject.
+    :type images: dict[str, list[BIDSFile]]
+    """
+    paths = {
+        subject_label: [x.path for x in subject_images]
+        for subject_label, subject_images in images.items()
+    }
+    nb_runs = sum(len(x) for x in paths.values())
+
+    log.info(
+        f"Preparing {nb_runs} runs with {cfg.n_jobs} parallel jobs "
+        f"of {cfg.omp_nthreads} threads"
+    )
+
+    # load masks before starting the pool so forked workers inherit them
+    load_deepmreye_masks()
+
+    # read from the database of the input dataset here, so the workers do not open it
+    runs = {
+        img_path: describe_run(layout_in, img_path)
+        for subject_paths in paths.values()
+        for img_path in subject_paths
+    }
+
+    with progress_bar(text="PREPARING DATA") as progress:
+        subject_loop = progress.add_task(
+            description="processing subject", total=len(paths)
         )
-        for subject_label in subjects:
-            process_subject(cfg, layout_in, layout_out, subject_label)
+        run_loop = progress.add_task(description="processing run", total=nb_runs)
+
+        remaining = {subject_label: len(x) for subject_label, x in paths.items()}
+
+        def _subject_done(subject_label: str) -> None:
             generate_report(
                 output_dir=cfg.output_dir, subject_label=subject_label, action="prepare"
             )
             progress.update(subject_loop, advance=1)
+
+        for subject_label in [x for x, y in remaining.items() if y == 0]:
+            _subject_done(subject_label)
+
+        with ProcessPoolExecutor(
+            max_workers=cfg.n_jobs, initializer=_init_worker, initargs=(cfg,)
+        ) as executor:
+            if cfg.session_reference:
+                # all runs of a session need the transforms of its reference
+                references = [
+                    group[0]
+                    for subject_paths in paths.values()
+                    for group in group_by_session(layout_in, subject_paths).values()
+                ]
+                reference_loop = progress.add_task(
+                    description="registering session", total=len(references)
+                )
+                futures_ref = [
+                    executor.submit(_register_session_in_worker, x) for x in references
+                ]
+                try:
+                    for future in as_completed(futures_ref):
+                        future.result()
+                        progress.update(reference_loop, advance=1)
+                except BaseException:
+                    for future in futures_ref:
+                        future.cancel()
+                    raise
+
+            futures = {
+                executor.submit(_prepare_run_in_worker, runs[img_path]): subject_label
+                for subject_label, subject_paths in paths.items()
+                for img_path in subject_paths
+            }
+            try:
+                for future in as_completed(futures):
+                    img_path = future.result()
+                    progress.update(
+                        run_loop, advance=1, description=f"done: {Path(img_path).name}"
+                    )
+                    subject_label = futures[future]
+                    remaining[subject_label] -= 1
+                    if remaining[subject_label] == 0:
+                        _subject_done(subject_label)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+
+def prepare_units_as_completed(
+    cfg: Config,
+    layout_in: BIDSLayout,
+    units: list[list[str]],
+    n_jobs: int,
+    max_pending: int,
+) -> Iterator[tuple[list[str], list[str]]]:
+    """Prepare units of work on a pool of worker processes as they are consumed.
+
+    A unit of work is a list of runs prepared by the same worker,
+    like all the runs of a session with ``cfg.session_reference``.
+
+    New units are only submitted when the caller asks for the next one,
+    so at most ``max_pending`` units are prepared and not consumed yet.
+
+    Workers are started with ``spawn``
+    so the caller can use TensorFlow while they run.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :param layout_in: Layout input dataset.
+    :type layout_in: BIDSLayout
+
+    :param units: Functional images of each unit of work.
+    :type units: list[list[str]]
+
+    :param n_jobs: Number of worker processes.
+    :type n_jobs: int
+
+    :param max_pending: Maximum number of units submitted and not consumed.
+    :type max_pending: int
+
+    :return: Functional images and extracted timeseries of each unit,
+             in the order they complete.
+    :rtype: Iterator[tuple[list[str], list[str]]]
+    """
+    # load masks before starting the pool so the workers do not wait for it
+    load_deepmreye_masks()
+
+    todo = iter(units)
+    pending: dict[Future[list[str]], list[str]] = {}
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(cfg,),
+    ) as executor:
+        try:
+            while True:
+                while len(pending) < max_pending and (unit := next(todo, None)):
+                    runs = [describe_run(layout_in, x) for x in unit]
+                    pending[executor.submit(_prepare_runs_in_worker, runs)] = unit
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                yield pending.pop(future), future.result()
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+
+# state of each worker process of the pools used by prepare_data_in_parallel
+# and prepare_units_as_completed
+_WORKER: dict[str, Any] = {}
+
+
+def _init_worker(cfg: Config) -> None:
+    """Index the output dataset once per worker process.
+
+    The runs to prepare are described by the main process (see ``describe_run``),
+    so the workers do not open the database of the input dataset.
+    """
+    _WORKER["cfg"] = cfg
+    _WORKER["layout_out"] = get_dataset_layout(cfg.output_dir)
+    load_deepmreye_masks()
+
+
+def _prepare_run_in_worker(run: tuple[str, dict[str, Any], str]) -> str:
+    prepare_run(_WORKER["cfg"], _WORKER["layout_out"], *run)
+    return run[0]
+
+
+def _register_session_in_worker(img_path: str) -> str:
+    register_session_reference(_WORKER["cfg"], _WORKER["layout_out"], img_path)
+    return img_path
+
+
+def _prepare_runs_in_worker(runs: list[tuple[str, dict[str, Any], str]]) -> list[str]:
+    """Prepare several runs, registering the reference of their session first.
+
+    With ``cfg.session_reference``, the runs must all be from the same session.
+    """
+    if _WORKER["cfg"].session_reference:
+        _register_session_in_worker(runs[0][0])
+    return [str(prepare_run(_WORKER["cfg"], _WORKER["layout_out"], *run)) for run in runs]
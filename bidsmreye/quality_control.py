@@ -3,33 +3,48 @@
 from __future__ import annotations
 
 import json
-import math
 from pathlib import Path
+from typing import Any
 
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
 from bids import BIDSLayout  # type: ignore
 from scipy.stats.distributions import chi2
 
+from bidsmreye.batch_qc import (
+    GAZE_DENSITY_EDGES,
+    QC_COLUMNS,
+    QC_METRICS,
+    batch_quality_control,
+    carling_outliers,
+    gaze_density,
+    stack_runs,
+    summarize_runs,
+)
 from bidsmreye.bids_utils import (
     check_layout,
     create_bidsname,
     get_dataset_layout,
     init_dataset,
+    list_shard_keys,
     list_subjects,
     return_desc_entity,
+    shard_key,
 )
 from bidsmreye.configuration import Config
+from bidsmreye.fingerprint import is_up_to_date, save_fingerprint
 from bidsmreye.logger import bidsmreye_log
 from bidsmreye.report import generate_report
 from bidsmreye.utils import (
     add_timestamps_to_dataframe,
+    atomic_write,
     check_if_file_found,
     create_dir_for_file,
     progress_bar,
     set_this_filter,
 )
-from bidsmreye.visualize import visualize_eye_gaze_data
+from bidsmreye.visualize import visualize_eye_gaze_data, write_figure
 
 log = bidsmreye_log("bidsmreye")
 
@@ -38,17 +53,24 @@ def compute_displacement(x: pd.Series, y: pd.Series) -> pd.Series:
     return np.sqrt((x.diff() ** 2) + (y.diff() ** 2))
 
 
-def add_qc_to_sidecar(confounds: pd.DataFrame, sidecar_name: Path) -> None:
+def add_qc_to_sidecar(
+    confounds: pd.DataFrame,
+    sidecar_name: Path,
+    metrics: dict[str, float] | None = None,
+) -> None:
     """Add quality control metrics to the sidecar json file.
 
-    :param layout: Layout of the BIDS dataset to which the confounds tsv file belongs to
-    :type  layout: BIDSLayout
+    :param confounds: Confounds with the columns added by
+                      ``compute_displacement_and_outliers``.
+    :type  confounds: pd.DataFrame
 
-    :param confounds_tsv: path the the confounds tsv file
-    :type  confounds_tsv: str | Path
+    :param sidecar_name: path the the sidecar json file
+    :type  sidecar_name: Path
 
-    :return: Path to the sidecar json file
-    :rtype: Path
+    :param metrics: Quality control metrics of the run.
+                    Computed from the confounds if not given.
+                    See ``bidsmreye.batch_qc.summarize_runs``.
+    :type  metrics: dict[str, float] | None
     """
     log.info(f"Quality control data added to {sidecar_name}")
 
@@ -61,11 +83,16 @@ def add_qc_to_sidecar(confounds: pd.DataFrame, sidecar_name: Path) -> None:
         create_dir_for_file(file=sidecar_name)
         content = {}
 
-    content["NbDisplacementOutliers"] = int(confounds["displacement_outliers"].sum())
-    content["NbXOutliers"] = int(confounds["x_outliers"].sum())
-    content["NbYOutliers"] = int(confounds["y_outliers"].sum())
-    content["XVar"] = confounds["x_coordinate"].var()
-    content["YVar"] = confounds["y_coordinate"].var()
+    if metrics is None:
+        metrics = {
+            key: value[0].item()
+            for key, value in summarize_runs(
+                confounds["x_coordinate"].to_numpy(dtype=float)[np.newaxis],
+                confounds["y_coordinate"].to_numpy(dtype=float)[np.newaxis],
+                {x: confounds[x].to_numpy()[np.newaxis] for x in QC_COLUMNS},
+            ).items()
+        }
+    content |= metrics
     content["Columns"] = confounds.columns.to_list()
 
     content["displacement"] = {
@@ -96,32 +123,50 @@ def add_qc_to_sidecar(confounds: pd.DataFrame, sidecar_name: Path) -> None:
 
     content = {key: content[key] for key in sorted(content)}
 
-    with open(sidecar_name, "w") as f:
+    with atomic_write(sidecar_name) as tmp_file, open(tmp_file, "w") as f:
         json.dump(content, f, indent=4)
 
 
 def compute_displacement_and_outliers(confounds: pd.DataFrame) -> pd.DataFrame:
-    confounds["displacement"] = compute_displacement(
-        confounds["x_coordinate"], confounds["y_coordinate"]
-    )
+    """Add the displacement and the outliers of the eye gaze to the confounds.
 
-    confounds["displacement_outliers"] = compute_robust_outliers(
-        confounds["displacement"], outlier_type="Carling"
+    See ``bidsmreye.batch_qc.batch_quality_control``.
+    """
+    columns = batch_quality_control(
+        confounds["x_coordinate"].to_numpy(dtype=float)[np.newaxis],
+        confounds["y_coordinate"].to_numpy(dtype=float)[np.newaxis],
     )
+    for key in QC_COLUMNS:
+        confounds[key] = columns[key][0]
 
-    confounds["x_outliers"] = compute_robust_outliers(
-        confounds["x_coordinate"], outlier_type="Carling"
-    )
     log.debug(f"Found {confounds['x_outliers'].sum()} x outliers")
-
-    confounds["y_outliers"] = compute_robust_outliers(
-        confounds["y_coordinate"], outlier_type="Carling"
-    )
     log.debug(f"Found {confounds['y_outliers'].sum()} y outliers")
 
     return confounds
 
 
+def read_confounds(
+    cfg: Config, layout_in: BIDSLayout, confounds_tsv: Path
+) -> pd.DataFrame:
+    """Read the eye gaze of a run and add timestamps if they are missing."""
+    confounds = pd.read_csv(confounds_tsv, sep="\t")
+
+    if "timestamp" not in confounds.columns:
+        # with several models, the sidecar has the same desc entity as the confounds
+        extra_entities = None
+        model_weights_files = cfg.list_model_weights_files()
+        if len(model_weights_files) == 1:
+            extra_entities = {"desc": return_desc_entity(Path(model_weights_files[0]))}
+        sampling_frequency = get_sampling_frequency(
+            layout_in, confounds_tsv, extra_entities=extra_entities
+        )
+
+        if sampling_frequency is not None:
+            confounds = add_timestamps_to_dataframe(confounds, sampling_frequency)
+
+    return confounds
+
+
 def perform_quality_control(
     cfg: Config,
     layout_in: BIDSLayout,
@@ -133,51 +178,107 @@ def perform_quality_control(
     Compute displacement and outlier for a given eyetrack.tsv file
     and create a visualization for it that is saved as an html file.
 
+    See ``quality_control_runs``.
+
     :param layout: pybids layout to of the dataset to act on.
     :type  layout: BIDSLayout
 
     :param confounds_tsv: Path to the confounds TSV file.
     :type  confounds_tsv: str | Path
     """
+    quality_control_runs(cfg, layout_in, [confounds_tsv], layout_out)
+
+
+def quality_control_runs(
+    cfg: Config,
+    layout_in: BIDSLayout,
+    confounds_tsvs: list[str] | list[Path] | list[str | Path],
+    layout_out: BIDSLayout | None = None,
+) -> None:
+    """Perform quality control on the confounds of several runs.
+
+    The displacement, outliers and metrics of all the runs
+    that are not up to date are computed at once
+    (see ``bidsmreye.batch_qc``),
+    then the confounds, sidecar, gaze density and visualization of each run are saved.
+
+    :param layout_in: pybids layout to of the dataset to act on.
+    :type  layout_in: BIDSLayout
+
+    :param confounds_tsvs: Paths to the confounds TSV files.
+    :type  confounds_tsvs: list[str | Path]
+
+    :param layout_out: pybids layout of the dataset to save the outputs to.
+                       Defaults to ``layout_in``.
+    :type  layout_out: BIDSLayout | None
+    """
     if layout_out is None:
         layout_out = layout_in
 
-    confounds_tsv = Path(confounds_tsv)
-    visualization_html_file = create_bidsname(layout_out, confounds_tsv, "confounds_html")
-    if not cfg.force and visualization_html_file.exists():
-        log.debug(
-            "Output for the following file already exists. "
-            "Use the '--force' option to overwrite. "
-            f"\n '{confounds_tsv.name}'"
+    runs = {}
+    for confounds_tsv in map(Path, confounds_tsvs):
+        outputs = {
+            x: create_bidsname(layout_out, confounds_tsv, x)
+            for x in ("confounds_html", "confounds_json", "confounds_tsv", "gaze_density")
+        }
+        # the confounds and their sidecar are updated in place in the output dataset,
+        # so the fingerprint is computed once they have been written
+        inputs: list[str | Path] = list(
+            dict.fromkeys(
+                [confounds_tsv, outputs["confounds_tsv"], outputs["confounds_json"]]
+            )
+        )
+        if is_up_to_date(
+            cfg,
+            "quality_control",
+            inputs,
+            [
+                outputs["confounds_html"],
+                outputs["confounds_tsv"],
+                outputs["gaze_density"],
+            ],
+        ):
+            continue
+        runs[confounds_tsv] = (
+            read_confounds(cfg, layout_in, confounds_tsv),
+            inputs,
+            outputs,
         )
-        return
 
-    confounds = pd.read_csv(confounds_tsv, sep="\t")
+    if not runs:
+        return
 
-    if "timestamp" not in confounds.columns:
-        extra_entities = None
-        if cfg.model_weights_file is not None:
-            extra_entities = {"desc": return_desc_entity(Path(cfg.model_weights_file))}
-        sampling_frequency = get_sampling_frequency(
-            layout_in, confounds_tsv, extra_entities=extra_entities
-        )
+    x = stack_runs([confounds["x_coordinate"] for confounds, _, _ in runs.values()])
+    y = stack_runs([confounds["y_coordinate"] for confounds, _, _ in runs.values()])
+    columns = batch_quality_control(x, y)
+    metrics = summarize_runs(x, y, columns)
+    density = gaze_density(x, y)
 
-        if sampling_frequency is not None:
-            confounds = add_timestamps_to_dataframe(confounds, sampling_frequency)
+    for i, (confounds, inputs, outputs) in enumerate(runs.values()):
+        for key in QC_COLUMNS:
+            confounds[key] = columns[key][i, : len(confounds)]
 
-    compute_displacement_and_outliers(confounds)
+        add_qc_to_sidecar(
+            confounds,
+            outputs["confounds_json"],
+            {key: metrics[key][i].item() for key in QC_METRICS},
+        )
 
-    sidecar_name = create_bidsname(layout_out, confounds_tsv, "confounds_json")
-    add_qc_to_sidecar(confounds, sidecar_name)
+        with atomic_write(outputs["gaze_density"]) as tmp_file:
+            np.savez_compressed(tmp_file, counts=density[i], edges=GAZE_DENSITY_EDGES)
 
-    fig = visualize_eye_gaze_data(confounds)
-    fig.update_layout(showlegend=False, height=800)
+        fig = visualize_eye_gaze_data(confounds, density[i])
+        fig.update_layout(showlegend=False, height=800)
+        write_figure(
+            fig,
+            outputs["confounds_html"],
+            Path(layout_out.root) if cfg.shared_plotlyjs else None,
+        )
 
-    create_dir_for_file(visualization_html_file)
-    fig.write_html(visualization_html_file)
+        with atomic_write(outputs["confounds_tsv"]) as tmp_file:
+            confounds.to_csv(tmp_file, sep="\t", index=False)
 
-    confounds_tsv = create_bidsname(layout_out, confounds_tsv, "confounds_tsv")
-    confounds.to_csv(confounds_tsv, sep="\t", index=False)
+        save_fingerprint(cfg, "quality_control", inputs, outputs["confounds_html"])
 
 
 def get_sampling_frequency(
@@ -206,12 +307,19 @@ def get_sampling_frequency(
     return sampling_frequency
 
 
-def quality_control_output(cfg: Config) -> None:
-    """Run quality control on the output dataset."""
+def quality_control_output(cfg: Config, keys: set[tuple[str, ...]] | None = None) -> None:
+    """Run quality control on the output dataset.
+
+    :param keys: Work units of the shard to process.
+                 See ``bids_utils.list_shard_keys``.
+    :type keys: set[tuple[str, ...]] | None
+    """
     layout_out = get_dataset_layout(cfg.output_dir)
     check_layout(cfg, layout_out)
 
     subjects = list_subjects(cfg, layout_out)
+    if keys is not None:
+        subjects = [x for x in subjects if x in {key[0] for key in keys}]
 
     text = "QUALITY CONTROL"
     with progress_bar(text=text) as progress:
@@ -219,7 +327,7 @@ def quality_control_output(cfg: Config) -> None:
             description="processing subject", total=len(subjects)
         )
         for subject_label in subjects:
-            qc_subject(cfg, layout_out, subject_label)
+            qc_subject(cfg, layout_out, subject_label, keys=keys)
             generate_report(
                 output_dir=cfg.output_dir,
                 subject_label=subject_label,
@@ -237,13 +345,17 @@ def quality_control_input(cfg: Config) -> None:
 
     subjects = list_subjects(cfg, layout_in)
 
+    keys = list_shard_keys(cfg, layout_in, subjects, "eyetrack")
+    if keys is not None:
+        subjects = [x for x in subjects if x in {key[0] for key in keys}]
+
     text = "QUALITY CONTROL"
     with progress_bar(text=text) as progress:
         subject_loop = progress.add_task(
             description="processing subject", total=len(subjects)
         )
         for subject_label in subjects:
-            qc_subject(cfg, layout_in, subject_label, layout_out)
+            qc_subject(cfg, layout_in, subject_label, layout_out, keys)
             generate_report(
                 output_dir=cfg.output_dir,
                 subject_label=subject_label,
@@ -257,8 +369,14 @@ def qc_subject(
     layout_in: BIDSLayout,
     subject_label: str,
     layout_out: BIDSLayout | None = None,
+    keys: set[tuple[str, ...]] | None = None,
 ) -> None:
-    """Run quality control for one subject."""
+    """Run quality control for one subject.
+
+    :param keys: Work units of the shard to process.
+                 See ``bids_utils.list_shard_keys``.
+    :type keys: set[tuple[str, ...]] | None
+    """
     log.info(f"Running subject: {subject_label}")
 
     this_filter = set_this_filter(cfg, subject_label, "eyetrack")
@@ -270,8 +388,77 @@ def qc_subject(
 
     check_if_file_found(bf, this_filter, layout_in)
 
-    for file in bf:
-        perform_quality_control(cfg, layout_in, file.path, layout_out)
+    if keys is not None:
+        bf = [x for x in bf if shard_key(cfg, layout_in, x) in keys]
+
+    quality_control_runs(cfg, layout_in, [file.path for file in bf], layout_out)
+
+
+def _kth_distance(sorted_values: npt.NDArray[Any], k: int) -> npt.NDArray[Any]:
+    """Return the k-th smallest distance from each value to all the values.
+
+    The k values closest to a value are consecutive in the sorted values,
+    so the k-th smallest distance is the smallest half-width of a window
+    of k consecutive values, measured from that value.
+    The best window starts at the first index ``i``
+    where ``sorted_values[i + k - 1] - x >= x - sorted_values[i]``,
+    or just before it.
+    That condition only turns true once as ``i`` increases,
+    so the index is found by a binary search for all the values at once.
+    """
+    x = sorted_values
+    last = len(x) - k
+
+    def wider_on_the_right(start: npt.NDArray[Any]) -> npt.NDArray[Any]:
+        start = np.clip(start, 0, last)
+        return x[start + k - 1] - x >= x - x[start]
+
+    def half_width(start: npt.NDArray[Any]) -> npt.NDArray[Any]:
+        start = np.clip(start, 0, last)
+        return np.maximum(x - x[start], x[start + k - 1] - x)
+
+    # the first index is in [low, high]
+    low = np.zeros(len(x), dtype=np.intp)
+    high = np.full(len(x), last + 1, dtype=np.intp)
+    while (searching := low < high).any():
+        middle = (low + high) // 2
+        right = wider_on_the_right(middle)
+        high = np.where(searching & right, middle, high)
+        low = np.where(searching & ~right, middle + 1, low)
+    start = low
+
+    return np.minimum(
+        np.where(start <= last, half_width(start), np.inf),
+        np.where(start > 0, half_width(start - 1), np.inf),
+    )
+
+
+def median_pairwise_distances(values: npt.NDArray[Any]) -> npt.NDArray[Any]:
+    """Compute the median of the distances from each value to all the other ones.
+
+    Gives the same results as taking, for each value,
+    the ``np.median`` of its absolute differences with the other values,
+    in O(n log n) instead of O(n²).
+
+    :param values: Values without NaN, at least 2.
+    :type values: np.ndarray
+
+    :rtype: np.ndarray
+    """
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+
+    # the distance of each value to itself is the smallest one:
+    # the i-th smallest distance to the other values
+    # is the (i + 1)-th smallest distance to all the values
+    nb_others = len(values) - 1
+    distance = _kth_distance(sorted_values, (nb_others + 1) // 2 + 1)
+    if nb_others % 2 == 0:
+        distance = (distance + _kth_distance(sorted_values, nb_others // 2 + 2)) / 2
+
+    median = np.empty_like(distance)
+    median[order] = distance
+    return median
 
 
 def compute_robust_outliers(
@@ -294,6 +481,8 @@ def compute_robust_outliers(
     centrality as this is based on the median of pair-wise distances. This is
     a very sensitive measures, i.e. it has a relatively high false positive
     rates. As such it is a great detection tools.
+    The pair-wise distances are computed in O(n log n)
+    (see ``median_pairwise_distances``), so long recordings can be used.
 
     The adjusted Carling's box-plot rule can also be used, and derived from
     the median of the data: outliers are outside the bound of median +/- k*IQR,
@@ -314,21 +503,15 @@ def compute_robust_outliers(
     if outlier_type == "S-outliers":
         k = np.sqrt(chi2.ppf(0.975, df=1))
 
-        non_nan_idx = time_series.index[~time_series.isnull()].tolist()
-
-        distance = []
-        for i in non_nan_idx:
-            this_timepoint = time_series[i]
+        values = time_series.to_numpy(dtype=float)
+        non_nan = ~np.isnan(values)
 
-            # all but current data point
-            indices = list(range(len(time_series)))
-            indices.pop(i)
-
-            tmp = time_series[indices]
-            tmp = tmp.dropna()
+        outliers = np.zeros(len(time_series), dtype=np.int8)
+        if non_nan.sum() < 2:
+            return outliers.tolist()
 
-            # median of all pair-wise distances
-            distance.append(np.median(abs(this_timepoint - tmp)))
+        # median of all pair-wise distances
+        distance = median_pairwise_distances(values[non_nan])
 
         # get the S estimator
         consistency_factor = 1.1926
@@ -336,34 +519,14 @@ def compute_robust_outliers(
 
         # get the outliers in a normal distribution
         # no scaling needed as S estimates already std(data)
-
-        outliers = np.zeros(len(time_series), dtype=np.int8)
-        outliers[non_nan_idx] = (distance / Sn) > k
+        with np.errstate(divide="ignore", invalid="ignore"):
+            outliers[non_nan] = (distance / Sn) > k
 
         return outliers.tolist()
 
     elif outlier_type == "Carling":
-        # interquartile range
-        nan_less = time_series.dropna()
-        nb_timepoints = len(nan_less)
-        y = sorted(nan_less)
-        j = math.floor(nb_timepoints / 4 + 5 / 12)
-        g = (nb_timepoints / 4) - j + (5 / 12)
-        k = nb_timepoints - j + 1
-
-        lower_quartiles = (1 - g) * y[j] + g * y[j + 1]
-        higher_quartiles = (1 - g) * y[k] + g * y[k - 1]
-        inter_quartiles_range = higher_quartiles - lower_quartiles
-
-        # robust outliers
-        M = np.median(nan_less)
-        carling_k = (17.63 * nb_timepoints - 23.64) / (7.74 * nb_timepoints - 3.71)
-        lt = time_series < (M - carling_k * inter_quartiles_range)
-        gt = time_series > (M + carling_k * inter_quartiles_range)
-        df = pd.DataFrame({"lt": lt, "gt": gt})
-        outliers = df["lt"] | df["gt"]
-
-        return list(map(np.int8, outliers))  # type: ignore
+        outliers = carling_outliers(time_series.to_numpy(dtype=float)[np.newaxis])
+        return outliers[0].tolist()
 
     else:
         raise ValueError(f"Unknown outlier_type: {outlier_type}")
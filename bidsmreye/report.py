@@ -1,17 +1,51 @@
 """Compile outputs from all tasks, spaces, runs into a single HTML."""
 
 import datetime
+import os
+import re
 from pathlib import Path
 
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 from bidsmreye._version import __version__
 from bidsmreye.logger import bidsmreye_log
+from bidsmreye.utils import atomic_write
 
 log = bidsmreye_log(name="bidsmreye")
 
 TEMPLATES_DIR = Path(__file__).parent / "templates"
 
+# script tag of the figures referencing the plotly.js library of the dataset
+PLOTLYJS_SCRIPT = re.compile(
+    r'<script charset="utf-8" src="(?P<src>[^"]*plotly-[0-9.]+\.min\.js)"></script>'
+)
+
+
+def plotlyjs_asset(output_dir: Path) -> Path:
+    """Return the plotly.js library shared by the figures of a dataset.
+
+    It is written the first time it is needed.
+    The version of plotly.js is part of the name,
+    so figures written with another version keep working.
+
+    :param output_dir: Root of the dataset.
+    :type output_dir: Path
+
+    :rtype: Path
+    """
+    from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+    asset = output_dir / "assets" / f"plotly-{get_plotlyjs_version()}.min.js"
+    if not asset.is_file():
+        with atomic_write(asset) as tmp_file, open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+    return asset
+
+
+def relative_src(target: Path, html_file: Path) -> str:
+    """Return the path of a file relative to the HTML file loading it."""
+    return Path(os.path.relpath(target, html_file.parent)).as_posix()
+
 
 def return_jinja_env(searchpath=None) -> Environment:
     if searchpath is None:
@@ -34,11 +68,28 @@ def generate_report(output_dir: Path, subject_label: str, action: str) -> None:
     elif action == "generalize":
         input_files = sorted(output_dir.glob(f"sub-{subject_label}/**/*eyetrack.html"))
 
+    # skip temporary files left by interrupted runs
+    input_files = [x for x in input_files if not x.name.startswith(".")]
+
+    report_filename = (
+        output_dir / f"sub-{subject_label}" / f"sub-{subject_label}_{action}.html"
+    )
+
+    # figures referencing the shared plotly.js library
+    # load it once from the head of the report
+    scripts: list[str] = []
     files = []
     for html_report in input_files:
         with open(html_report) as f:
             content = f.read()
 
+        for src in PLOTLYJS_SCRIPT.findall(content):
+            asset = Path(os.path.normpath(html_report.parent / src))
+            script = relative_src(asset, report_filename)
+            if script not in scripts:
+                scripts.append(script)
+        content = PLOTLYJS_SCRIPT.sub("", content)
+
         name: str = html_report.stem
         if action == "prepare":
             name = name.replace("_desc-eye_report", "_desc-preproc_bold")
@@ -50,16 +101,13 @@ def generate_report(output_dir: Path, subject_label: str, action: str) -> None:
     report = template.render(
         action=action,
         files=files,
+        scripts=scripts,
         subject_label=subject_label,
         date=date,
         version=__version__,
     )
 
-    report_filename = (
-        output_dir / f"sub-{subject_label}" / f"sub-{subject_label}_{action}.html"
-    )
-
-    with open(report_filename, "w") as f:
+    with atomic_write(report_filename) as tmp_file, open(tmp_file, "w") as f:
         f.write(report)
 
     log.info(f"Report saved at: '{report_filename}'.")
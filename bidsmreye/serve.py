@@ -0,0 +1,196 @@
+"""Keep the models loaded in a daemon that generalizes runs on request.
+
+Jobs are sent to the daemon over a local Unix socket,
+as one JSON object per line, and answered the same way
+once all their outputs are written:
+
+- ``{"files": [...]}``: extracted timeseries (``desc-eye_timeseries.npz``)
+  of the runs to generalize,
+- ``{"subjects": [...], "task": [...], ...}``: filters on the runs of the dataset,
+  with the same meaning as the options of the ``generalize`` action
+  (see ``JOB_FILTERS``),
+- ``{"stop": true}``: stop the daemon.
+
+Answers are ``{"status": "ok"}`` or ``{"status": "error", "message": ...}``.
+Jobs are run one at a time, in the order they arrive.
+"""
+
+from __future__ import annotations
+
+import json
+import socket
+import socketserver
+from pathlib import Path
+from typing import Any
+
+from attrs import evolve
+from bids import BIDSLayout  # type: ignore
+
+from bidsmreye.bids_utils import get_dataset_layout
+from bidsmreye.configuration import Config
+from bidsmreye.logger import bidsmreye_log
+
+log = bidsmreye_log(name="bidsmreye")
+
+# options of the generalize action that can be set for each job
+JOB_FILTERS = ("subjects", "space", "task", "run", "bids_filter", "shard")
+
+
+def default_socket(cfg: Config) -> Path:
+    """Return the socket of the daemon of an output dataset.
+
+    Hidden files are ignored by pybids so it does not pollute the dataset.
+    """
+    return cfg.output_dir / ".bidsmreye.sock"
+
+
+def job_from_config(cfg: Config) -> dict[str, Any]:
+    """Return the job generalizing the runs selected by a configuration.
+
+    :param cfg: Configuration object
+    :type cfg: Config
+
+    :rtype: dict[str, Any]
+    """
+    return {x: getattr(cfg, x) for x in JOB_FILTERS}
+
+
+def submit(socket_path: str | Path, job: dict[str, Any]) -> dict[str, Any]:
+    """Send a job to a daemon and wait for it to be done.
+
+    :param socket_path: Socket the daemon listens on. See ``serve``.
+    :type socket_path: str | Path
+
+    :param job: See the description of the module.
+    :type job: dict[str, Any]
+
+    :raises RuntimeError: If the job failed.
+
+    :return: Answer of the daemon.
+    :rtype: dict[str, Any]
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall((json.dumps(job) + "\n").encode())
+        with sock.makefile("r") as f:
+            answer = f.readline()
+
+    if not answer:
+        raise RuntimeError(f"The daemon on '{socket_path}' closed the connection.")
+    response: dict[str, Any] = json.loads(answer)
+    if response["status"] != "ok":
+        raise RuntimeError(f"Job failed on the daemon: {response['message']}")
+    return response
+
+
+def run_job(cfg: Config, layout_out: BIDSLayout, job: dict[str, Any]) -> None:
+    """Generalize the runs of a job with the models already loaded.
+
+    :param cfg: Configuration of the daemon.
+    :type cfg: Config
+
+    :param layout_out: Output dataset layout.
+    :type layout_out: BIDSLayout
+
+    :param job: See the description of the module.
+    :type job: dict[str, Any]
+    """
+    from bidsmreye.generalize import generalize, generalize_files
+
+    if "files" in job:
+        if missing := [str(x) for x in job["files"] if not Path(x).is_file()]:
+            raise FileNotFoundError(f"Extracted timeseries not found: {missing}.")
+        generalize_files(cfg, layout_out, [str(x) for x in job["files"]])
+        return
+
+    if unknown := sorted(set(job) - set(JOB_FILTERS)):
+        raise ValueError(f"Unknown job options: {unknown}.")
+    # the Config adds the 'bidsmreye' folder to the output directory
+    generalize(evolve(cfg, output_dir=cfg.output_dir.parent, reset_database=False, **job))
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    server: _JobServer
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            response: dict[str, Any] = {"status": "ok"}
+            try:
+                job = json.loads(line)
+                if job.get("stop"):
+                    self.server.stopped = True
+                else:
+                    run_job(self.server.cfg, self.server.layout_out, job)
+            except Exception as exc:
+                log.exception(f"Job failed: {line.decode().strip()}")
+                response = {"status": "error", "message": f"{type(exc).__name__}: {exc}"}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            if self.server.stopped:
+                return
+
+
+class _JobServer(socketserver.UnixStreamServer):
+    # jobs are run one at a time: let clients wait for their turn
+    request_queue_size = 128
+
+    def __init__(self, socket_path: str, cfg: Config, layout_out: BIDSLayout) -> None:
+        super().__init__(socket_path, _JobHandler)
+        self.cfg = cfg
+        self.layout_out = layout_out
+        self.stopped = False
+
+
+def check_socket(socket_path: Path) -> None:
+    """Remove the socket left by a daemon that did not stop cleanly.
+
+    :raises RuntimeError: If a daemon is still listening on the socket.
+    """
+    if not socket_path.exists():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            log.warning(f"Removing stale socket: {socket_path}")
+            socket_path.unlink(missing_ok=True)
+            return
+    raise RuntimeError(f"A daemon is already listening on '{socket_path}'.")
+
+
+def serve(cfg: Config, socket_path: str | Path | None = None) -> None:
+    """Load the models once and generalize the runs of the jobs sent on a socket.
+
+    The models are loaded before the first job
+    if some runs of the output dataset are already prepared,
+    except the int8 models, which are calibrated on the runs of each job.
+
+    :param cfg: Configuration object.
+                Its model and inference options are used for all the jobs.
+    :type cfg: Config
+
+    :param socket_path: Unix socket to listen on.
+                        Defaults to ``default_socket``.
+    :type socket_path: str | Path | None
+    """
+    from bidsmreye.generalize import list_models, load_models, set_tensorflow_options
+
+    socket_path = Path(socket_path or default_socket(cfg))
+    check_socket(socket_path)
+
+    models = list_models(cfg)
+    set_tensorflow_options(bfloat16=cfg.bfloat16)
+    layout_out = get_dataset_layout(cfg.output_dir)
+    file = next(cfg.output_dir.glob("sub-*/**/*desc-eye_timeseries.npz"), None)
+    if file is not None and cfg.backend != "onnx_int8":
+        load_models(cfg, models, [str(file)])
+
+    with _JobServer(str(socket_path), cfg, layout_out) as server:
+        # only the user running the daemon can send it jobs
+        socket_path.chmod(0o600)
+        log.info(f"Waiting for jobs on: {socket_path}")
+        try:
+            while not server.stopped:
+                server.handle_request()
+        finally:
+            socket_path.unlink(missing_ok=True)
+    log.info("Daemon stopped.")
@@ -1,11 +1,21 @@
 from __future__ import annotations
 
+import errno
+import os
+import pickle
 import re
 import shutil
+import struct
+import tempfile
+import zipfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
 
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
 from bids import BIDSLayout  # type: ignore
 from bids.layout import BIDSFile
@@ -28,6 +38,22 @@ log = bidsmreye_log(name="bidsmreye")
 
 TEMPLATES_DIR = Path(__file__).parent / "templates"
 
+# signature, file name length and extra field length
+# of the local header preceding each member of a zip file
+ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+@lru_cache(maxsize=1)
+def _umask() -> int:
+    """Return the umask of the process.
+
+    Read once, on first use, as it can only be read by changing it.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
 
 def progress_bar(text: str, color: str = "green") -> Progress:
     return Progress(
@@ -51,8 +77,8 @@ def copy_license(output_dir: Path) -> Path:
     output_file = output_dir / "LICENSE"
     create_dir_if_absent(output_dir)
     if not (output_dir / "LICENSE").is_file():
-        shutil.copy(input_file, output_dir)
-        move_file(output_dir / "CCO", output_file)
+        with atomic_write(output_file) as tmp_file:
+            shutil.copy(input_file, tmp_file)
     return output_file
 
 
@@ -72,7 +98,7 @@ def set_this_filter(
     this_filter = cfg.bids_filter[filter_type]
     this_filter["suffix"] = return_regex(this_filter["suffix"])
     this_filter["task"] = return_regex(cfg.task)
-    if filter_type not in ("eyetrack", "eyetrack_qc"):
+    if filter_type not in ("eyetrack", "eyetrack_qc", "gaze_density"):
         this_filter["space"] = return_regex(cfg.space)
     this_filter["subject"] = subject_label
     if cfg.run:
@@ -83,10 +109,46 @@ def set_this_filter(
     return this_filter
 
 
+@contextmanager
+def atomic_write(output_file: str | Path) -> Iterator[Path]:
+    """Write a file through a temporary file renamed once it is complete.
+
+    Yields the path of the temporary file to write to.
+    It is hidden (so ignored by pybids), in the same directory as the output
+    and ends with the same name, so writers that rely on the extension still work.
+    Its name is unique, so several threads can write the same output.
+    If an error occurs, the temporary file is removed
+    and any previous version of the output is left untouched:
+    outputs are always either complete or absent.
+
+    :param output_file: File to write.
+    :type output_file: str | Path
+
+    :return: Temporary file to write to.
+    :rtype: Iterator[Path]
+    """
+    output_file = Path(output_file)
+    create_dir_for_file(output_file)
+    fd, name = tempfile.mkstemp(
+        dir=output_file.parent, prefix=".tmp-", suffix=f"-{output_file.name}"
+    )
+    os.close(fd)
+    tmp_file = Path(name)
+    try:
+        yield tmp_file
+        # mkstemp only lets the owner read the file
+        tmp_file.chmod(0o666 & ~_umask())
+        tmp_file.replace(output_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
 def move_file(input: Path, output: Path) -> None:
     """Move or rename a file and create target directory if it does not exist.
 
-    Should work even the source and target names are on different file systems.
+    Renames the file when possible
+    and only copies it if source and target are on different file systems,
+    in which case the copy is atomic (see ``atomic_write``).
 
     :param input:File to move.
     :type input: Path
@@ -99,8 +161,14 @@ def move_file(input: Path, output: Path) -> None:
     """
     log.debug(f"{input.absolute()} --> {output.absolute()}")
     create_dir_for_file(output)
-    shutil.copy(input, output)
-    input.unlink()
+    try:
+        input.replace(output)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        with atomic_write(output) as tmp_file:
+            shutil.copy(input, tmp_file)
+        input.unlink()
 
 
 def create_dir_if_absent(output_path: str | Path) -> None:
@@ -200,13 +268,160 @@ def return_deepmreye_output_filename(filename: str, filetype: str | None = None)
     if filetype is None:
         pass
     elif filetype == "mask":
-        filename = "mask_" + re.sub(r"\.nii.*", ".p", filename)
+        filename = "mask_" + re.sub(r"\.nii.*", ".npy", filename)
     elif filetype == "report":
         filename = "report_" + re.sub(r"\.nii.*", ".html", filename)
 
     return filename
 
 
+def save_eye_mask(data: npt.NDArray[Any], output_file: Path) -> Path:
+    """Save the data extracted from the eye mask of a run.
+
+    Data are saved as float32 in a ``.npy`` file with time as first dimension,
+    so each volume is stored contiguously and
+    any range of volumes can be read without reading the whole file.
+
+    :param data: Eye mask data with time as last dimension.
+    :type data: np.ndarray
+
+    :param output_file: ``.npy`` file to write to.
+    :type output_file: Path
+
+    :return: Path to the saved file.
+    :rtype: Path
+    """
+    with atomic_write(output_file) as tmp_file:
+        np.save(
+            tmp_file,
+            np.ascontiguousarray(np.moveaxis(data, -1, 0), dtype=np.float32),
+            allow_pickle=False,
+        )
+    return output_file
+
+
+def load_eye_mask(input_file: Path, mmap_mode: str | None = "r") -> npt.NDArray[Any]:
+    """Load the data extracted from the eye mask of a run.
+
+    By default the data are memory mapped:
+    only the parts of the array that are accessed are read from disk.
+
+    :param input_file: ``.npy`` file saved with ``save_eye_mask``.
+    :type input_file: Path
+
+    :param mmap_mode: Passed to ``numpy.load``.
+                      Use None to load the whole array in memory.
+    :type mmap_mode: str | None
+
+    :return: Eye mask data with time as last dimension.
+    :rtype: np.ndarray
+    """
+    data = np.load(input_file, mmap_mode=mmap_mode, allow_pickle=False)  # type: ignore
+    return np.moveaxis(data, 0, -1)
+
+
+def convert_eye_mask(input_file: Path) -> Path:
+    """Convert eye mask data pickled by older versions to ``.npy``.
+
+    The pickle file is removed after conversion.
+
+    Only use on files created by bidsmreye or deepMReye:
+    unpickling a file can execute arbitrary code.
+
+    :param input_file: ``.p`` file.
+    :type input_file: Path
+
+    :return: Path to the converted ``.npy`` file.
+    :rtype: Path
+    """
+    log.info(f"Converting pickled eye mask data to npy:\n {input_file}")
+    with open(input_file, "rb") as f:
+        data = pickle.load(f)
+    output_file = save_eye_mask(data, input_file.with_suffix(".npy"))
+    input_file.unlink()
+    return output_file
+
+
+def load_timeseries(input_file: str | Path) -> list[npt.NDArray[Any]]:
+    """Memory map the volumes of an extracted timeseries.
+
+    The ``desc-eye_timeseries.npz`` files store each volume in its own
+    uncompressed ``.npy`` member, so the volumes are mapped from the file
+    and only read from disk when they are accessed,
+    whatever the number of volumes of the run.
+    Compressed members are read in memory,
+    as are the members saved in version 3.0 of the npy format.
+
+    :param input_file: ``.npz`` file saved by ``deepmreye.preprocess.save_data``.
+    :type input_file: str | Path
+
+    :return: Volumes of the run, the same as the ones read
+             by ``deepmreye.util.data_generator.get_all_subject_data``.
+    :rtype: list[np.ndarray]
+    """
+    with zipfile.ZipFile(input_file) as archive, open(input_file, "rb") as f:
+        names = archive.namelist()
+        nb_volumes = len(names) // (3 if "identifier_0.npy" in names else 2)
+        if nb_volumes == 0:
+            return []
+
+        buffer = np.memmap(input_file, dtype=np.uint8, mode="r")
+        volumes = []
+        for i in range(nb_volumes):
+            info = archive.getinfo(f"data_{i}.npy")
+            header = None
+            if info.compress_type == zipfile.ZIP_STORED:
+                header = _read_npy_header(f, info, input_file)
+            if header is None:
+                with archive.open(info) as member:
+                    volumes.append(np.lib.format.read_array(member))
+                continue
+
+            shape, fortran_order, dtype = header
+            volumes.append(
+                np.ndarray(
+                    shape,
+                    dtype=dtype,
+                    buffer=buffer,
+                    offset=f.tell(),
+                    order="F" if fortran_order else "C",
+                )
+            )
+    return volumes
+
+
+def _read_npy_header(
+    f: Any, info: zipfile.ZipInfo, input_file: str | Path
+) -> tuple[tuple[int, ...], bool, np.dtype[Any]] | None:
+    """Read the npy header of an uncompressed member of a zip file.
+
+    Leaves ``f`` at the start of the data of the array.
+
+    :return: Shape, Fortran order and dtype of the array,
+             or None if it can only be read by ``numpy.lib.format.read_array``.
+    """
+    f.seek(info.header_offset)
+    signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(
+        f.read(ZIP_LOCAL_HEADER.size)
+    )
+    if signature != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise ValueError(f"No zip local header for '{info.filename}' in:\n{input_file}")
+    f.seek(name_length + extra_length, os.SEEK_CUR)
+
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    if version == (2, 0):
+        return np.lib.format.read_array_header_2_0(f)
+    # same header as 2.0 with utf8 field names
+    if version == (3, 0):
+        return None
+    raise ValueError(
+        f"Unsupported npy format version {version[0]}.{version[1]} "
+        f"for '{info.filename}' in:\n{input_file}"
+    )
+
+
 def add_timestamps_to_dataframe(df: pd.DataFrame, sampling_frequency: float):
     nb_timepoints = df.shape[0]
     timestamp = np.arange(
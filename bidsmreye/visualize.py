@@ -1,20 +1,24 @@
 from __future__ import annotations
 
 import json
+import warnings
 from datetime import datetime
 from pathlib import Path
 from typing import Any
 
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 
 from bidsmreye._version import __version__
+from bidsmreye.batch_qc import GAZE_DENSITY_EDGES, QC_METRICS, gaze_density
 from bidsmreye.bids_utils import get_dataset_layout, list_subjects
 from bidsmreye.configuration import Config
 from bidsmreye.logger import bidsmreye_log
-from bidsmreye.utils import check_if_file_found, set_this_filter
+from bidsmreye.report import plotlyjs_asset, relative_src
+from bidsmreye.utils import atomic_write, check_if_file_found, set_this_filter
 
 LINE_WIDTH = 3
 FONT_SIZE = {"size": 14}
@@ -26,6 +30,10 @@ MARKER_SIZE = 10
 
 TICK_FONT = {"family": "arial", "color": "black", "size": 14}
 
+# maximum number of samples of a time series plotted as a line
+# (a few per pixel of the figures)
+MAX_LINE_POINTS = 2000
+
 X_POSITION_1 = 1
 X_POSITION_2 = 1.5
 X_POSITION_3 = 2
@@ -39,6 +47,27 @@ COLORS = [COLOR_1, COLOR_2, COLOR_3]
 log = bidsmreye_log(name="bidsmreye")
 
 
+def write_figure(fig: Any, html_file: Path, dataset_dir: Path | None = None) -> None:
+    """Save a figure as a HTML file.
+
+    :param fig: Plotly figure.
+    :type fig: Any
+
+    :param html_file: Where to save the figure.
+    :type html_file: Path
+
+    :param dataset_dir: Root of the dataset whose plotly.js library
+                        is loaded by the figure (see ``report.plotlyjs_asset``).
+                        If None, the library is embedded in the file (a few MB).
+    :type dataset_dir: Path | None
+    """
+    include_plotlyjs: bool | str = True
+    if dataset_dir is not None:
+        include_plotlyjs = relative_src(plotlyjs_asset(dataset_dir), html_file)
+    with atomic_write(html_file) as tmp_file:
+        fig.write_html(tmp_file, include_plotlyjs=include_plotlyjs)
+
+
 def collect_group_qc_data(cfg: Config) -> pd.DataFrame | None:
     """Collect QC metrics data from all subjects json in a BIDS dataset.
 
@@ -60,8 +89,8 @@ def collect_group_qc_data(cfg: Config) -> pd.DataFrame | None:
 
     check_if_file_found(bf, this_filter, layout)
 
-    qc_data = None
-    for i, file in enumerate(bf):
+    records = []
+    for file in bf:
         log.info(f"Processing file: {file.path}")
 
         entities = layout.parse_file_entities(file.path)
@@ -69,23 +98,16 @@ def collect_group_qc_data(cfg: Config) -> pd.DataFrame | None:
         with open(file.path) as f:
             data = json.loads(f.read())
 
-        df = pd.json_normalize(data)
-        df["filename"] = Path(file.path).name
-        df["subject"] = entities["subject"]
-        qc_data = df if i == 0 else pd.concat([qc_data, df], sort=False)
+        data["filename"] = Path(file.path).name
+        data["subject"] = entities["subject"]
+        records.append(data)
 
-    if qc_data is None:
+    if not records:
         return None
 
-    cols = [
-        "subject",
-        "filename",
-        "NbDisplacementOutliers",
-        "NbXOutliers",
-        "NbYOutliers",
-        "XVar",
-        "YVar",
-    ]
+    qc_data = pd.json_normalize(records)
+
+    cols = ["subject", "filename", *QC_METRICS]
     try:
         qc_data = qc_data[cols]
     except KeyError:
@@ -96,6 +118,39 @@ def collect_group_qc_data(cfg: Config) -> pd.DataFrame | None:
     return qc_data
 
 
+def collect_group_gaze_density(cfg: Config) -> npt.NDArray[Any] | None:
+    """Sum the gaze densities of all the runs in a BIDS dataset.
+
+    Runs whose density was computed on another grid than ``GAZE_DENSITY_EDGES``
+    are skipped.
+
+    :return: Counts with shape (X bins, Y bins) or None if no density was found.
+    :rtype: np.ndarray | None
+    """
+    layout = get_dataset_layout(cfg.output_dir, use_database=False)
+
+    subjects = list_subjects(cfg, layout)
+
+    this_filter = set_this_filter(cfg, subjects, "gaze_density")
+
+    bf = layout.get(
+        regex_search=True,
+        **this_filter,
+    )
+
+    counts = None
+    for file in bf:
+        with np.load(file.path) as data:
+            if not np.array_equal(data["edges"], GAZE_DENSITY_EDGES):
+                log.warning(
+                    f"Skipping gaze density computed on another grid: {file.path}"
+                )
+                continue
+            counts = data["counts"] if counts is None else counts + data["counts"]
+
+    return counts
+
+
 def plot_group_boxplot(
     fig: Any,
     qc_data: pd.DataFrame,
@@ -152,7 +207,7 @@ def group_report(cfg: Config) -> None:
             vertical_spacing=0.1,
             specs=[
                 [{"rowspan": 1, "colspan": 3}, None, None],
-                [{"rowspan": 1, "colspan": 2}, None, None],
+                [{"rowspan": 1, "colspan": 2}, None, {}],
             ],
         )
     )
@@ -185,6 +240,13 @@ def group_report(cfg: Config) -> None:
         yaxes_title="variance (degrees<sup>2</sup>)",
     )
 
+    density = collect_group_gaze_density(cfg)
+    if density is not None:
+        plot_gaze_density(fig, density, row=2, col=3)
+        plotting_range = density_range(density)
+        fig.update_xaxes(row=2, col=3, range=plotting_range, ticksuffix="°")
+        fig.update_yaxes(row=2, col=3, range=plotting_range, ticksuffix="°")
+
     fig.update_yaxes(
         title={"standoff": 0, "font": FONT_SIZE},
         showline=True,
@@ -209,6 +271,7 @@ def group_report(cfg: Config) -> None:
     )
 
     fig.update_traces(
+        selector={"type": "box"},
         boxpoints="all",
         jitter=0.3,
         pointpos=2,
@@ -240,24 +303,130 @@ def group_report(cfg: Config) -> None:
     )
 
     fig.show()
-    group_report_file = cfg.output_dir / "group_eyetrack.html"
-    fig.write_html(group_report_file)
+    write_figure(
+        fig,
+        cfg.output_dir / "group_eyetrack.html",
+        cfg.output_dir if cfg.shared_plotlyjs else None,
+    )
 
     qc_data_file = cfg.output_dir / "group_eyetrack.tsv"
-    qc_data.to_csv(qc_data_file, sep="\t", index=False)
+    with atomic_write(qc_data_file) as tmp_file:
+        qc_data.to_csv(tmp_file, sep="\t", index=False)
+
+    if density is not None:
+        with atomic_write(cfg.output_dir / "group_gazedensity.npz") as tmp_file:
+            np.savez_compressed(tmp_file, counts=density, edges=GAZE_DENSITY_EDGES)
+
+
+def largest_triangle_three_buckets(
+    x: npt.NDArray[Any], y: npt.NDArray[Any], nb_points: int
+) -> npt.NDArray[np.intp]:
+    """Select the points that best preserve the shape of a line.
+
+    Largest-Triangle-Three-Buckets:
+    the first and last points are kept,
+    the others are split in ``nb_points - 2`` consecutive buckets
+    and from each bucket the point kept is the one forming the largest triangle
+    with the point kept from the previous bucket
+    and the mean of the next bucket.
+
+    :param x: Coordinates of the points, in the order they are joined.
+    :type x: np.ndarray
+
+    :param y: Coordinates of the points.
+    :type y: np.ndarray
+
+    :param nb_points: Number of points to keep.
+    :type nb_points: int
+
+    :return: Indices of the points kept, sorted.
+    :rtype: np.ndarray
+    """
+    nb_samples = len(x)
+    if nb_points >= nb_samples or nb_points < 3:
+        return np.arange(nb_samples)
+
+    edges = np.linspace(1, nb_samples - 1, nb_points - 1).astype(int)
+    # mean of each bucket, the last point closing the last one
+    with warnings.catch_warnings():
+        # mean of empty slice
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        means = [
+            np.array([*np.add.reduceat(np.nan_to_num(v), edges[:-1]), v[-1]])
+            for v in (x, y)
+        ]
+        counts = np.array([*np.add.reduceat(~np.isnan(x + y), edges[:-1]), 1])
+        mean_x, mean_y = (v / counts for v in means)
+
+    selected = np.empty(nb_points, dtype=np.intp)
+    selected[0], selected[-1] = 0, nb_samples - 1
+    a = 0
+    for i in range(nb_points - 2):
+        start, stop = edges[i], edges[i + 1]
+        area = np.abs(
+            (x[a] - mean_x[i + 1]) * (y[start:stop] - y[a])
+            - (x[a] - x[start:stop]) * (mean_y[i + 1] - y[a])
+        )
+        # missing samples are only kept if the whole bucket is missing
+        a = start + int(np.argmax(np.where(np.isnan(area), -1, area)))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample(
+    x: pd.Series | npt.NDArray[Any],
+    y: pd.Series | npt.NDArray[Any],
+    keep: pd.Series | npt.NDArray[Any] | None = None,
+    max_points: int = MAX_LINE_POINTS,
+) -> npt.NDArray[np.intp]:
+    """Select at most ``max_points`` points of a line to plot, and the ``keep`` ones.
+
+    See ``largest_triangle_three_buckets``.
+
+    :param keep: Boolean mask of the points to always keep, like outliers.
+    :type keep: pd.Series | np.ndarray | None
+
+    :return: Indices of the points to plot, sorted.
+    :rtype: np.ndarray
+    """
+    index = largest_triangle_three_buckets(
+        np.asarray(x, dtype=float), np.asarray(y, dtype=float), max_points
+    )
+    if keep is not None:
+        index = np.union1d(index, np.flatnonzero(np.asarray(keep, dtype=bool)))
+    return index
 
 
 def value_range(X: pd.Series) -> list[float]:
     return [-X.max() * 1.2, X.max() * 1.2]
 
 
+def density_range(density: npt.NDArray[Any]) -> list[float]:
+    """Return a range around the bins of a gaze density that are not empty."""
+    x_bins, y_bins = np.nonzero(density)
+    edges = np.abs(GAZE_DENSITY_EDGES[np.r_[x_bins, x_bins + 1, y_bins, y_bins + 1]])
+    return value_range(pd.Series(edges))
+
+
 def time_range(time_stamps: pd.Series) -> list[float]:
     return [time_stamps.min() - 3, time_stamps.max() + 3]
 
 
 def visualize_eye_gaze_data(
-    eye_gaze_data: pd.DataFrame,
+    eye_gaze_data: pd.DataFrame, density: npt.NDArray[Any] | None = None
 ) -> Any:
+    """Plot the gaze positions, displacement and outliers of a run.
+
+    :param density: Gaze density of the run. See ``batch_qc.gaze_density``.
+                    Computed from ``eye_gaze_data`` if None.
+    :type density: np.ndarray | None
+    """
+    if density is None:
+        density = gaze_density(
+            eye_gaze_data["x_coordinate"].to_numpy(float)[np.newaxis],
+            eye_gaze_data["y_coordinate"].to_numpy(float)[np.newaxis],
+        )[0]
+
     fig = go.FigureWidget(
         make_subplots(
             rows=3,
@@ -292,7 +461,7 @@ def visualize_eye_gaze_data(
         tickfont=TICK_FONT,
     )
 
-    plot_heat_map(fig, eye_gaze_data)
+    plot_heat_map(fig, eye_gaze_data, density)
 
     return fig
 
@@ -334,10 +503,11 @@ def plot_time_series(
         col=col,
     )
 
+    index = downsample(eye_gaze_data["timestamp"], values_to_plot, outliers == 1)
     fig.add_trace(
         go.Scatter(
-            x=eye_gaze_data["timestamp"],
-            y=values_to_plot,
+            x=eye_gaze_data["timestamp"].iloc[index],
+            y=values_to_plot.iloc[index],
             mode="lines",
             line_color=line_color,
             line_width=LINE_WIDTH,
@@ -387,18 +557,30 @@ def plot_time_series(
     )
 
 
-def plot_heat_map(fig: Any, eye_gaze_data: pd.DataFrame) -> None:
+def plot_gaze_density(fig: Any, density: npt.NDArray[Any], row: int, col: int) -> None:
+    """Plot the contours of a gaze density.
+
+    :param density: Counts with shape (X bins, Y bins) on ``GAZE_DENSITY_EDGES``.
+    :type density: np.ndarray
+    """
+    centers = (GAZE_DENSITY_EDGES[:-1] + GAZE_DENSITY_EDGES[1:]) / 2
+    fig.add_trace(
+        go.Contour(x=centers, y=centers, z=density.T, colorscale=HEAT_MAP_COLOR),
+        row=row,
+        col=col,
+    )
+
+
+def plot_heat_map(
+    fig: Any, eye_gaze_data: pd.DataFrame, density: npt.NDArray[Any]
+) -> None:
     X = eye_gaze_data["x_coordinate"]
     Y = eye_gaze_data["y_coordinate"]
 
     x_range = value_range(X)
     y_range = value_range(Y)
 
-    fig.add_trace(
-        go.Histogram2dContour(x=X, y=Y, colorscale=HEAT_MAP_COLOR),
-        row=1,
-        col=3,
-    )
+    plot_gaze_density(fig, density, row=1, col=3)
 
     fig.add_trace(
         go.Scatter(
@@ -423,10 +605,12 @@ def plot_heat_map(fig: Any, eye_gaze_data: pd.DataFrame) -> None:
         col=3,
     )
 
+    outliers = eye_gaze_data[["x_outliers", "y_outliers", "displacement_outliers"]]
+    index = downsample(X, Y, (outliers == 1).any(axis=1))
     fig.add_trace(
         go.Scatter(
-            x=X,
-            y=Y,
+            x=X.iloc[index],
+            y=Y.iloc[index],
             opacity=0.4,
             line={"color": "black", "width": 1, "dash": "dash"},
         ),
@@ -2,12 +2,19 @@ from __future__ import annotations
 
 import json
 import shutil
+from collections.abc import Iterator
 from pathlib import Path
 
+import nibabel as nib
 import numpy as np
 import pandas as pd
 import pytest
+from deepmreye import architecture, preprocess
+from deepmreye.util import model_opts
+from nibabel.processing import resample_to_output
 
+from bidsmreye.configuration import Config
+from bidsmreye.prepare_data import prepare_data
 from bidsmreye.quality_control import compute_displacement, compute_robust_outliers
 
 
@@ -21,6 +28,88 @@ def data_dir():
     return Path(__file__).parent / "data"
 
 
+@pytest.fixture(scope="session")
+def bold_dataset(tmp_path_factory) -> Iterator[Path]:
+    """Two runs of the synthetic dataset that can be prepared.
+
+    The images of the synthetic dataset are empty,
+    so they are replaced by a few volumes of the deepMReye template with some noise.
+
+    ANTs samples the images at random during registration:
+    its seed is fixed so all the preparations of these runs give the same outputs.
+    """
+    src_dir = Path(__file__).parent / "data" / "synthetic" / "derivatives" / "fmriprep"
+    target_dir = tmp_path_factory.mktemp("bold_dataset") / "fmriprep"
+    func_dir = target_dir / "sub-01" / "ses-01" / "func"
+    func_dir.mkdir(parents=True)
+    for file in ["dataset_description.json", "task-nback_bold.json"]:
+        shutil.copy(src_dir / file, target_dir / file)
+
+    template = nib.load(Path(preprocess.__file__).parent / "masks" / "dme_template.nii")
+    # a coarser resolution keeps the images small
+    template = resample_to_output(template, voxel_sizes=4.0)
+    data = np.asarray(template.dataobj, dtype=np.float32)
+    rng = np.random.default_rng(0)
+    for run in ["01", "02"]:
+        volumes = [
+            data * (1 + 0.01 * rng.standard_normal(data.shape, dtype=np.float32))
+            for _ in range(3)
+        ]
+        nib.save(
+            nib.Nifti1Image(np.stack(volumes, axis=-1), template.affine),
+            func_dir / f"sub-01_ses-01_task-nback_run-{run}_"
+            "space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz",
+        )
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("ANTS_RANDOM_SEED", "1")
+        monkeypatch.setenv("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "1")
+        yield target_dir
+
+
+@pytest.fixture(scope="session")
+def prepared_dataset(tmp_path_factory, bold_dataset) -> Path:
+    """Output of the serial preparation of ``bold_dataset``."""
+    cfg = Config(bold_dataset, tmp_path_factory.mktemp("prepared"), linear_coreg=True)
+    prepare_data(cfg)
+    return cfg.output_dir
+
+
+def assert_same_outputs(output_dir, expected_dir, pattern):
+    """Check that two output datasets have the same files with the same values."""
+    files = sorted(x.relative_to(expected_dir) for x in expected_dir.rglob(pattern))
+    assert files
+    assert sorted(x.relative_to(output_dir) for x in output_dir.rglob(pattern)) == files
+    for file in files:
+        if file.suffix == ".npz":
+            with np.load(output_dir / file) as data, np.load(expected_dir / file) as exp:
+                assert sorted(data) == sorted(exp)
+                for key in exp:
+                    if exp[key].dtype.kind == "f":
+                        np.testing.assert_allclose(
+                            data[key], exp[key], rtol=1e-5, atol=1e-6
+                        )
+                    else:
+                        np.testing.assert_array_equal(data[key], exp[key])
+        elif file.suffix == ".npy":
+            np.testing.assert_allclose(
+                np.load(output_dir / file),
+                np.load(expected_dir / file),
+                rtol=1e-5,
+                atol=1e-6,
+            )
+        elif file.suffix == ".tsv":
+            pd.testing.assert_frame_equal(
+                pd.read_csv(output_dir / file, sep="\t"),
+                pd.read_csv(expected_dir / file, sep="\t"),
+                rtol=1e-5,
+            )
+        elif file.suffix == ".json":
+            assert json.loads((output_dir / file).read_text()) == json.loads(
+                (expected_dir / file).read_text()
+            )
+
+
 @pytest.fixture
 def output_dir(tmp_path, data_dir) -> Path:
     src_dir = data_dir / "bidsmreye"
@@ -40,6 +129,47 @@ def bidsmreye_eyetrack_tsv(output_dir):
     )
 
 
+@pytest.fixture
+def save_timeseries():
+    """Return a function saving an extracted timeseries like deepMReye does.
+
+    Each volume is filled with its index,
+    or with random values if a random generator is given.
+    """
+
+    def _save_timeseries(file, nb_volumes, rng=None, shape=(47, 29, 18), save=np.savez):
+        content = {}
+        for i in range(nb_volumes):
+            content[f"data_{i}"] = (
+                np.full(shape, i, dtype=np.float32)
+                if rng is None
+                else rng.standard_normal(shape, dtype=np.float32)
+            )
+            content[f"label_{i}"] = np.zeros((10, 2))
+            content[f"identifier_{i}"] = np.zeros(2)
+        save(file, **content)
+        return str(file)
+
+    return _save_timeseries
+
+
+@pytest.fixture
+def small_model_weights(tmp_path, monkeypatch) -> Path:
+    """Save the weights of an untrained model for the volumes of deepMReye.
+
+    It has the same architecture as the pretrained models but with smaller
+    dense layers, to keep building and converting it fast:
+    the options of deepMReye are patched so bidsmreye builds the same model.
+    """
+    opts = model_opts.get_opts()
+    opts["num_fc"] = 32
+    monkeypatch.setattr(model_opts, "get_opts", lambda: dict(opts))
+    _, model = architecture.create_standard_model((47, 29, 18, 1), opts)
+    model_weights_file = tmp_path / "model.h5"
+    model.save_weights(model_weights_file)
+    return model_weights_file
+
+
 @pytest.fixture
 def create_basic_data():
     return {
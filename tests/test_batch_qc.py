@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+from bidsmreye.batch_qc import (
+    GAZE_DENSITY_EDGES,
+    QC_COLUMNS,
+    QC_METRICS,
+    batch_quality_control,
+    carling_outliers,
+    compute_displacement,
+    gaze_density,
+    stack_runs,
+    summarize_runs,
+)
+from bidsmreye.quality_control import compute_robust_outliers
+
+
+def random_runs(nb_runs=5):
+    rng = np.random.default_rng(0)
+    runs = []
+    for i in range(nb_runs):
+        x = rng.standard_normal(20 + 7 * i)
+        x[rng.integers(0, len(x))] = 10
+        x[rng.random(len(x)) < 0.1] = np.nan
+        runs.append(x)
+    return runs
+
+
+def test_stack_runs():
+    stacked = stack_runs([[1, 2, 3], [4]])
+
+    assert stacked.shape == (2, 3)
+    assert np.array_equal(stacked, [[1, 2, 3], [4, np.nan, np.nan]], equal_nan=True)
+    assert stack_runs([]).shape == (0, 0)
+
+
+def test_compute_displacement():
+    x = pd.Series([0.0, 3.0, 3.0, np.nan])
+    y = pd.Series([0.0, 4.0, 5.0, 1.0])
+
+    displacement = compute_displacement(
+        x.to_numpy()[np.newaxis], y.to_numpy()[np.newaxis]
+    )
+
+    expected = np.sqrt(x.diff() ** 2 + y.diff() ** 2)
+    assert np.array_equal(displacement[0], expected, equal_nan=True)
+
+
+def test_carling_outliers():
+    runs = random_runs()
+
+    outliers = carling_outliers(stack_runs(runs))
+
+    for i, x in enumerate(runs):
+        assert outliers[i, : len(x)].tolist() == compute_robust_outliers(
+            pd.Series(x), outlier_type="Carling"
+        )
+        assert not outliers[i, len(x) :].any()
+
+
+def test_carling_outliers_short_run():
+    outliers = carling_outliers(stack_runs([[1.0, 2.0, 100.0], []]))
+
+    assert not outliers.any()
+
+
+def test_batch_quality_control():
+    runs = random_runs()
+    x = stack_runs(runs)
+    y = stack_runs([x[::-1] for x in runs])
+
+    columns = batch_quality_control(x, y)
+    metrics = summarize_runs(x, y, columns)
+
+    assert set(columns) == set(QC_COLUMNS)
+    assert set(metrics) == set(QC_METRICS)
+    for key in QC_COLUMNS:
+        assert columns[key].shape == x.shape
+    for i, run in enumerate(runs):
+        assert metrics["NbXOutliers"][i] == sum(
+            compute_robust_outliers(pd.Series(run), outlier_type="Carling")
+        )
+        assert np.isclose(metrics["XVar"][i], pd.Series(run).var(), rtol=1e-12)
+
+
+def test_gaze_density():
+    runs = random_runs()
+    x = stack_runs(runs)
+    y = stack_runs([x[::-1] for x in runs])
+
+    density = gaze_density(x, y)
+
+    assert density.shape == (len(runs), 120, 120)
+    for i in range(len(runs)):
+        valid = ~(np.isnan(x[i]) | np.isnan(y[i]))
+        expected, _, _ = np.histogram2d(
+            x[i][valid], y[i][valid], bins=[GAZE_DENSITY_EDGES, GAZE_DENSITY_EDGES]
+        )
+        assert np.array_equal(density[i], expected)
+
+
+def test_gaze_density_outside_of_the_grid():
+    density = gaze_density(np.array([[-100.0, 100.0, 30.0]]), np.zeros((1, 3)))
+
+    assert density.sum() == 3
+    assert density[0, 0].sum() == 1
+    assert density[0, -1].sum() == 2
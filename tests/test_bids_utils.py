@@ -11,10 +11,14 @@ from bidsmreye.bids_utils import (
     create_bidsname,
     get_dataset_layout,
     init_dataset,
+    list_images,
+    list_shard_keys,
     list_subjects,
+    save_sampling_frequency_to_json,
+    select_shard,
+    shard_key,
 )
 from bidsmreye.configuration import Config
-from bidsmreye.prepare_data import save_sampling_frequency_to_json
 from bidsmreye.utils import set_this_filter
 
 
@@ -40,7 +44,7 @@ def test_create_bidsname(tmp_path):
         == Path("sub-01")
         / "ses-01"
         / "func"
-        / "sub-01_ses-01_task-motion_run-01_desc-eye_mask.p"
+        / "sub-01_ses-01_task-motion_run-01_desc-eye_mask.npy"
     )
 
 
@@ -71,6 +75,36 @@ def test_list_subjects(data_dir, pybids_test_dataset):
     assert len(subjects) == 5
 
 
+@pytest.mark.parametrize("session_reference", [False, True])
+def test_select_shard(data_dir, pybids_test_dataset, session_reference):
+    layout = get_dataset_layout(pybids_test_dataset)
+
+    cfg = Config(pybids_test_dataset, data_dir, session_reference=session_reference)
+    images = [
+        x.path
+        for subject_label in list_subjects(cfg, layout)
+        for x in list_images(cfg, layout, subject_label)
+    ]
+    assert select_shard(cfg, layout, images) == images
+    assert list_shard_keys(cfg, layout, cfg.subjects) is None
+
+    shards = []
+    for index in range(3):
+        cfg.shard = (index, 3)
+        shards.append(select_shard(cfg, layout, images))
+        assert list_shard_keys(cfg, layout, cfg.subjects) == {
+            shard_key(cfg, layout, x) for x in shards[-1]
+        }
+
+    # disjoint slices covering all the images
+    assert sorted(x for shard in shards for x in shard) == sorted(images)
+    # all the images of a work unit end up in the same shard
+    keys = [{shard_key(cfg, layout, x) for x in shard} for shard in shards]
+    assert not keys[0] & keys[1] and not keys[0] & keys[2] and not keys[1] & keys[2]
+    # balanced number of work units
+    assert max(len(x) for x in keys) - min(len(x) for x in keys) <= 1
+
+
 def test_save_sampling_frequency_to_json(data_dir, pybids_test_dataset):
     layout_in = get_dataset_layout(pybids_test_dataset)
 
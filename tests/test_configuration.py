@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import logging
+import os
+
 import pytest
 
 from bidsmreye.configuration import (
@@ -25,6 +28,108 @@ def test_Config(data_dir, pybids_test_dataset):
     assert sorted(cfg.space) == ["MNI152NLin2009cAsym", "T1w"]
 
 
+def test_Config_n_jobs(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir)
+    assert cfg.n_jobs == 1
+
+    cfg = Config(pybids_test_dataset, data_dir, n_jobs=-1)
+    assert cfg.n_jobs >= 1
+
+
+def test_Config_nthreads(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir)
+    assert cfg.nthreads >= 1
+    assert cfg.omp_nthreads == cfg.nthreads
+
+    cfg = Config(pybids_test_dataset, data_dir, nthreads=8, n_jobs=3)
+    assert cfg.omp_nthreads == 2
+
+    cfg = Config(pybids_test_dataset, data_dir, nthreads=2, n_jobs=4)
+    assert cfg.n_jobs == 2
+    assert cfg.omp_nthreads == 1
+
+    cfg = Config(pybids_test_dataset, data_dir, nthreads=4, n_jobs=-1)
+    assert cfg.n_jobs == 4
+
+
+def test_Config_nthreads_warning(data_dir, pybids_test_dataset, caplog):
+    with caplog.at_level(logging.WARNING, logger="bidsmreye"):
+        cfg = Config(pybids_test_dataset, data_dir, nthreads=3, n_jobs=4)
+    assert cfg.n_jobs == 3
+    assert "Running 3 parallel jobs instead of 4" in caplog.text
+
+
+def test_Config_list_model_weights_files(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir)
+    assert cfg.list_model_weights_files() == []
+
+    cfg = Config(pybids_test_dataset, data_dir, model_weights_file="1to6")
+    assert cfg.list_model_weights_files() == ["1to6"]
+
+    cfg = Config(
+        pybids_test_dataset,
+        data_dir,
+        model_weights_file=["1to6", "5_free_viewing", "1to6"],
+    )
+    assert cfg.list_model_weights_files() == ["1to6", "5_free_viewing"]
+
+
+def test_Config_inference_options(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir)
+    assert cfg.onednn
+    assert not cfg.bfloat16
+
+    cfg = Config(
+        pybids_test_dataset,
+        data_dir,
+        onednn=False,
+        bfloat16=True,
+        inter_op_threads=3,
+    )
+    assert not cfg.bfloat16
+
+
+def test_Config_does_not_change_environment(data_dir, pybids_test_dataset):
+    environment = {
+        key: value for key, value in os.environ.items() if key != "CUDA_VISIBLE_DEVICES"
+    }
+
+    Config(pybids_test_dataset, data_dir, nthreads=2, onednn=False, inter_op_threads=3)
+
+    assert {
+        key: value for key, value in os.environ.items() if key != "CUDA_VISIBLE_DEVICES"
+    } == environment
+
+
+def test_Config_quantization_report(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir, quantization_report=True)
+    assert not cfg.quantization_report
+
+    cfg = Config(
+        pybids_test_dataset, data_dir, backend="onnx_int8", quantization_report=True
+    )
+    assert cfg.quantization_report
+
+
+def test_Config_backend_error(data_dir, pybids_test_dataset):
+    with pytest.raises(ValueError):
+        Config(pybids_test_dataset, data_dir, backend="torch")
+
+
+def test_Config_shard(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir)
+    assert cfg.shard is None
+
+    cfg = Config(pybids_test_dataset, data_dir, shard="1/3")
+    assert cfg.shard == (1, 3)
+
+
+@pytest.mark.parametrize("shard", ["3/3", "-1/3", "1/0", "1", "a/b"])
+def test_Config_shard_error(data_dir, pybids_test_dataset, shard):
+    with pytest.raises(ValueError, match="shard"):
+        Config(pybids_test_dataset, data_dir, shard=shard)
+
+
 def test_config_to_dict_smoke(data_dir, pybids_test_dataset):
     cfg = Config(
         pybids_test_dataset,
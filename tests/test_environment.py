@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from bidsmreye.environment import (
+    THREAD_ENV_VARIABLES,
+    set_environment,
+    set_tensorflow_env,
+    set_thread_env,
+    thread_budget,
+)
+
+TF_ENV_VARIABLES = ("TF_ENABLE_ONEDNN_OPTS", "TF_NUM_INTEROP_THREADS")
+
+
+@pytest.fixture
+def clean_environment(monkeypatch):
+    for variable in (*THREAD_ENV_VARIABLES, *TF_ENV_VARIABLES):
+        monkeypatch.delenv(variable, raising=False)
+    return monkeypatch
+
+
+def test_thread_budget():
+    assert thread_budget(8, 3, 0) == (8, 3, 2)
+    assert thread_budget(2, 4, 0) == (2, 2, 1)
+    assert thread_budget(4, -1, 0) == (4, 4, 1)
+    assert thread_budget(4, 2, 4) == (4, 2, 4)
+    assert thread_budget(0, 1, 0)[0] >= 1
+
+
+def test_set_thread_env(clean_environment):
+    clean_environment.setenv("OMP_NUM_THREADS", "3")
+
+    set_thread_env(2)
+
+    assert os.environ["OMP_NUM_THREADS"] == "3"
+    assert os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] == "2"
+    assert os.environ["TF_NUM_INTRAOP_THREADS"] == "2"
+    assert os.environ["TF_NUM_INTEROP_THREADS"] == "2"
+
+    set_thread_env(1, override=True)
+
+    assert os.environ["OMP_NUM_THREADS"] == "1"
+
+
+def test_set_tensorflow_env(clean_environment):
+    set_tensorflow_env()
+
+    assert not any(x in os.environ for x in TF_ENV_VARIABLES)
+
+    set_tensorflow_env(onednn=False, inter_op_threads=3)
+
+    assert os.environ["TF_ENABLE_ONEDNN_OPTS"] == "0"
+    assert os.environ["TF_NUM_INTEROP_THREADS"] == "3"
+
+
+def test_set_environment(clean_environment):
+    set_environment()
+
+    assert not any(x in os.environ for x in (*THREAD_ENV_VARIABLES, *TF_ENV_VARIABLES))
+
+    set_environment(nthreads=8, n_jobs=4, inter_op_threads=1)
+
+    assert all(os.environ[x] == "2" for x in THREAD_ENV_VARIABLES)
+    assert os.environ["TF_NUM_INTEROP_THREADS"] == "1"
+
+
+def test_set_environment_keeps_user_variables(clean_environment):
+    clean_environment.setenv("OMP_NUM_THREADS", "5")
+    clean_environment.setenv("TF_ENABLE_ONEDNN_OPTS", "1")
+
+    set_environment(omp_nthreads=2, onednn=False)
+
+    assert os.environ["OMP_NUM_THREADS"] == "5"
+    assert os.environ["TF_ENABLE_ONEDNN_OPTS"] == "1"
+    assert os.environ["MKL_NUM_THREADS"] == "2"
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from unittest import mock
+
+from bidsmreye import fingerprint
+from bidsmreye.configuration import Config
+from bidsmreye.fingerprint import fingerprint_file, is_up_to_date, save_fingerprint
+
+
+def _touch(file, content):
+    file.write_text(content)
+    stat = file.stat()
+    # make sure the modification time changes even on coarse file systems
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_is_up_to_date(tmp_path, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, tmp_path)
+
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("foo")
+    output_file = tmp_path / "output.txt"
+
+    assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
+
+    output_file.write_text("bar")
+    assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
+
+    save_fingerprint(cfg, "generalize", [input_file], output_file)
+    assert fingerprint_file(output_file).exists()
+    assert is_up_to_date(cfg, "generalize", [input_file], [output_file])
+
+    # touched but same content
+    _touch(input_file, "foo")
+    assert is_up_to_date(cfg, "generalize", [input_file], [output_file])
+
+    # other step or options
+    assert not is_up_to_date(cfg, "quality_control", [input_file], [output_file])
+    cfg.bfloat16 = True
+    assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
+    cfg.bfloat16 = False
+    cfg.xla = True
+    assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
+    cfg.xla = False
+
+    cfg.force = True
+    assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
+    cfg.force = False
+
+    _touch(input_file, "baz")
+    assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
+
+
+def test_is_up_to_date_touched_hashed_once(tmp_path, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, tmp_path)
+
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("foo")
+    output_file = tmp_path / "output.txt"
+    output_file.write_text("bar")
+    save_fingerprint(cfg, "generalize", [input_file], output_file)
+
+    _touch(input_file, "foo")
+    with mock.patch.object(
+        fingerprint, "hash_file", wraps=fingerprint.hash_file
+    ) as hash_file:
+        assert is_up_to_date(cfg, "generalize", [input_file], [output_file])
+        assert is_up_to_date(cfg, "generalize", [input_file], [output_file])
+    assert hash_file.call_count == 1
+
+    saved = json.loads(fingerprint_file(output_file).read_text())
+    assert saved["inputs"][str(input_file)]["mtime_ns"] == input_file.stat().st_mtime_ns
+
+
+def test_is_up_to_date_unhashed_step(tmp_path, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, tmp_path)
+
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("foo")
+    output_file = tmp_path / "output.txt"
+    output_file.write_text("bar")
+    save_fingerprint(cfg, "prepare", [input_file], output_file)
+
+    saved = json.loads(fingerprint_file(output_file).read_text())
+    assert "sha256" not in saved["inputs"][str(input_file)]
+    assert is_up_to_date(cfg, "prepare", [input_file], [output_file])
+
+    _touch(input_file, "foo")
+    assert not is_up_to_date(cfg, "prepare", [input_file], [output_file])
+
+
+def test_is_up_to_date_logs_reason(tmp_path, pybids_test_dataset, caplog):
+    cfg = Config(pybids_test_dataset, tmp_path)
+
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("foo")
+    output_file = tmp_path / "output.txt"
+    output_file.write_text("bar")
+    other_output = tmp_path / "other_output.txt"
+
+    with caplog.at_level(logging.WARNING, logger="bidsmreye"):
+        assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
+        assert "no fingerprint" in caplog.text
+
+        assert not is_up_to_date(
+            cfg, "generalize", [input_file], [output_file, other_output]
+        )
+        assert "missing ['other_output.txt']" in caplog.text
+
+        save_fingerprint(cfg, "generalize", [input_file], output_file)
+        _touch(input_file, "baz")
+        assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
+        assert "input.txt changed" in caplog.text
+
+
+def test_is_up_to_date_inputs_changed(tmp_path, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, tmp_path)
+
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("foo")
+    other_input = tmp_path / "other_input.txt"
+    other_input.write_text("foo")
+    output_file = tmp_path / "output.txt"
+    output_file.write_text("bar")
+
+    save_fingerprint(cfg, "generalize", [input_file], output_file)
+
+    assert not is_up_to_date(cfg, "generalize", [input_file, other_input], [output_file])
+
+    input_file.unlink()
+    assert not is_up_to_date(cfg, "generalize", [input_file], [output_file])
@@ -2,8 +2,24 @@ from __future__ import annotations
 
 import json
 
+import numpy as np
+from deepmreye import train
+from deepmreye.util import data_generator, model_opts
+
 from bidsmreye.bids_utils import get_dataset_layout
-from bidsmreye.generalize import convert_confounds
+from bidsmreye.configuration import Config
+from bidsmreye.generalize import (
+    CALIBRATION_RUNS,
+    QUANTIZED_MODELS_DIR,
+    batch_volumes,
+    calibration_runs,
+    convert_confounds,
+    input_shape,
+    load_model,
+    model_files,
+    predict_runs,
+)
+from bidsmreye.onnx_backend import onnx_model_file
 
 
 def test_convert_confounds(output_dir):
@@ -19,6 +35,149 @@ def test_convert_confounds(output_dir):
     with open(file.with_suffix(".json"), "w") as f:
         json.dump({"SamplingFrequency": 2.0}, f)
 
-    confound_name = convert_confounds(layout_out, file)
+    content = np.load(file, allow_pickle=True).item(0)
+    pred_y = next(iter(content.values()))["pred_y"]
+
+    confound_name = convert_confounds(layout_out, file, pred_y)
 
     assert confound_name.is_file()
+
+
+def test_input_shape(tmp_path):
+    file = tmp_path / "sub-01_desc-eye_timeseries.npz"
+    np.savez(file, data_0=np.zeros((47, 29, 18)), data_1=np.zeros((47, 29, 18)))
+
+    assert input_shape(file) == (47, 29, 18, 1)
+
+
+def test_batch_volumes(tmp_path, save_timeseries):
+    files = [
+        save_timeseries(tmp_path / f"run-{i}_timeseries.npz", nb_volumes)
+        for i, nb_volumes in enumerate([5, 2, 7])
+    ]
+
+    batches = list(batch_volumes(files, batch_size=4))
+
+    assert [sum(len(x) for _, x, _ in batch) for batch in batches] == [4, 4, 4, 2]
+    assert [(file, len(x), is_last) for file, x, is_last in batches[1]] == [
+        (files[0], 1, True),
+        (files[1], 2, True),
+        (files[2], 1, False),
+    ]
+
+
+def test_calibration_runs(tmp_path):
+    files = [
+        str(tmp_path / f"sub-{sub}" / "func" / f"sub-{sub}_task-rest_run-{run}.npz")
+        for sub in ["02", "01"]
+        for run in ["2", "1", "3"]
+    ]
+
+    calibration = calibration_runs(files)
+
+    assert len(calibration) == CALIBRATION_RUNS
+    assert calibration == sorted(files)[:CALIBRATION_RUNS]
+    assert calibration_runs(files[::-1]) == calibration
+
+
+def test_model_files(tmp_path, pybids_test_dataset, save_timeseries):
+    files = [
+        save_timeseries(tmp_path / f"sub-01_run-{i}_desc-eye_timeseries.npz", 2)
+        for i in range(1, 7)
+    ]
+    models = {"1to6": tmp_path / "dataset_1to6.h5"}
+    onnx_file = onnx_model_file(models["1to6"], input_shape(files[0]))
+
+    cfg = Config(pybids_test_dataset, tmp_path)
+    assert model_files(cfg, models, files) == {"1to6": [models["1to6"]]}
+
+    cfg = Config(pybids_test_dataset, tmp_path, backend="onnx")
+    assert model_files(cfg, models, files) == {"1to6": [models["1to6"], onnx_file]}
+
+    cfg = Config(pybids_test_dataset, tmp_path, backend="onnx_int8")
+    weights, quantized_file = model_files(cfg, models, files)["1to6"]
+    assert quantized_file.parent == cfg.output_dir / QUANTIZED_MODELS_DIR
+    # only depends on the calibration runs
+    assert model_files(cfg, models, files[:CALIBRATION_RUNS])["1to6"][1] == quantized_file
+    assert model_files(cfg, models, files[1:])["1to6"][1] != quantized_file
+
+    cfg = Config(
+        pybids_test_dataset, tmp_path, backend="onnx_int8", quantization_report=True
+    )
+    assert model_files(cfg, models, files)["1to6"] == [weights, quantized_file, onnx_file]
+
+
+class _Model:
+    """Predicts the value of the first voxel of each volume, times a factor."""
+
+    def __init__(self, factor=1):
+        self.factor = factor
+
+    def predict_on_batch(self, X):
+        values = X[:, 0, 0, 0, 0] * self.factor
+        return np.stack([values, values], axis=-1)[:, None, :], values
+
+
+def test_predict_runs(tmp_path, save_timeseries):
+    files = [
+        save_timeseries(tmp_path / f"run-{i}_timeseries.npz", nb_volumes)
+        for i, nb_volumes in enumerate([5, 2, 7])
+    ]
+
+    predictions = dict(predict_runs({"1to6": _Model()}, files, batch_size=4))
+
+    assert list(predictions) == files
+    for file, nb_volumes in zip(files, [5, 2, 7]):
+        assert predictions[file]["1to6"]["pred_y"].shape == (nb_volumes, 1, 2)
+        np.testing.assert_array_equal(
+            predictions[file]["1to6"]["euc_pred"], np.arange(nb_volumes)
+        )
+
+
+def test_predict_runs_several_models(tmp_path, save_timeseries):
+    files = [
+        save_timeseries(tmp_path / f"run-{i}_timeseries.npz", nb_volumes)
+        for i, nb_volumes in enumerate([5, 2, 7])
+    ]
+
+    models = {"1to6": _Model(), "FreeViewing": _Model(factor=2)}
+    predictions = dict(predict_runs(models, files, batch_size=4))
+
+    assert list(predictions) == files
+    for file, nb_volumes in zip(files, [5, 2, 7]):
+        assert list(predictions[file]) == ["1to6", "FreeViewing"]
+        np.testing.assert_array_equal(
+            predictions[file]["FreeViewing"]["euc_pred"], 2 * np.arange(nb_volumes)
+        )
+
+
+def test_predict_runs_matches_deepmreye(tmp_path, save_timeseries, small_model_weights):
+    # more volumes than in a batch of predict_runs
+    file = save_timeseries(
+        tmp_path / "run-1_timeseries.npz", 70, np.random.default_rng(0)
+    )
+    shape = input_shape(file)
+
+    # how bidsmreye used to predict, with the untrained model of deepMReye
+    # (first, as it clears the TensorFlow session)
+    generators = data_generator.create_generators([file], [file])
+    generators = (*generators, [file], [file])
+    _, model_inference = train.train_model(
+        dataset="tmp",
+        generators=generators,
+        opts=model_opts.get_opts(),
+        return_untrained=True,
+    )
+    model_inference.load_weights(small_model_weights)
+    evaluation, _ = train.evaluate_model(
+        dataset="tmp", model=model_inference, generators=generators, percentile_cut=80
+    )
+
+    predictions = dict(
+        predict_runs({"1to6": load_model(small_model_weights, shape)}, [file])
+    )
+
+    for key in ["pred_y", "euc_pred"]:
+        np.testing.assert_allclose(
+            predictions[file]["1to6"][key], evaluation[file][key], rtol=1e-4, atol=1e-5
+        )
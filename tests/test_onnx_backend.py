@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from bidsmreye.generalize import load_model
+from bidsmreye.onnx_backend import (
+    ONNX_TOLERANCE,
+    OnnxModel,
+    calibration_volumes,
+    compare_gaze,
+    convert_to_onnx,
+    onnx_model_file,
+    quantize_onnx_model,
+    quantized_model_file,
+)
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("tf2onnx")
+
+
+# shape of the volumes extracted by deepMReye, with a channel dimension
+INPUT_SHAPE = (47, 29, 18, 1)
+
+
+def test_onnx_model_file():
+    assert (
+        onnx_model_file(Path("models") / "dataset_1to6.h5", (47, 29, 18, 1))
+        == Path("models") / "dataset_1to6_47x29x18.onnx"
+    )
+
+
+def test_quantized_model_file():
+    onnx_file = Path("models") / "dataset_1to6_47x29x18.onnx"
+    models_dir = Path("bidsmreye") / "models"
+    files = ["sub-01/func/sub-01_run-1.npz", "sub-01/func/sub-01_run-2.npz"]
+
+    quantized_file = quantized_model_file(onnx_file, models_dir, files)
+
+    assert quantized_file.parent == models_dir
+    assert quantized_file.name.startswith("dataset_1to6_47x29x18_int8-")
+    assert quantized_model_file(onnx_file, models_dir, files[::-1]) == quantized_file
+    assert quantized_model_file(onnx_file, models_dir, files[:1]) != quantized_file
+
+
+def test_convert_to_onnx(tmp_path, small_model_weights):
+    model = load_model(small_model_weights, INPUT_SHAPE)
+
+    onnx_file = convert_to_onnx(model, INPUT_SHAPE, tmp_path / "model.onnx")
+
+    assert onnx_file.is_file()
+    assert not list(tmp_path.glob(".tmp-*"))
+
+    X = np.random.default_rng(0).standard_normal((5, *INPUT_SHAPE), dtype=np.float32)
+    expected = model.predict_on_batch(X)
+    predictions = OnnxModel(onnx_file).predict_on_batch(X)
+
+    assert len(predictions) == len(expected)
+    for prediction, value in zip(predictions, expected):
+        assert prediction.shape == value.shape
+        np.testing.assert_allclose(prediction, value, atol=ONNX_TOLERANCE, rtol=0)
+
+
+def test_calibration_volumes(tmp_path, save_timeseries):
+    rng = np.random.default_rng(0)
+    files = [
+        save_timeseries(tmp_path / f"run-{i}_desc-eye_timeseries.npz", 10, rng)
+        for i in range(3)
+    ]
+
+    X = calibration_volumes(files, nb_volumes=8)
+
+    assert X.shape == (8, 47, 29, 18, 1)
+    assert X.dtype == np.float32
+
+
+def test_quantize_onnx_model(tmp_path, save_timeseries, small_model_weights):
+    model = load_model(small_model_weights, INPUT_SHAPE)
+    onnx_file = convert_to_onnx(model, INPUT_SHAPE, tmp_path / "model.onnx")
+    rng = np.random.default_rng(0)
+    files = [
+        save_timeseries(tmp_path / f"run-{i}_desc-eye_timeseries.npz", 8, rng)
+        for i in range(2)
+    ]
+
+    quantized_file = quantize_onnx_model(
+        onnx_file, tmp_path / "model_int8.onnx", files, nb_volumes=8
+    )
+
+    assert quantized_file.is_file()
+    assert quantized_file.stat().st_size < onnx_file.stat().st_size
+    assert not list(tmp_path.glob(".tmp-*"))
+
+    X = rng.standard_normal((5, *INPUT_SHAPE), dtype=np.float32)
+    expected = OnnxModel(onnx_file).predict_on_batch(X)
+    predictions = OnnxModel(quantized_file).predict_on_batch(X)
+    for prediction, value in zip(predictions, expected):
+        assert prediction.shape == value.shape
+        assert np.isfinite(prediction).all()
+
+
+def test_compare_gaze():
+    rng = np.random.default_rng(0)
+    reference = rng.standard_normal((20, 10, 2))
+
+    comparison = compare_gaze(reference, reference)
+
+    assert comparison["XCorrelation"] == pytest.approx(1)
+    assert comparison["YCorrelation"] == pytest.approx(1)
+    assert comparison["XRMSE"] == pytest.approx(0)
+    assert comparison["YRMSE"] == pytest.approx(0)
+
+    comparison = compare_gaze(reference, reference + 0.5)
+
+    assert comparison["XCorrelation"] == pytest.approx(1)
+    assert comparison["XRMSE"] == pytest.approx(0.5)
+
+
+def test_compare_gaze_constant():
+    reference = np.zeros((20, 10, 2))
+
+    comparison = compare_gaze(reference, reference)
+
+    assert comparison["XCorrelation"] is None
+    assert comparison["XRMSE"] == pytest.approx(0)
+    # valid JSON for the sidecars
+    json.dumps(comparison, allow_nan=False)
+
+    comparison = compare_gaze(np.full((3, 10, 2), np.nan), reference[:3])
+
+    assert comparison["YRMSE"] is None
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from pathlib import Path
+
 from bidsmreye._parsers import common_parser, download_parser
 
 
@@ -44,6 +46,157 @@ def test_parser_basic() -> None:
 
     assert args.task == ["foo", "bar"]
     assert args.linear_coreg is False
+    assert args.n_jobs == 1
+    assert args.session_reference is False
+    assert args.eye_slab is False
+    assert args.shard is None
+    assert args.nthreads == 0
+    assert args.omp_nthreads == 0
+
+
+def test_parser_n_jobs() -> None:
+    parser = common_parser()
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "all", "--n_jobs", "4"]
+    )
+
+    assert args.n_jobs == 4
+
+
+def test_parser_generalize() -> None:
+    parser = common_parser()
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "generalize"]
+    )
+
+    assert args.batch_size == 64
+
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "all", "--batch_size", "8"]
+    )
+
+    assert args.batch_size == 8
+
+
+def test_parser_inference_options() -> None:
+    parser = common_parser()
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "generalize"]
+    )
+
+    assert args.inter_op_threads == 0
+    assert not args.no_onednn
+    assert not args.xla
+    assert not args.bfloat16
+    assert args.backend == "tensorflow"
+    assert not args.quantization_report
+
+    args, _ = parser.parse_known_args(
+        [
+            "/path/to/bids",
+            "/path/to/output",
+            "participant",
+            "all",
+            "--inter_op_threads",
+            "1",
+            "--no_onednn",
+            "--xla",
+            "--bfloat16",
+            "--backend",
+            "onnx_int8",
+            "--quantization_report",
+        ]
+    )
+
+    assert args.inter_op_threads == 1
+    assert args.no_onednn
+    assert args.xla
+    assert args.bfloat16
+    assert args.backend == "onnx_int8"
+    assert args.quantization_report
+
+
+def test_parser_pipeline() -> None:
+    parser = common_parser()
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "all"]
+    )
+    assert not args.pipeline
+
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "all", "--pipeline"]
+    )
+    assert args.pipeline
+
+
+def test_parser_serve() -> None:
+    parser = common_parser()
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "serve", "--xla"]
+    )
+    assert args.command == "serve"
+    assert args.socket is None
+    assert args.xla
+
+    args, _ = parser.parse_known_args(
+        [
+            "/path/to/bids",
+            "/path/to/output",
+            "participant",
+            "generalize",
+            "--socket",
+            "/tmp/bidsmreye.sock",
+        ]
+    )
+    assert args.socket == Path("/tmp/bidsmreye.sock")
+
+
+def test_parser_shared_plotlyjs() -> None:
+    parser = common_parser()
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "generalize"]
+    )
+    assert not args.shared_plotlyjs
+
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "group", "qc", "--shared_plotlyjs"]
+    )
+    assert args.shared_plotlyjs
+
+
+def test_parser_several_models() -> None:
+    parser = common_parser()
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "generalize"]
+    )
+
+    assert args.model == ["1to6"]
+    assert not args.ensemble
+
+    args, _ = parser.parse_known_args(
+        [
+            "/path/to/bids",
+            "/path/to/output",
+            "participant",
+            "generalize",
+            "--model",
+            "1to6",
+            "5_free_viewing",
+            "--ensemble",
+        ]
+    )
+
+    assert args.model == ["1to6", "5_free_viewing"]
+    assert args.ensemble
+
+
+def test_parser_shard() -> None:
+    parser = common_parser()
+    args, _ = parser.parse_known_args(
+        ["/path/to/bids", "/path/to/output", "participant", "all", "--shard", "1/4"]
+    )
+
+    assert args.shard == "1/4"
 
 
 def test_download_parser():
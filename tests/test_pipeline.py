@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import shutil
+from pathlib import Path
+
+import pytest
+
+from bidsmreye import pipeline
+from bidsmreye.bids_utils import create_bidsname, get_dataset_layout
+from bidsmreye.configuration import Config
+from bidsmreye.generalize import CALIBRATION_RUNS, calibration_runs, generalize
+from bidsmreye.pipeline import (
+    list_units,
+    preparation_jobs,
+    prepare_and_generalize,
+)
+
+from .conftest import assert_same_outputs
+
+
+def test_list_units(tmp_path, data_dir, pybids_test_dataset):
+    layout = get_dataset_layout(tmp_path / "derivatives")
+    images = {
+        sub: [
+            f"sub-{sub}/ses-{ses}/func/"
+            f"sub-{sub}_ses-{ses}_task-rest_run-{run}_space-MNI152NLin2009cAsym_bold.nii.gz"
+            for ses in ["01", "02"]
+            for run in ["2", "1"]
+        ]
+        for sub in ["01", "02"]
+    }
+
+    cfg = Config(pybids_test_dataset, data_dir)
+    units = list_units(cfg, layout, images)
+
+    assert [len(x) for x in units.values()] == [4, 4]
+    assert all(len(unit) == 1 for x in units.values() for unit in x)
+
+    cfg = Config(pybids_test_dataset, data_dir, session_reference=True)
+    units = list_units(cfg, layout, images)
+
+    assert [len(x) for x in units.values()] == [2, 2]
+    assert [Path(x).name for x in units["01"][0]] == [
+        "sub-01_ses-01_task-rest_run-1_space-MNI152NLin2009cAsym_bold.nii.gz",
+        "sub-01_ses-01_task-rest_run-2_space-MNI152NLin2009cAsym_bold.nii.gz",
+    ]
+
+
+def test_preparation_jobs(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir, nthreads=4, n_jobs=1)
+    assert preparation_jobs(cfg) == 1
+    cfg = Config(pybids_test_dataset, data_dir, nthreads=4, n_jobs=4)
+    assert preparation_jobs(cfg) == 3
+
+
+def test_prepare_and_generalize_calibration(tmp_path, monkeypatch, pybids_test_dataset):
+    submitted = []
+    prepared = []
+    # runs prepared before the first one is generalized
+    ready = []
+    generalized = []
+    model_runs = []
+
+    def prepare_in_reverse(cfg, layout_in, units, n_jobs, max_pending):
+        submitted.extend(units)
+        for unit in reversed(units):
+            prepared.extend(unit)
+            yield unit, [f"{x}.npz" for x in unit]
+
+    def model_files(cfg, models, files):
+        model_runs.append(files)
+        return {x: [] for x in models}
+
+    def load_models(cfg, models, files):
+        model_runs.append(files)
+        return {}
+
+    def generalize_runs(cfg, layout_out, models_inference, models, runs):
+        if not generalized:
+            ready.extend(prepared)
+        generalized.extend(runs)
+        yield from runs
+
+    monkeypatch.setattr(pipeline, "prepare_units_as_completed", prepare_in_reverse)
+    monkeypatch.setattr(pipeline, "model_files", model_files)
+    monkeypatch.setattr(pipeline, "load_models", load_models)
+    monkeypatch.setattr(pipeline, "generalize_runs", generalize_runs)
+    monkeypatch.setattr(pipeline, "stale_outputs", lambda *args: {"model": []})
+    monkeypatch.setattr(pipeline, "generate_report", lambda **kwargs: None)
+    monkeypatch.setattr(pipeline, "quality_control_output", lambda *args: None)
+
+    cfg = Config(
+        pybids_test_dataset,
+        tmp_path,
+        model_weights_file=tmp_path / "model.h5",
+        subjects=["01"],
+        backend="onnx_int8",
+    )
+    prepare_and_generalize(cfg)
+
+    assert len(generalized) > CALIBRATION_RUNS
+    layout_out = get_dataset_layout(cfg.output_dir)
+    timeseries = {
+        str(create_bidsname(layout_out, Path(x), "no_label_bold")): x for x in prepared
+    }
+    # models of all the runs, so calibrated on the same runs as with generalize
+    assert [sorted(x) for x in model_runs] == [sorted(timeseries)] * 2
+    calibration = {timeseries[x] for x in calibration_runs(list(timeseries))}
+    # the calibration runs are submitted first
+    # and nothing is generalized before they are prepared
+    assert {x for unit in submitted[:CALIBRATION_RUNS] for x in unit} == calibration
+    assert calibration <= set(ready)
+
+
+@pytest.mark.parametrize("backend", ["tensorflow", "onnx_int8"])
+def test_prepare_and_generalize(
+    tmp_path, bold_dataset, prepared_dataset, small_model_weights, backend
+):
+    # prepare then generalize
+    sequential_dir = tmp_path / "sequential"
+    shutil.copytree(prepared_dataset, sequential_dir / "bidsmreye")
+    cfg = Config(
+        bold_dataset,
+        sequential_dir,
+        linear_coreg=True,
+        model_weights_file=small_model_weights,
+        backend=backend,
+    )
+    generalize(cfg)
+
+    cfg = Config(
+        bold_dataset,
+        tmp_path / "pipeline",
+        linear_coreg=True,
+        model_weights_file=small_model_weights,
+        backend=backend,
+        nthreads=3,
+        n_jobs=3,
+        pipeline=True,
+    )
+    prepare_and_generalize(cfg)
+
+    for pattern in ["*_timeseries.npz", "*_eyetrack.tsv", "*_eyetrack.json"]:
+        assert_same_outputs(cfg.output_dir, sequential_dir / "bidsmreye", pattern)
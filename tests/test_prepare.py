@@ -2,8 +2,24 @@ from __future__ import annotations
 
 from pathlib import Path
 
+import ants
+import nibabel as nib
+import numpy as np
+
 from bidsmreye.bids_utils import create_bidsname, get_dataset_layout
-from bidsmreye.prepare_data import combine_data_with_empty_labels
+from bidsmreye.configuration import Config
+from bidsmreye.prepare_data import (
+    combine_data_with_empty_labels,
+    eye_slab_bounds,
+    group_by_session,
+    load_deepmreye_masks,
+    prepare_data,
+    read_eye_slab,
+    session_transform_sidecar,
+)
+from bidsmreye.utils import save_eye_mask
+
+from .conftest import assert_same_outputs
 
 
 def test_combine_data_with_empty_labels(output_dir):
@@ -13,13 +29,97 @@ def test_combine_data_with_empty_labels(output_dir):
         output_dir
         / "sub-01"
         / "func"
-        / "sub-01_task-nback_run-01_space-MNI152NLin2009cAsym_desc-eye_mask.p"
+        / "sub-01_task-nback_run-01_space-MNI152NLin2009cAsym_desc-eye_mask.npy"
     )
+    save_eye_mask(np.random.rand(47, 29, 18, 20) + 1, file)
 
     no_label_file = combine_data_with_empty_labels(layout_out, file)
 
     assert no_label_file.exists()
 
-    output_file = create_bidsname(layout_out, file, "no_label_bold")
-    file_to_move = Path(layout_out.root) / ".." / "bidsmreye" / output_file.name
-    assert no_label_file == file_to_move
+    assert no_label_file == create_bidsname(layout_out, file, "no_label_bold")
+
+
+def test_load_deepmreye_masks_is_cached():
+    load_deepmreye_masks.cache_clear()
+
+    masks = load_deepmreye_masks()
+
+    assert load_deepmreye_masks() is masks
+    assert load_deepmreye_masks.cache_info().hits == 1
+
+
+def test_group_by_session(tmp_path):
+    layout = get_dataset_layout(tmp_path / "derivatives")
+    images = [
+        f"sub-{sub}/ses-{ses}/func/"
+        f"sub-{sub}_ses-{ses}_task-rest_run-{run}_space-MNI152NLin2009cAsym_bold.nii.gz"
+        for sub in ["02", "01"]
+        for ses in ["01", "02"]
+        for run in ["2", "1"]
+    ]
+
+    groups = group_by_session(layout, images)
+
+    assert len(groups) == 4
+    assert [Path(x).name for x in groups[("01", "01", "MNI152NLin2009cAsym")]] == [
+        "sub-01_ses-01_task-rest_run-1_space-MNI152NLin2009cAsym_bold.nii.gz",
+        "sub-01_ses-01_task-rest_run-2_space-MNI152NLin2009cAsym_bold.nii.gz",
+    ]
+
+
+def test_session_transform_sidecar(tmp_path):
+    layout = get_dataset_layout(tmp_path / "derivatives")
+
+    sidecar = session_transform_sidecar(
+        layout,
+        "sub-01/ses-01/func/sub-01_ses-01_task-rest_run-1_space-T1w_bold.nii.gz",
+    )
+    assert sidecar.relative_to(layout.root) == (
+        Path("sub-01")
+        / "ses-01"
+        / "func"
+        / "sub-01_ses-01_from-T1w_to-deepMReye_xfm.json"
+    )
+
+    sidecar = session_transform_sidecar(
+        layout, "sub-01/func/sub-01_task-rest_run-1_bold.nii.gz"
+    )
+    assert sidecar.name == "sub-01_from-boldref_to-deepMReye_xfm.json"
+
+
+def test_read_eye_slab(tmp_path):
+    dme_template = load_deepmreye_masks()[2]
+    template_file = tmp_path / "template.nii.gz"
+    ants.image_write(dme_template, str(template_file))
+    template = nib.load(template_file)
+    data = np.stack([template.get_fdata()] * 3, axis=-1)
+    img = tmp_path / "sub-01_task-rest_space-MNI152NLin2009cAsym_bold.nii"
+    nib.Nifti1Image(data, template.affine).to_filename(img)
+
+    identity = str(tmp_path / "identity.mat")
+    ants.write_transform(ants.new_ants_transform(dimension=3), identity)
+
+    slab = read_eye_slab(str(img), [identity])
+
+    assert slab.dimension == 4
+    assert slab.shape[3] == 3
+    assert np.prod(slab.shape) < data.size
+
+    bounds = eye_slab_bounds(template.affine, data.shape, [identity])
+    assert np.allclose(slab.numpy(), data[bounds])
+    start = [x.start for x in bounds]
+    assert np.allclose(
+        slab.origin[:3],
+        ants.transform_index_to_physical_point(dme_template, start),
+    )
+
+
+def test_prepare_data_in_parallel(tmp_path, bold_dataset, prepared_dataset):
+    cfg = Config(bold_dataset, tmp_path, linear_coreg=True, nthreads=2, n_jobs=2)
+    assert cfg.n_jobs == 2
+
+    prepare_data(cfg)
+
+    for pattern in ["*_timeseries.npz", "*_timeseries.json", "*_mask.npy"]:
+        assert_same_outputs(cfg.output_dir, prepared_dataset, pattern)
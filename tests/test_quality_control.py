@@ -13,6 +13,7 @@ from bidsmreye.quality_control import (
     compute_displacement_and_outliers,
     compute_robust_outliers,
     get_sampling_frequency,
+    median_pairwise_distances,
     perform_quality_control,
     quality_control_input,
     quality_control_output,
@@ -76,6 +77,32 @@ def test_compute_robust_outliers():
     assert outliers == expected_outliers
 
 
+def test_compute_robust_outliers_constant():
+    assert compute_robust_outliers(pd.Series([1.0] * 5)) == [0] * 5
+    assert compute_robust_outliers(pd.Series([1.0, np.nan])) == [0, 0]
+
+
+@pytest.mark.parametrize("nb_values", [2, 3, 20, 51])
+def test_median_pairwise_distances(nb_values):
+    rng = np.random.default_rng(nb_values)
+    # with ties
+    values = rng.integers(0, 5, nb_values).astype(float)
+    values[: nb_values // 2] = rng.standard_normal(nb_values // 2)
+
+    expected = [np.median(np.abs(x - np.delete(values, i))) for i, x in enumerate(values)]
+
+    assert np.array_equal(median_pairwise_distances(values), expected)
+
+
+def test_median_pairwise_distances_rounded():
+    # like eyetracker data: many ties, and sums of values that are rounded
+    values = np.round(np.random.default_rng(0).standard_normal(2000), 2)
+
+    expected = [np.median(np.abs(x - np.delete(values, i))) for i, x in enumerate(values)]
+
+    assert np.array_equal(median_pairwise_distances(values), expected)
+
+
 def test_compute_robust_outliers_carling():
     series = time_series()
     series[8] = 10
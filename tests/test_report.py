@@ -1,6 +1,6 @@
 import pathlib
 
-from bidsmreye.report import generate_report
+from bidsmreye.report import generate_report, plotlyjs_asset, relative_src
 
 
 def test_generate_report(tmp_path):
@@ -14,3 +14,19 @@ def test_generate_report(tmp_path):
 
     assert (output_dir / "sub-01" / "sub-01_prepare.html").exists()
     assert (output_dir / "sub-01" / "sub-01_generalize.html").exists()
+
+
+def test_generate_report_shared_plotlyjs(tmp_path):
+    asset = plotlyjs_asset(tmp_path)
+    figure = tmp_path / "sub-01" / "ses-01" / "figures" / "sub-01_eyetrack.html"
+    figure.parent.mkdir(parents=True)
+    src = relative_src(asset, figure)
+    figure.write_text(f'<div><script charset="utf-8" src="{src}"></script>plot</div>')
+
+    generate_report(output_dir=tmp_path, subject_label="01", action="generalize")
+
+    assert src == f"../../../assets/{asset.name}"
+    report = (tmp_path / "sub-01" / "sub-01_generalize.html").read_text()
+    assert report.count(f"assets/{asset.name}") == 1
+    assert f'src="../assets/{asset.name}"' in report
+    assert "<div>plot</div>" in report
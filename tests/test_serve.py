@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bidsmreye.configuration import Config
+from bidsmreye.serve import (
+    JOB_FILTERS,
+    check_socket,
+    default_socket,
+    job_from_config,
+    serve,
+    submit,
+)
+
+
+@pytest.fixture
+def daemon(tmp_path, data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, tmp_path, model_weights_file=tmp_path / "model.h5")
+    socket_path = tmp_path / "bidsmreye.sock"
+    thread = threading.Thread(target=serve, args=(cfg, socket_path))
+    thread.start()
+    for _ in range(100):
+        if socket_path.exists():
+            break
+        time.sleep(0.1)
+
+    yield socket_path
+
+    # stop the daemon, unless the test already did
+    with contextlib.suppress(ConnectionRefusedError, FileNotFoundError):
+        submit(socket_path, {"stop": True})
+    thread.join(timeout=30)
+    socket_path.unlink(missing_ok=True)
+    assert not thread.is_alive()
+
+
+def test_default_socket(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir)
+    assert default_socket(cfg) == cfg.output_dir / ".bidsmreye.sock"
+
+
+def test_job_from_config(data_dir, pybids_test_dataset):
+    cfg = Config(pybids_test_dataset, data_dir, shard="1/4")
+    job = job_from_config(cfg)
+    assert sorted(job) == sorted(JOB_FILTERS)
+    assert job["shard"] == (1, 4)
+
+
+def test_serve(daemon):
+    with pytest.raises(RuntimeError, match="Unknown job options"):
+        submit(daemon, {"model": "1to6"})
+
+    # a failed job does not stop the daemon
+    with pytest.raises(RuntimeError, match="FileNotFoundError"):
+        submit(daemon, {"files": [str(daemon.parent / "missing.npz")]})
+
+    with pytest.raises(RuntimeError, match="already listening"):
+        check_socket(daemon)
+
+    assert submit(daemon, {"stop": True}) == {"status": "ok"}
+    for _ in range(100):
+        if not daemon.exists():
+            break
+        time.sleep(0.1)
+    assert not daemon.exists()
+
+
+def test_serve_files(daemon, save_timeseries, small_model_weights):
+    func_dir = daemon.parent / "bidsmreye" / "sub-01" / "func"
+    func_dir.mkdir(parents=True)
+    file = save_timeseries(
+        func_dir / "sub-01_task-nback_space-MNI152NLin2009cAsym_desc-eye_timeseries.npz",
+        5,
+        np.random.default_rng(0),
+    )
+    with open(Path(file).with_suffix(".json"), "w") as f:
+        json.dump({"SamplingFrequency": 5.0}, f)
+    assert submit(daemon, {"files": [file]}) == {"status": "ok"}
+
+    outputs = sorted(func_dir.glob("*_eyetrack.tsv"))
+    assert len(outputs) == 1
+    assert len(pd.read_csv(outputs[0], sep="\t")) == 5
+
+
+def test_check_socket_stale(tmp_path):
+    import socket
+
+    socket_path = tmp_path / "bidsmreye.sock"
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(socket_path))
+    sock.close()
+
+    check_socket(socket_path)
+
+    assert not socket_path.exists()
@@ -1,14 +1,28 @@
 from __future__ import annotations
 
+import os
+import pickle
+import threading
+import zipfile
 from pathlib import Path
 
+import numpy as np
+import pytest
+from deepmreye.util import data_generator
+
 from bidsmreye.bids_utils import get_dataset_layout
 from bidsmreye.configuration import Config
 from bidsmreye.utils import (
+    atomic_write,
+    convert_eye_mask,
     copy_license,
     get_deepmreye_filename,
+    load_eye_mask,
+    load_timeseries,
+    move_file,
     return_deepmreye_output_filename,
     return_regex,
+    save_eye_mask,
     set_this_filter,
 )
 
@@ -34,7 +48,7 @@ def test_get_deepmreye_filename(pybids_test_dataset):
         / "func"
         / (
             "mask_sub-01_ses-01_task-nback_run-01_"
-            "space-MNI152NLin2009cAsym_desc-preproc_bold.p"
+            "space-MNI152NLin2009cAsym_desc-preproc_bold.npy"
         )
     )
 
@@ -55,7 +69,7 @@ def test_return_deepmreye_output_filename():
     input_file = "sub-01_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz"
     output_filename = return_deepmreye_output_filename(input_file, "mask")
     expected_output_file = (
-        "mask_sub-01_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.p"
+        "mask_sub-01_task-rest_space-MNI152NLin2009cAsym_desc-preproc_bold.npy"
     )
     assert output_filename == expected_output_file
 
@@ -64,6 +78,89 @@ def test_return_deepmreye_output_filename():
     assert output_filename == expected_output_file
 
 
+def test_save_and_load_eye_mask(tmp_path):
+    data = np.random.rand(5, 4, 3, 25).astype(np.float32)
+    file = tmp_path / "mask.npy"
+
+    save_eye_mask(data, file)
+
+    assert np.load(file).shape == (25, 5, 4, 3)
+
+    loaded = load_eye_mask(file)
+    assert isinstance(loaded.base, np.memmap)
+    assert np.array_equal(loaded, data)
+
+
+def test_convert_eye_mask(tmp_path):
+    data = np.random.rand(5, 4, 3, 25).astype(np.float32)
+    file = tmp_path / "mask.p"
+    with open(file, "wb") as f:
+        pickle.dump(data, f)
+
+    output_file = convert_eye_mask(file)
+
+    assert output_file == tmp_path / "mask.npy"
+    assert not file.exists()
+    assert np.array_equal(load_eye_mask(output_file), data)
+
+
+@pytest.mark.parametrize("save", [np.savez, np.savez_compressed])
+def test_load_timeseries(tmp_path, save_timeseries, save):
+    file = tmp_path / "desc-eye_timeseries.npz"
+    rng = np.random.default_rng(0)
+    save_timeseries(file, 7, rng, shape=(5, 4, 3), save=save)
+
+    volumes = load_timeseries(file)
+
+    X, _ = data_generator.get_all_subject_data(str(file))
+    assert len(volumes) == 7
+    assert np.array_equal(np.stack(volumes)[..., np.newaxis], X)
+    if save is np.savez:
+        assert all(isinstance(x.base, np.memmap) for x in volumes)
+
+
+def test_load_timeseries_empty(tmp_path):
+    file = tmp_path / "desc-eye_timeseries.npz"
+    np.savez(file)
+
+    assert load_timeseries(file) == []
+
+
+def _save_npy_version(file, nb_volumes, version):
+    rng = np.random.default_rng(0)
+    with zipfile.ZipFile(file, "w") as archive:
+        for i in range(nb_volumes):
+            for name, value in [
+                (f"data_{i}", rng.standard_normal((5, 4, 3), dtype=np.float32)),
+                (f"label_{i}", np.zeros((10, 2))),
+            ]:
+                with archive.open(f"{name}.npy", "w") as member:
+                    np.lib.format.write_array(member, value, version=version)
+
+
+@pytest.mark.filterwarnings("ignore:Stored array in format")
+@pytest.mark.parametrize("version", [(2, 0), (3, 0)])
+def test_load_timeseries_npy_version(tmp_path, version):
+    file = tmp_path / "desc-eye_timeseries.npz"
+    _save_npy_version(file, 3, version=version)
+
+    volumes = load_timeseries(file)
+
+    X, _ = data_generator.get_all_subject_data(str(file))
+    assert np.array_equal(np.stack(volumes)[..., np.newaxis], X)
+
+
+def test_load_timeseries_unsupported_npy_version(tmp_path):
+    file = tmp_path / "desc-eye_timeseries.npz"
+    _save_npy_version(file, 3, version=(1, 0))
+    file.write_bytes(
+        file.read_bytes().replace(b"\x93NUMPY\x01\x00", b"\x93NUMPY\x04\x00")
+    )
+
+    with pytest.raises(ValueError, match="Unsupported npy format version 4.0"):
+        load_timeseries(file)
+
+
 def test_return_regex():
     assert return_regex("foo") == "^foo$"
     assert return_regex("^foo") == "^foo$"
@@ -131,3 +228,61 @@ def test_set_this_filter_with_bids_filter_file(output_dir, pybids_test_dataset):
         "suffix": "^eyetrack$$",
         "desc": "preproc",
     }
+
+
+def test_move_file(tmp_path):
+    input_file = tmp_path / "foo.txt"
+    input_file.write_text("foo")
+    output_file = tmp_path / "sub-01" / "bar.txt"
+
+    move_file(input_file, output_file)
+
+    assert not input_file.exists()
+    assert output_file.read_text() == "foo"
+
+
+def test_atomic_write(tmp_path):
+    output_file = tmp_path / "sub-01" / "foo.tsv"
+
+    with atomic_write(output_file) as tmp_file:
+        assert tmp_file.name.endswith("foo.tsv")
+        assert tmp_file.name.startswith(".")
+        tmp_file.write_text("foo")
+        assert not output_file.exists()
+
+    assert output_file.read_text() == "foo"
+
+    # previous version is kept if writing fails
+    with pytest.raises(RuntimeError), atomic_write(output_file) as tmp_file:
+        tmp_file.write_text("ba")
+        raise RuntimeError
+
+    assert output_file.read_text() == "foo"
+    assert list(output_file.parent.iterdir()) == [output_file]
+
+
+def test_atomic_write_threads(tmp_path):
+    output_file = tmp_path / "foo.tsv"
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def write(i):
+        try:
+            with atomic_write(output_file) as tmp_file:
+                barrier.wait()
+                tmp_file.write_text(str(i) * 1000)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert output_file.read_text() in {str(i) * 1000 for i in range(8)}
+    assert list(tmp_path.iterdir()) == [output_file]
+    umask = os.umask(0)
+    os.umask(umask)
+    assert output_file.stat().st_mode & 0o777 == 0o666 & ~umask
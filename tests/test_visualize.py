@@ -3,11 +3,22 @@ from __future__ import annotations
 import json
 import shutil
 
+import numpy as np
 import pandas as pd
+import pytest
 
+from bidsmreye.batch_qc import batch_quality_control
 from bidsmreye.bidsmreye import bidsmreye
 from bidsmreye.configuration import Config
-from bidsmreye.visualize import group_report, visualize_eye_gaze_data
+from bidsmreye.quality_control import quality_control_input
+from bidsmreye.visualize import (
+    MAX_LINE_POINTS,
+    downsample,
+    group_report,
+    largest_triangle_three_buckets,
+    visualize_eye_gaze_data,
+    write_figure,
+)
 
 
 def test_visualize_eye_gaze_data(create_confounds_tsv, bidsmreye_eyetrack_tsv):
@@ -16,6 +27,84 @@ def test_visualize_eye_gaze_data(create_confounds_tsv, bidsmreye_eyetrack_tsv):
     fig.show()
 
 
+@pytest.mark.parametrize("nb_samples", [2, 10, 11, 1000])
+def test_largest_triangle_three_buckets(nb_samples):
+    rng = np.random.default_rng(0)
+    x = np.arange(nb_samples, dtype=float)
+    y = rng.standard_normal(nb_samples)
+
+    index = largest_triangle_three_buckets(x, y, 10)
+
+    assert len(index) == min(nb_samples, 10)
+    assert index[0] == 0
+    assert index[-1] == nb_samples - 1
+    assert np.all(np.diff(index) > 0)
+
+
+def test_largest_triangle_three_buckets_keeps_peaks():
+    y = np.zeros(1000)
+    y[[250, 500, 750]] = [1, -1, 1]
+    y[600:700] = np.nan
+
+    index = largest_triangle_three_buckets(np.arange(1000.0), y, 50)
+
+    assert {250, 500, 750} <= set(index)
+    # the gap is still plotted
+    assert np.isnan(y[index]).any()
+
+
+def test_downsample_keeps_outliers():
+    y = np.random.default_rng(0).standard_normal(10000)
+    keep = np.zeros(10000, dtype=bool)
+    keep[::1000] = True
+
+    index = downsample(np.arange(10000.0), y, keep, max_points=100)
+
+    assert len(index) <= 100 + keep.sum()
+    assert set(np.flatnonzero(keep)) <= set(index)
+
+
+def test_visualize_eye_gaze_data_long_run():
+    rng = np.random.default_rng(0)
+    nb_samples = 100 * MAX_LINE_POINTS
+    x = np.cumsum(rng.standard_normal(nb_samples)) / 100
+    y = np.cumsum(rng.standard_normal(nb_samples)) / 100
+    eye_gaze_data = pd.DataFrame(
+        {
+            "timestamp": np.arange(nb_samples) / 1000,
+            "x_coordinate": x,
+            "y_coordinate": y,
+            **{
+                key: values[0]
+                for key, values in batch_quality_control(x[None], y[None]).items()
+            },
+        }
+    )
+
+    fig = visualize_eye_gaze_data(eye_gaze_data)
+
+    nb_outliers = eye_gaze_data.filter(like="outliers").to_numpy().sum()
+    lines = [x for x in fig.data if x.type == "scatter" and x.mode != "markers"]
+    assert all(len(x.x) <= MAX_LINE_POINTS + nb_outliers for x in lines)
+    # outliers are all plotted
+    markers = [x for x in fig.data if x.type == "scatter" and x.mode == "markers"]
+    assert len(markers[0].x) == eye_gaze_data["x_outliers"].sum()
+
+
+def test_write_figure(tmp_path, create_confounds_tsv, bidsmreye_eyetrack_tsv):
+    fig = visualize_eye_gaze_data(pd.read_csv(bidsmreye_eyetrack_tsv, sep="\t"))
+    embedded = tmp_path / "embedded.html"
+    shared = tmp_path / "sub-01" / "figures" / "shared.html"
+
+    write_figure(fig, embedded)
+    write_figure(fig, shared, tmp_path)
+
+    assets = list((tmp_path / "assets").glob("plotly-*.min.js"))
+    assert len(assets) == 1
+    assert f'src="../../assets/{assets[0].name}"' in shared.read_text()
+    assert shared.stat().st_size < embedded.stat().st_size / 10
+
+
 def test_group_report(tmp_path, data_dir):
     src_dir = data_dir / "derivatives" / "bidsmreye"
     target_dir = tmp_path / "bidsmreye"
@@ -33,6 +122,19 @@ def test_group_report(tmp_path, data_dir):
     assert (target_dir / "group_eyetrack.tsv").exists()
 
 
+def test_group_report_gaze_density(tmp_path, data_dir):
+    cfg = Config(data_dir / "ds000201-der", tmp_path / "derivatives")
+    quality_control_input(cfg)
+
+    group_report(cfg)
+
+    densities = sorted(cfg.output_dir.glob("sub-*/**/*_gazedensity.npz"))
+    assert densities
+    expected = sum(np.load(x)["counts"] for x in densities)
+    with np.load(cfg.output_dir / "group_gazedensity.npz") as group:
+        assert np.array_equal(group["counts"], expected)
+
+
 def test_group_report_missing_qc(tmp_path, data_dir):
     """Regression test for https://github.com/cpp-lln-lab/bidsMReye/issues/171 ."""
     src_dir = data_dir / "derivatives" / "bidsmreye"
@@ -0,0 +1,211 @@
+"""Benchmark the throughput of the CPU inference settings of generalize.
+
+Each setting runs in its own process,
+as most TensorFlow options must be set before TensorFlow is imported.
+
+By default the model has random weights
+and is run on synthetic volumes with the shape of the bidsmreye outputs:
+the throughput does not depend on the values.
+Pass the weights of a model and an extracted timeseries to benchmark on real data.
+The predictions of each setting are compared to those of the default one.
+
+Usage::
+
+    python tools/benchmark_inference.py
+    python tools/benchmark_inference.py --model dataset_1to6.h5 --timeseries file.npz
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from bidsmreye.configuration import cpu_supports_bfloat16
+from bidsmreye.environment import available_cpus, set_tensorflow_env, set_thread_env
+
+# shape of the timeseries extracted by bidsmreye
+VOLUME_SHAPE = (47, 29, 18)
+
+DEFAULT_SETTING: dict[str, Any] = {
+    "batch_size": 64,
+    "omp_nthreads": available_cpus(),
+    "inter_op_threads": 0,
+    "onednn": True,
+    "xla": False,
+    "bfloat16": False,
+}
+
+
+def list_settings() -> dict[str, dict[str, Any]]:
+    """List the settings to benchmark, each one changing one default option."""
+    settings: dict[str, dict[str, Any]] = {"default": {}}
+    for batch_size in (16, 256):
+        settings[f"--batch_size {batch_size}"] = {"batch_size": batch_size}
+    if available_cpus() > 1:
+        settings["--omp_nthreads 1"] = {"omp_nthreads": 1}
+    settings["--inter_op_threads 1"] = {"inter_op_threads": 1}
+    settings["--no_onednn"] = {"onednn": False}
+    settings["--xla"] = {"xla": True}
+    if cpu_supports_bfloat16():
+        settings["--bfloat16"] = {"bfloat16": True}
+    return {name: {**DEFAULT_SETTING, **x} for name, x in settings.items()}
+
+
+def save_timeseries(file: Path, nb_volumes: int) -> None:
+    """Save random volumes in the format of the timeseries extracted by bidsmreye."""
+    rng = np.random.default_rng(0)
+    np.savez(
+        file,
+        **{
+            f"data_{i}": rng.standard_normal(VOLUME_SHAPE, dtype=np.float32)
+            for i in range(nb_volumes)
+        },
+        **{f"label_{i}": np.zeros((10, 2)) for i in range(nb_volumes)},
+        **{f"identifier_{i}": np.zeros(2) for i in range(nb_volumes)},
+    )
+
+
+def save_random_weights(file: Path) -> None:
+    """Save the weights of a model that was not trained."""
+    from deepmreye import architecture
+    from deepmreye.util import model_opts
+
+    _, model = architecture.create_standard_model(
+        (*VOLUME_SHAPE, 1), model_opts.get_opts()
+    )
+    model.save_weights(file)
+
+
+def run_setting(
+    setting: dict[str, Any], model: Path, timeseries: Path, predictions: Path
+) -> float:
+    """Predict all the volumes of a timeseries with one setting.
+
+    Must run in a process where TensorFlow has not been imported yet.
+
+    :return: Number of volumes predicted per second,
+             without building and compiling the model.
+    """
+    set_thread_env(setting["omp_nthreads"], override=True)
+    set_tensorflow_env(setting["onednn"], setting["inter_op_threads"], override=True)
+
+    from bidsmreye.generalize import (
+        input_shape,
+        load_model,
+        predict_runs,
+        set_tensorflow_options,
+    )
+
+    set_tensorflow_options(bfloat16=setting["bfloat16"])
+    shape = input_shape(timeseries)
+    model_inference = load_model(model, shape, setting["xla"])
+
+    # trace and compile the forward pass
+    model_inference.predict_on_batch(
+        np.zeros((setting["batch_size"], *shape), dtype=np.float32)
+    )
+
+    start = time.perf_counter()
+    _, prediction = next(
+        predict_runs({"model": model_inference}, [str(timeseries)], setting["batch_size"])
+    )
+    duration = time.perf_counter() - start
+
+    pred_y = prediction["model"]["pred_y"]
+    np.save(predictions, pred_y)
+    return len(pred_y) / duration
+
+
+def run_in_subprocess(name: str, setting: dict[str, Any], **files: Path) -> float:
+    worker = {"setting": setting, **{key: str(value) for key, value in files.items()}}
+    result = subprocess.run(
+        [sys.executable, __file__, "--worker", json.dumps(worker)],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        print(result.stderr, file=sys.stderr)
+        raise RuntimeError(f"Setting '{name}' failed.")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", type=Path, help="Weights of the model to use.")
+    parser.add_argument(
+        "--timeseries", type=Path, help="Timeseries extracted by bidsmreye."
+    )
+    parser.add_argument(
+        "--volumes",
+        type=int,
+        default=512,
+        help="Number of synthetic volumes when no timeseries is given.",
+    )
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--random_weights", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.random_weights is not None:
+        save_random_weights(args.random_weights)
+        return
+
+    if args.worker is not None:
+        worker = json.loads(args.worker)
+        print(
+            run_setting(
+                worker["setting"],
+                Path(worker["model"]),
+                Path(worker["timeseries"]),
+                Path(worker["predictions"]),
+            )
+        )
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model = args.model
+        if model is None:
+            model = Path(tmp_dir) / "random_weights.h5"
+            subprocess.run(
+                [sys.executable, __file__, "--random_weights", str(model)],
+                capture_output=True,
+                check=True,
+            )
+
+        timeseries = args.timeseries
+        if timeseries is None:
+            timeseries = Path(tmp_dir) / "sub-01_desc-eye_timeseries.npz"
+            save_timeseries(timeseries, args.volumes)
+
+        print(f"CPUs available: {available_cpus()}")
+        print(f"bfloat16 support: {cpu_supports_bfloat16()}\n")
+        print(f"| {'setting':<22} | {'volumes / s':>11} | {'max abs diff':>12} |")
+        print(f"|{'-' * 24}|{'-' * 13}|{'-' * 14}|")
+
+        reference = None
+        for name, setting in list_settings().items():
+            predictions = Path(tmp_dir) / "predictions.npy"
+            throughput = run_in_subprocess(
+                name,
+                setting,
+                model=model,
+                timeseries=timeseries,
+                predictions=predictions,
+            )
+            pred_y = np.load(predictions)
+            if reference is None:
+                reference = pred_y
+            diff = float(np.nanmax(np.abs(pred_y - reference)))
+            print(f"| {name:<22} | {throughput:>11.1f} | {diff:>12.2e} |")
+
+
+if __name__ == "__main__":
+    main()
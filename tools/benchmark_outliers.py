@@ -0,0 +1,110 @@
+"""Benchmark the S-outliers detection of the quality control.
+
+Times ``compute_robust_outliers`` on random walks of increasing length,
+similar to gaze positions with a few spikes,
+as is and rounded to ``--decimals`` like eyetracker data, which has many ties.
+Up to ``--reference_max`` samples, the flags are also compared
+to those of the original implementation,
+which loops over the samples in O(n²).
+
+Usage::
+
+    python tools/benchmark_outliers.py
+    python tools/benchmark_outliers.py --sizes 1000 10000 --reference_max 10000
+    python tools/benchmark_outliers.py --decimals 1
+"""
+
+from __future__ import annotations
+
+import argparse
+import itertools
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats.distributions import chi2
+
+from bidsmreye.quality_control import compute_robust_outliers
+
+
+def random_gaze(nb_samples: int, decimals: int | None = None) -> pd.Series:
+    """Random walk with spikes and missing samples, rounded if ``decimals`` is set."""
+    rng = np.random.default_rng(0)
+    values = np.cumsum(rng.standard_normal(nb_samples)) / np.sqrt(nb_samples)
+    spikes = rng.random(nb_samples) < 0.001
+    values[spikes] += rng.standard_normal(spikes.sum()) * 10
+    values[rng.random(nb_samples) < 0.01] = np.nan
+    if decimals is not None:
+        values = np.round(values, decimals)
+    return pd.Series(values)
+
+
+def reference_outliers(time_series: pd.Series) -> list[int]:
+    """S-outliers as computed before they were vectorized."""
+    k = np.sqrt(chi2.ppf(0.975, df=1))
+    non_nan_idx = time_series.index[~time_series.isnull()].tolist()
+    distance = []
+    for i in non_nan_idx:
+        indices = list(range(len(time_series)))
+        indices.pop(i)
+        tmp = time_series[indices].dropna()
+        distance.append(np.median(abs(time_series[i] - tmp)))
+    Sn = 1.1926 * np.median(distance)
+    outliers = np.zeros(len(time_series), dtype=np.int8)
+    outliers[non_nan_idx] = (distance / Sn) > k
+    return outliers.tolist()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10**3, 10**4, 10**5, 10**6, 10**7],
+        help="Number of samples of the series.",
+    )
+    parser.add_argument(
+        "--reference_max",
+        type=int,
+        default=10**4,
+        help="Longest series to also run with the original implementation.",
+    )
+    parser.add_argument(
+        "--decimals",
+        type=int,
+        default=2,
+        help="Decimals of the rounded series.",
+    )
+    args = parser.parse_args(argv)
+
+    print(
+        f"| {'samples':>10} | {'series':>10} | {'time (s)':>9} | {'outliers':>8} "
+        f"| {'reference (s)':>13} |"
+    )
+    print(f"|{'-' * 12}|{'-' * 12}|{'-' * 11}|{'-' * 10}|{'-' * 15}|")
+
+    for nb_samples, decimals in itertools.product(args.sizes, [None, args.decimals]):
+        series = random_gaze(nb_samples, decimals)
+        kind = "continuous" if decimals is None else "rounded"
+
+        start = time.perf_counter()
+        outliers = compute_robust_outliers(series)
+        duration = time.perf_counter() - start
+
+        reference = "-"
+        if nb_samples <= args.reference_max:
+            start = time.perf_counter()
+            expected = reference_outliers(series)
+            reference = f"{time.perf_counter() - start:.3f}"
+            if outliers != expected:
+                raise RuntimeError(f"Outliers differ for {nb_samples} samples.")
+
+        print(
+            f"| {nb_samples:>10} | {kind:>10} | {duration:>9.3f} | {sum(outliers):>8} "
+            f"| {reference:>13} |"
+        )
+
+
+if __name__ == "__main__":
+    main()